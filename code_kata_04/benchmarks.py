@@ -0,0 +1,207 @@
+"""
+Benchmarks for the kata 04 readers.
+
+Large weather files are generated by repeating the data rows of weather.dat
+(see `write_weather_file`) so the readers can be timed at any size.  The
+classes follow the airspeed velocity (asv) conventions but can also be run
+directly,
+
+ > python benchmarks.py
+ > python benchmarks.py --n-days 30 100000
+ > python benchmarks.py --check
+"""
+
+import os
+import atexit
+import shutil
+import timeit
+import argparse
+import tempfile
+
+import numpy
+import pandas
+
+import kata_04
+
+
+BENCH_N_DAYS = [30, 10000]
+
+_FNAMES = {}
+
+
+def write_weather_file(fname, n_days, template_fname=kata_04.WEATHER_FNAME):
+    """Write a weather file with `n_days` data rows.
+
+    The header, the blank line after it and the monthly summary line are
+    copied from `template_fname` and the data rows are repeated (with the
+    day numbers continued) until there are `n_days` of them.
+    """
+    with open(template_fname) as fp:
+        lines = fp.read().splitlines()
+    header = lines[:2]
+    rows = [line for line in lines[2:] if line.strip()[:1].isdigit()]
+    footer = [line for line in lines[2:] if line.strip().startswith('mo')]
+
+    with open(fname, 'w') as fp:
+        for line in header:
+            fp.write(line + '\n')
+        for iday in range(n_days):
+            row = rows[iday % len(rows)]
+            fp.write('{:>4d}'.format(iday % 9999 + 1) + row[4:] + '\n')
+        for line in footer:
+            fp.write(line + '\n')
+
+
+def weather_fname(n_days):
+    """Return a temporary weather file with `n_days` rows (written once and
+    removed at exit)."""
+    if n_days not in _FNAMES:
+        dirname = tempfile.mkdtemp(prefix='kata_04_bench_')
+        atexit.register(shutil.rmtree, dirname, True)
+        fname = os.path.join(dirname, 'weather.dat')
+        write_weather_file(fname, n_days)
+        _FNAMES[n_days] = fname
+    return _FNAMES[n_days]
+
+
+class TimeReadWeather:
+    """Reading weather files of different lengths."""
+
+    params = BENCH_N_DAYS
+    param_names = ['n_days']
+
+    def setup(self, n_days):
+        self.fname = weather_fname(n_days)
+        with open(self.fname, 'rb') as fp:
+            lines = [line.rstrip(b'\r\n') for line in fp.readlines()[:102]]
+        self.spans = kata_04.infer_field_spans(
+            [line for line in lines if line.strip()])
+
+    def time_read_weather(self, n_days):
+        kata_04.read_weather(self.fname)
+
+    def time_read_weather_fast(self, n_days):
+        kata_04.read_weather(self.fname, method='fast')
+
+    def time_read_fixed_width_spans(self, n_days):
+        kata_04.read_fixed_width(self.fname, spans=self.spans)
+
+
+class TimeMinSpread:
+    """Day with the smallest temperature spread: reading the whole file
+    into a DataFrame against the streaming engine (in this process and
+    with byte ranges spread over a process pool)."""
+
+    params = BENCH_N_DAYS
+    param_names = ['n_days']
+
+    def setup(self, n_days):
+        self.fname = weather_fname(n_days)
+        self.range_bytes = max(os.path.getsize(self.fname) // 8, 1)
+
+    def time_read_then_min(self, n_days):
+        df = kata_04.read_fixed_width(self.fname, strip_chars='*')
+        df = df[df['Dy'].astype(str).str.isdigit()]
+        (df['MxT'] - df['MnT']).abs().idxmin()
+
+    def time_min_spread(self, n_days):
+        kata_04.weather_min_spread(self.fname, max_workers=1)
+
+    def time_min_spread_pool(self, n_days):
+        kata_04.weather_min_spread(
+            self.fname, range_bytes=self.range_bytes)
+
+
+BENCHMARKS = [TimeReadWeather, TimeMinSpread]
+
+
+def check_read_weather():
+    """Check that both methods of `read_weather` give the same frame.
+
+    Raises:
+      AssertionError: if the frames differ
+    """
+    pandas.testing.assert_frame_equal(
+        kata_04.read_weather(method='fwf'),
+        kata_04.read_weather(method='fast'))
+
+
+def check_min_spread(k=5):
+    """Check `min_spread` against spreads computed from whole DataFrames.
+
+    football.dat is scanned with both layouts (its rows have words without
+    a header word) and a generated weather file with the fixed layout.
+
+    Raises:
+      AssertionError: if a result differs
+    """
+    df = kata_04.read_football()
+    spread = (df['F'] - df['A']).abs()
+    order = numpy.lexsort((numpy.arange(len(df)), spread.values))[:k]
+    expected = [(spread.iloc[i], df['Team'].iloc[i]) for i in order]
+    for layout in kata_04.LAYOUTS:
+        rows = kata_04.football_min_spread(k=k, layout=layout)
+        found = [(row.spread, row.label) for row in rows]
+        assert found == expected, (layout, found, expected)
+
+    fname = weather_fname(BENCH_N_DAYS[-1])
+    df = kata_04.read_fixed_width(fname, strip_chars='*')
+    df = df[df['Dy'].astype(str).str.isdigit()].reset_index(drop=True)
+    spread = (df['MxT'] - df['MnT']).abs()
+    order = numpy.lexsort((numpy.arange(len(df)), spread.values))[:k]
+    expected = [(spread.iloc[i], str(df['Dy'].iloc[i])) for i in order]
+    rows = kata_04.weather_min_spread(fname, k=k, max_workers=1)
+    found = [(row.spread, row.label) for row in rows]
+    assert found == expected, (found, expected)
+
+
+def run_benchmarks(classes, n_days=None, repeat=3):
+    """Run the `time_` methods of each class and print the best time.
+
+    The number of calls per timing is chosen with `Timer.autorange`.  If
+    `n_days` is given it replaces the `params` of the classes.
+
+    Returns:
+      list of tuple: (class name, method name, param, best seconds per call)
+    """
+    results = []
+    for cls in classes:
+        params = cls.params if n_days is None else n_days
+        for param in params:
+            bench = cls()
+            bench.setup(param)
+            names = sorted(
+                name for name in dir(bench) if name.startswith('time_'))
+            for name in names:
+                method = getattr(bench, name)
+                timer = timeit.Timer(lambda: method(param))
+                number, _ = timer.autorange()
+                best = min(timer.repeat(repeat=repeat, number=number)) / number
+                results.append((cls.__name__, name, param, best))
+                print('{:<16} {:<32} {:>8} {:>14.3f} ms'.format(
+                    cls.__name__, name, str(param), best * 1.0e3))
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--n-days',
+        type=int,
+        nargs='+',
+        default=None,
+        help='number of rows in the generated files (default {})'.format(
+            BENCH_N_DAYS))
+    parser.add_argument(
+        '--check',
+        action='store_true',
+        help='only check the results of the readers and the spread engine')
+    args = parser.parse_args()
+
+    if args.check:
+        check_read_weather()
+        check_min_spread()
+        print('checks passed')
+    else:
+        run_benchmarks(BENCHMARKS, n_days=args.n_days)
@@ -1,11 +1,42 @@
+import os
+import re
+import mmap
+import heapq
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
 import pandas
 
 
 WEATHER_FNAME = 'weather.dat'
 FOOTBALL_FNAME = 'football.dat'
 
+SPACE = ord(' ')
+NEWLINE = ord('\n')
+CR = ord('\r')
+DASH = ord('-')
+EQUALS = ord('=')
+LINE_BLANK = 0
+LINE_SEPARATOR = 1
+LINE_DATA = 2
+
+DEFAULT_CHUNK_BYTES = 1 << 20
+DEFAULT_RANGE_BYTES = 64 << 20
+NUMBER_CHARS = b' +-.0123456789eE'
+LAYOUTS = ['fixed', 'whitespace']
+
+SpreadRow = namedtuple('SpreadRow', [
+    'spread',           # |a - b| (or a - b with absolute=False)
+    'label',            # value of the label field
+    'a',                # value of the first field
+    'b',                # value of the second field
+    'fname',            # file the row is in
+    'offset',           # byte offset of the start of the row in the file
+])
 
-def read_weather(fname=WEATHER_FNAME):
+
+def read_weather(fname=WEATHER_FNAME, method='fwf'):
     """Read the weather file into a DataFrame and return it.
 
     Pandas has many input routines (all prefixed with "read")
@@ -25,7 +56,12 @@ def read_weather(fname=WEATHER_FNAME):
     turns out that pandas.read_fwf is *almost* smart enough to automatically
     determine the widths of the columns.  In the end we need to specify them
     to get the last columns read correctly.
+
+    With `method='fast'` the file is read with `read_fixed_width` instead,
+    which works out the widths by itself and is much faster on big files.
     """
+    if method == 'fast':
+        return read_fixed_width(fname)
 
     # things I tried that don't work
     # 1) df = pandas.read_csv(fname)
@@ -35,16 +71,519 @@ def read_weather(fname=WEATHER_FNAME):
     df = pandas.read_fwf(
         fname, widths=[4, 6, 6, 6, 7, 6, 5, 6, 6, 6, 5, 4, 4, 4, 4, 4, 6])
 
-    # we still have a row on top full of NaN because there was a blank line
-    # just below the header.  we could use dropna(axis=0, how='all') but that
-    # would also drop any rows that happen to be empty in the middle of the
-    # data.  instead we can simply use drop(0) which is the label of the row.
-    # also note that almost every pandas operation returns a new object and
-    # doesn't operate in place so we assign the results to df.
-    df = df.drop(0)
+    # older versions of pandas give a row on top full of NaN because there
+    # was a blank line just below the header (newer ones skip blank lines).
+    # we could use dropna(axis=0, how='all') but that would also drop any
+    # rows that happen to be empty in the middle of the data.  instead we
+    # only drop the first row (label 0) and only if it is all NaN.  also note
+    # that almost every pandas operation returns a new object and doesn't
+    # operate in place so we assign the results to df.
+    if df.shape[0] > 0 and df.iloc[0].isnull().all():
+        df = df.drop(0).reset_index(drop=True)
     return df
 
 
+def read_football(fname=FOOTBALL_FNAME):
+    """Read the football file into a DataFrame and return it.
+
+    This file trips up `pandas.read_fwf`: the team rank ("1.") and the "-"
+    between goals for and against have no header and there is a separator
+    line of dashes in the middle.  `read_fixed_width` handles all of these.
+    """
+    return read_fixed_width(fname)
+
+
+def read_fixed_width(fname, spans=None, sample_rows=100, strip_chars=None):
+    """Read a fixed width file with a header line into a DataFrame.
+
+    This is a faster alternative to `pandas.read_fwf` that can also work
+    out the column boundaries by itself.  The steps are,
+
+      1) memory map the file and view it as one array of bytes
+      2) find the start and end of every line with vectorized searches for
+         newline characters.  Blank lines and separator lines (only '-' or
+         '=' characters, like the one in football.dat) are dropped.
+      3) if `spans` is not given, infer them (see `infer_field_spans`) from
+         the header line and the first `sample_rows` data lines
+      4) gather the bytes of each field of all data lines into a 2-D array
+         (one row per line, padded with spaces), which is a column of fixed
+         length byte strings
+      5) convert each column to int, then float and otherwise str.  Empty
+         fields (e.g. HDDay in weather.dat) become missing values.
+
+    Args:
+      fname (str): name of the file
+      spans (list of tuple): (start, stop) character positions of each
+        field (default is to infer them)
+      sample_rows (int): number of data lines used to infer the spans
+      strip_chars (str): characters to remove from every field before
+        converting, e.g. '*' to read the flagged values in weather.dat as
+        numbers
+
+    Returns:
+      DataFrame: one column per field named after the header words above it
+        (fields without header words are named like pandas names them)
+    """
+    with open(fname, 'rb') as fp:
+        try:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files can't be memory mapped
+            return pandas.DataFrame()
+    try:
+        return _read_fixed_width_buf(
+            numpy.frombuffer(mm, dtype=numpy.uint8), spans, sample_rows,
+            strip_chars)
+    finally:
+        try:
+            mm.close()
+        except BufferError:
+            # an array still refers to the map (e.g. from a traceback), it
+            # is closed when that is collected
+            pass
+
+
+def _read_fixed_width_buf(buf, spans, sample_rows, strip_chars):
+    """`read_fixed_width` of the bytes of a file.  Every column is copied
+    out of `buf` so no array refers to it afterwards."""
+    starts, ends, kinds = _line_bounds(buf)
+    header_idx = numpy.flatnonzero(kinds != LINE_BLANK)[0]
+    is_data = kinds == LINE_DATA
+    is_data[:header_idx+1] = False
+    data_starts, data_ends = starts[is_data], ends[is_data]
+
+    header = bytes(buf[starts[header_idx]:ends[header_idx]])
+    if spans is None:
+        sample = [header] + [
+            bytes(buf[a:b])
+            for a, b in zip(data_starts[:sample_rows], data_ends[:sample_rows])]
+        spans = infer_field_spans(sample)
+
+    columns = {}
+    names = _field_names(header, spans)
+    for name, span in zip(names, spans):
+        field = _field_bytes(buf, data_starts, data_ends, span)
+        columns[name] = _convert_field(field, strip_chars)
+    return pandas.DataFrame(columns)
+
+
+def infer_field_spans(lines):
+    """Return (start, stop) positions of the fields in fixed width lines.
+
+    The first line is the header.  A character position is part of a field
+    if any of the lines has a non-space character there, so fields are
+    first taken to be the runs of such positions.  A field that is empty in
+    most lines (e.g. HDDay in weather.dat) is still found as long as the
+    header or some line fills it.
+
+    Neighbouring columns are not always separated by a blank position.  In
+    weather.dat "10.0" in SkyC touches MxS and the header "AvSLP" is one
+    character to the right of its values, so MnR and AvSLP touch.  A run
+    under more than one header word is therefore split between each pair of
+    words, after the position that is blank in the most data lines.  That
+    position goes to the left field, which is where flags like the '*' of
+    "29*" in MxS belong.
+
+    Args:
+      lines (list of bytes): header and sample lines
+
+    Returns:
+      list of tuple: (start, stop) of each field
+    """
+    width = max(len(line) for line in lines)
+    counts = numpy.zeros(width, dtype=numpy.int64)
+    for line in lines[1:]:
+        chars = numpy.frombuffer(line, dtype=numpy.uint8)
+        counts[:len(line)] += (chars != SPACE) & (chars != CR)
+    words = _header_words(lines[0])
+
+    occupied = numpy.zeros(width + 2, dtype=bool)
+    occupied[1:width+1] = counts > 0
+    for start, stop in words:
+        occupied[start+1:stop+1] = True
+    edges = numpy.flatnonzero(numpy.diff(occupied.astype(numpy.int8)))
+
+    spans = []
+    for start, stop in zip(edges[::2], edges[1::2]):
+        inside = [
+            word for word in words if start <= word[0] and word[1] <= stop]
+        for left, right in zip(inside[:-1], inside[1:]):
+            # candidate split positions run from the second character of
+            # the left word to the one before the last of the right word
+            lo, hi = left[0] + 1, max(right[1] - 1, left[0] + 2)
+            split = lo + int(numpy.argmin(counts[lo:hi])) + 1
+            spans.append((int(start), split))
+            start = split
+        spans.append((int(start), int(stop)))
+    return spans
+
+
+def _header_words(header):
+    """Return (start, stop) positions of the words in a header line."""
+    return [
+        match.span() for match in re.finditer(rb'[^ \r]+', header)]
+
+
+def _field_names(header, spans):
+    """Name each field after the header words it overlaps the most.
+
+    Fields without header words are named like pandas names them,
+    'Unnamed: <field number>'.
+    """
+    words = {}
+    for start, stop in _header_words(header):
+        overlaps = [
+            min(stop, span[1]) - max(start, span[0]) for span in spans]
+        ifield = int(numpy.argmax(overlaps))
+        words.setdefault(ifield, []).append(header[start:stop].decode())
+    return [
+        ' '.join(words[ifield]) if ifield in words
+        else 'Unnamed: {}'.format(ifield)
+        for ifield in range(len(spans))]
+
+
+def _line_bounds(buf):
+    """Return (starts, ends, kinds) of the lines in a byte array.
+
+    `ends` excludes the newline (and a carriage return before it) and
+    `kinds` is one of LINE_BLANK, LINE_SEPARATOR or LINE_DATA per line.
+    """
+    newlines = numpy.flatnonzero(buf == NEWLINE)
+    starts = numpy.concatenate([[0], newlines + 1])
+    ends = numpy.concatenate([newlines, [buf.size]])
+    if starts[-1] == buf.size:
+        starts, ends = starts[:-1], ends[:-1]
+    has_cr = (ends > starts) & (buf[numpy.maximum(ends-1, 0)] == CR)
+    ends = ends - has_cr
+
+    # count the text and rule characters of every line with one reduction
+    # over the line segments (reduceat returns the first element for empty
+    # segments so those are zeroed)
+    is_text = (buf > SPACE) & (buf != CR)
+    is_rule = (buf == DASH) | (buf == EQUALS)
+    is_empty = ends == starts
+    seg_starts = numpy.minimum(starts, buf.size - 1)
+    line_text = numpy.add.reduceat(is_text, seg_starts, dtype=numpy.int32)
+    line_rule = numpy.add.reduceat(is_rule, seg_starts, dtype=numpy.int32)
+    line_text[is_empty] = 0
+    line_rule[is_empty] = 0
+
+    kinds = numpy.full(starts.size, LINE_DATA, dtype=numpy.int8)
+    kinds[line_rule == line_text] = LINE_SEPARATOR
+    kinds[line_text == 0] = LINE_BLANK
+    return starts, ends, kinds
+
+
+def _convert_field(field, strip_chars=None):
+    """Convert a 2-D array of field bytes (one row per line) to int, float
+    or str values.
+
+    numpy's casts from byte strings ignore surrounding spaces, so fields are
+    only stripped when they hold strings.
+    """
+    if strip_chars:
+        field = field.copy()
+        field[numpy.isin(field, list(strip_chars.encode()))] = SPACE
+    is_empty = ~(field != SPACE).any(axis=1)
+    values = field.view('S{}'.format(field.shape[1])).ravel()
+    if not is_empty.any():
+        try:
+            return values.astype(numpy.int64)
+        except ValueError:
+            pass
+    try:
+        return numpy.where(is_empty, b'nan', values).astype(numpy.float64)
+    except ValueError:
+        strings = numpy.char.strip(values).astype(str).astype(object)
+        strings[is_empty] = None
+        return strings
+
+
+def min_spread(fnames, col_a, col_b, label_col, k=1, layout='fixed',
+               label_regex=None, strip_chars=None, absolute=True,
+               chunk_bytes=DEFAULT_CHUNK_BYTES,
+               range_bytes=DEFAULT_RANGE_BYTES, max_workers=None):
+    """Return the `k` rows with the smallest spread |a - b| between two
+    columns of one or more files.
+
+    Every file has a header line and is read in chunks of `chunk_bytes`
+    (plus one line) so memory doesn't grow with the file size.  Files
+    longer than `range_bytes` are split into byte ranges that start and end
+    at line boundaries and every file or range is a task for a pool of
+    processes.  Each task keeps its `k` best rows in a heap and the results
+    of all tasks are merged in the end.
+
+    Only the label and the two columns are extracted from a chunk.  Rows
+    in which one of them isn't a number are skipped (blank, separator and
+    repeated header lines, summary lines, ...), as are rows whose label
+    doesn't match `label_regex`.
+
+    Args:
+      fnames (str or list of str): files to scan
+      col_a, col_b, label_col (str or int): names of the columns (as in
+        `read_fixed_width`) or their positions
+      k (int): number of rows to return
+      layout (str): 'fixed' for fixed width fields (see
+        `infer_field_spans`, the spans are inferred from the start of each
+        file) or 'whitespace' for fields separated by white space (header
+        words are then matched to data words by position, see
+        `_word_positions`)
+      label_regex (str): only rows whose stripped label fully matches
+        this regular expression are kept
+      strip_chars (str): characters to remove from the two columns before
+        converting them (e.g. '*' for the flags in weather.dat)
+      absolute (bool): rank by |a - b| (default) or by a - b
+      chunk_bytes (int): bytes read at a time
+      range_bytes (int): bytes per task for large files
+      max_workers (int): number of processes (default is the CPU count).
+        With a single task or `max_workers=1` everything runs in this
+        process.
+
+    Returns:
+      list of SpreadRow: sorted by spread, then file and offset
+    """
+    if layout not in LAYOUTS:
+        raise ValueError('layout must be one of {}'.format(LAYOUTS))
+    if isinstance(fnames, str):
+        fnames = [fnames]
+
+    tasks = []
+    for fname in fnames:
+        fields, data_start = _spread_fields(
+            fname, (label_col, col_a, col_b), layout)
+        size = os.path.getsize(fname)
+        for start in range(data_start, max(size, data_start + 1), range_bytes):
+            tasks.append((
+                fname, start, min(start + range_bytes, size), fields, layout,
+                k, label_regex, strip_chars, absolute, chunk_bytes))
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if len(tasks) == 1 or max_workers == 1:
+        results = [_spread_task(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_spread_task, *zip(*tasks)))
+    return heapq.nsmallest(
+        k, (row for rows in results for row in rows), key=_spread_key)
+
+
+def _spread_key(row):
+    return (row.spread, row.fname, row.offset)
+
+
+def _spread_fields(fname, cols, layout, sample_rows=100):
+    """Locate the label and the two columns of a file.
+
+    Returns:
+      tuple: (fields, data_start) where `fields` are (start, stop) spans
+        for the fixed layout and word positions for the white space layout
+        and `data_start` is the byte offset after the header line
+    """
+    with open(fname, 'rb') as fp:
+        head = fp.read(DEFAULT_CHUNK_BYTES)
+    head = head[:head.rfind(b'\n') + 1] or head
+    buf = numpy.frombuffer(head, dtype=numpy.uint8)
+    starts, ends, kinds = _line_bounds(buf)
+    header_idx = numpy.flatnonzero(kinds != LINE_BLANK)[0]
+    header = head[starts[header_idx]:ends[header_idx]]
+    data_start = int(ends[header_idx]) + 1
+
+    is_data = kinds == LINE_DATA
+    is_data[:header_idx+1] = False
+    sample = [
+        head[a:b] for a, b in zip(
+            starts[is_data][:sample_rows], ends[is_data][:sample_rows])]
+    if layout == 'fixed':
+        spans = infer_field_spans([header] + sample)
+        names = _field_names(header, spans)
+        positions = spans
+    else:
+        names = [word.decode() for word in header.split()]
+        positions = _word_positions(header, sample, fname)
+
+    fields = []
+    for col in cols:
+        if isinstance(col, str):
+            if col not in names:
+                raise KeyError('{!r} is not a column of {}'.format(col, fname))
+            col = names.index(col)
+        fields.append(positions[col])
+    return fields, data_start
+
+
+def _word_positions(header, sample, fname):
+    """Return the position of the data word under each header word.
+
+    Data lines can have words without a header word (the rank "1." and the
+    "-" between goals in football.dat), so header words are matched to the
+    data word they overlap the most (or the nearest one) by character
+    position.  This needs the same number of words in every sample line.
+    """
+    header_words = _header_words(header)
+    line_words = [_header_words(line) for line in sample]
+    n_words = set(len(words) for words in line_words)
+    if len(n_words) > 1:
+        raise ValueError(
+            'lines of {} have {} words, the white space layout needs the '
+            'same number of words in every line (use the fixed '
+            'layout)'.format(fname, sorted(n_words)))
+    if not line_words or n_words == {len(header_words)}:
+        return list(range(len(header_words)))
+
+    positions = []
+    for start, stop in header_words:
+        votes = numpy.zeros(len(line_words[0]), dtype=numpy.int64)
+        for words in line_words:
+            overlap = [min(stop, b) - max(start, a) for a, b in words]
+            distance = [abs((a + b) - (start + stop)) for a, b in words]
+            best = max(
+                range(len(words)),
+                key=lambda i: (overlap[i] > 0, overlap[i], -distance[i]))
+            votes[best] += 1
+        positions.append(int(numpy.argmax(votes)))
+    return positions
+
+
+def _spread_task(fname, start, stop, fields, layout, k, label_regex,
+                 strip_chars, absolute, chunk_bytes):
+    """Return the `k` best rows that start in [start, stop) of a file."""
+    label_re = re.compile(label_regex.encode()) if label_regex else None
+    heap = []
+    with open(fname, 'rb') as fp:
+        # a row belongs to the range its first byte is in
+        if start > 0:
+            fp.seek(start - 1)
+            if fp.read(1) != b'\n':
+                fp.readline()
+        offset = fp.tell()
+        while offset < stop:
+            chunk = fp.read(chunk_bytes)
+            if not chunk:
+                break
+            if not chunk.endswith(b'\n'):
+                chunk += fp.readline()
+            for row in _chunk_spreads(
+                    chunk, offset, stop, fields, layout, label_re,
+                    strip_chars, absolute, k):
+                # the heap holds the worst kept row on top
+                item = (-row.spread, -row.offset, row)
+                if len(heap) < k:
+                    heapq.heappush(heap, item)
+                elif item > heap[0]:
+                    heapq.heapreplace(heap, item)
+            offset += len(chunk)
+    return [item[-1]._replace(fname=fname) for item in heap]
+
+
+def _chunk_spreads(chunk, offset, stop, fields, layout, label_re, strip_chars,
+                   absolute, k):
+    """Return the `k` best rows of a chunk of whole lines as `SpreadRow`s
+    (without the file name)."""
+    buf = numpy.frombuffer(chunk, dtype=numpy.uint8)
+    starts, ends, kinds = _line_bounds(buf)
+    keep = (kinds == LINE_DATA) & (starts + offset < stop)
+    starts, ends = starts[keep], ends[keep]
+    if starts.size == 0:
+        return []
+
+    if layout == 'fixed':
+        label, a, b = [
+            _field_bytes(buf, starts, ends, span) for span in fields]
+    else:
+        words = [chunk[s:e].split() for s, e in zip(starts, ends)]
+        label, a, b = [
+            _word_bytes(words, position) for position in fields]
+    a = _parse_numbers(a, strip_chars)
+    b = _parse_numbers(b, strip_chars)
+    labels = numpy.char.strip(label.view(
+        'S{}'.format(max(label.shape[1], 1))).ravel())
+
+    spread = a - b
+    if absolute:
+        spread = numpy.abs(spread)
+    # rows in order of (spread, offset), the label is only checked until k
+    # rows are accepted
+    rows = numpy.flatnonzero(~numpy.isnan(spread))
+    rows = rows[numpy.lexsort((starts[rows], spread[rows]))]
+    best = []
+    for i in rows:
+        if label_re is not None and label_re.fullmatch(labels[i]) is None:
+            continue
+        best.append(SpreadRow(
+            float(spread[i]), labels[i].decode(), float(a[i]), float(b[i]),
+            None, int(offset + starts[i])))
+        if len(best) == k:
+            break
+    return best
+
+
+def _field_bytes(buf, starts, ends, span):
+    """Return a 2-D array with the bytes of one fixed width field of every
+    line (padded with spaces).
+
+    The field is gathered one character position at a time, so besides the
+    result only a few arrays with one value per line are allocated.
+    """
+    field = numpy.full((starts.size, span[1] - span[0]), SPACE,
+                       dtype=numpy.uint8)
+    for j, pos in enumerate(range(span[0], span[1])):
+        index = starts + pos
+        valid = index < ends
+        field[valid, j] = buf[index[valid]]
+    return field
+
+
+def _word_bytes(words, position):
+    """Return a 2-D array with one word of every line (padded with
+    spaces)."""
+    values = numpy.array(
+        [line[position] if position < len(line) else b''
+         for line in words])
+    width = max(values.dtype.itemsize, 1)
+    field = numpy.frombuffer(
+        values.astype('S{}'.format(width)).tobytes(), dtype=numpy.uint8)
+    field = field.reshape(len(words), width).copy()
+    field[field == 0] = SPACE
+    return field
+
+
+def _parse_numbers(field, strip_chars=None):
+    """Convert a 2-D array of field bytes to floats (NaN for fields that
+    are empty or aren't numbers)."""
+    if strip_chars:
+        field = field.copy()
+        field[numpy.isin(field, list(strip_chars.encode()))] = SPACE
+    allowed = numpy.zeros(256, dtype=bool)
+    allowed[list(NUMBER_CHARS)] = True
+    is_number = allowed[field].all(axis=1) & (field != SPACE).any(axis=1)
+    values = numpy.full(field.shape[0], numpy.nan)
+    strings = field[is_number].view('S{}'.format(field.shape[1])).ravel()
+    try:
+        values[is_number] = strings.astype(numpy.float64)
+    except ValueError:
+        # things like '-' or '1-2' pass the character test
+        for i, string in zip(numpy.flatnonzero(is_number), strings):
+            try:
+                values[i] = float(string)
+            except ValueError:
+                pass
+    return values
+
+
+def weather_min_spread(fnames=WEATHER_FNAME, k=1, **kwargs):
+    """Return the `k` days with the smallest temperature spread (MxT - MnT)
+    in one or more weather files (see `min_spread`)."""
+    return min_spread(
+        fnames, 'MxT', 'MnT', 'Dy', k=k, label_regex=r'\d+',
+        strip_chars='*', **kwargs)
+
+
+def football_min_spread(fnames=FOOTBALL_FNAME, k=1, **kwargs):
+    """Return the `k` teams with the smallest difference between goals for
+    and goals against (F - A) in one or more football files (see
+    `min_spread`)."""
+    return min_spread(fnames, 'F', 'A', 'Team', k=k, **kwargs)
 
 
 if __name__ == '__main__':
@@ -66,3 +605,11 @@ if __name__ == '__main__':
     print
 
     # "loc" and "iloc" are ways to index into the DataFrame
+
+    # the kata questions, answered by the streaming engine
+    day = weather_min_spread()[0]
+    print('day with the smallest temperature spread: {} ({})'.format(
+        day.label, day.spread))
+    team = football_min_spread()[0]
+    print('team with the smallest goal difference: {} ({})'.format(
+        team.label, team.spread))
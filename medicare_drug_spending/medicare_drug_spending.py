@@ -1,47 +1,823 @@
-import pandas
-import matplotlib
-import matplotlib.pyplot as plt
-import seaborn as sns
+"""
+Cluster the drugs in the Medicare Drug Spending dashboard workbook.
+
+The first version of this script ran `AffinityPropagation(preference=-50)`
+on the scaled percent features.  Affinity propagation passes messages
+between every pair of samples so it builds dense n x n similarity,
+responsibility and availability matrices and memory and time grow
+quadratically with the number of drugs.  That is fine for the ~3000 drugs
+in the 2016 file but not for dashboards that stack several years.
+
+`cluster_drugs` offers a choice of engines,
+
+  - 'affinity' (default): the original dense `AffinityPropagation`
+    (exact, O(n^2))
+  - 'knn_affinity': affinity propagation with messages passed only along
+    the edges of a k-nearest-neighbour graph (O(n k) memory, see
+    `knn_affinity_propagation`)
+  - 'minibatch_kmeans': `MiniBatchKMeans` with a fixed number of clusters
+    (linear time and memory)
+
+The workbook is read by `stream_dashboard` through a read-only sheet
+reader that keeps only the requested columns and drops the footer rows as
+it goes.  The result is cached as typed arrays keyed on the sha256 of the
+workbook (see `cached_dashboard`) so repeat runs skip the Excel parsing.
+
+Every stage (reading, scaling, clustering) is timed and, if `tracemalloc`
+is tracing, its peak memory is recorded too (see `timed_stage`).  openpyxl,
+sklearn and matplotlib are imported by the functions that use them.
+
+ > python medicare_drug_spending.py
+ > python medicare_drug_spending.py --engine minibatch_kmeans --n-clusters 12
+ > python medicare_drug_spending.py --fname data/a.xlsx data/b.xlsx --trace-memory
+ > python medicare_drug_spending.py --read-method pandas
+"""
+
+import os
+import sys
+import json
+import time
+import datetime
+import warnings
+import hashlib
+import argparse
+import tracemalloc
 from itertools import cycle
+from collections import deque
+from collections import namedtuple
+from contextlib import contextmanager
+
+import numpy
+import pandas
 
-from sklearn.preprocessing import StandardScaler
-from sklearn.cluster import AffinityPropagation
 
-fname = 'data/Medicare_Drug_Spending_Dashboard_Data_02_17_2016.xlsx'
-df = pandas.read_excel(fname, header=2, skip_footer=3, na_values=['n/a', '*'])
+DEFAULT_FNAME = 'data/Medicare_Drug_Spending_Dashboard_Data_02_17_2016.xlsx'
+NA_VALUES = ['n/a', '*']
+FEATURE_SETS = ['percent', 'dense']
+# sheet columns of each feature set
+FEATURE_COLUMNS = {'percent': slice(-4, None), 'dense': slice(6, None)}
+READ_METHODS = ['stream', 'pandas']
+DEFAULT_CACHE_DIR = '.dashboard_cache'
+CLUSTER_ENGINES = ['affinity', 'knn_affinity', 'minibatch_kmeans']
+DEFAULT_ENGINE = 'affinity'
+DEFAULT_FRAC_THRESH = 0.2
+DEFAULT_PREFERENCE = -50
+DEFAULT_N_NEIGHBORS = 30
+DEFAULT_N_CLUSTERS = 8
 
-features = df.iloc[:, 6:]
-frac_null = features.isnull().sum() / features.shape[0]
-dense_features = features.loc[:, frac_null < 0.2]
-percent_features = df.iloc[:, -4:]
 
-# scale features such that they have zero mean and unit standard deviation
-scaler = StandardScaler()
-#X = scaler.fit_transform(dense_features)
-X = scaler.fit_transform(percent_features)
+StageStats = namedtuple('StageStats', [
+    'stage',            # name of the stage
+    'seconds',          # wall time
+    'peak_mb',          # peak traced memory (None if tracemalloc is off)
+])
 
-af = AffinityPropagation(preference=-50).fit(X)
-cluster_centers_indices = af.cluster_centers_indices_
-labels = af.labels_
-n_clusters_ = len(cluster_centers_indices)
 
+ClusterResult = namedtuple('ClusterResult', [
+    'engine',           # name of the engine used
+    'labels',           # cluster label of every row (-1 if unassigned)
+    'centers',          # coordinates of the cluster centers
+    'exemplars',        # row index of each center (None for k-means)
+    'n_clusters',
+    'n_iter',           # iterations of the clustering algorithm
+    'converged',        # False if the engine stopped at its max_iter
+    'stages',           # list of StageStats
+])
 
 
-from itertools import cycle
+class _UncountedStage:
+    """Stage yielded by `timed_stage` when rows are not recorded."""
+
+
+    def add_rows(self, rows):
+        pass
+
+
+@contextmanager
+def timed_stage(stages, name, rows=None):
+    """Append the wall time and peak memory of a `with` block to `stages`.
+
+    When the block runs under `project_1/cli.py` with profiling on, the
+    stage is handed to `profiling.stage` (rows included) and its record is
+    reused, so the two don't reset each other's `tracemalloc` peaks.
+    Otherwise memory is only measured while `tracemalloc` is tracing and
+    the peak is reset when the stage starts so every stage reports its own
+    peak.
+
+    Yields an object whose `add_rows` counts the rows of the stage.
+    """
+    profiling = sys.modules.get('profiling')
+    if profiling is not None and profiling.is_enabled():
+        with profiling.stage(name, rows=rows) as st:
+            yield st
+        stages.append(StageStats(name, st.record.wall_seconds,
+                                 st.record.peak_mb))
+        return
+
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+    t1 = time.perf_counter()
+    yield _UncountedStage()
+    t2 = time.perf_counter()
+    peak_mb = tracemalloc.get_traced_memory()[1] / 2**20 if tracing else None
+    stages.append(StageStats(name, t2-t1, peak_mb))
+
+
+def stage_report(stages):
+    """Return the stage statistics as a DataFrame indexed by stage."""
+    return pandas.DataFrame(
+        stages, columns=StageStats._fields).set_index('stage')
+
+
+def _resolve_usecols(usecols, n_cols):
+    """Return the sorted sheet column positions selected by `usecols`, a
+    list of slices (negative bounds count from the last header column)."""
+    if usecols is None:
+        return list(range(n_cols))
+    positions = set()
+    for cols in usecols:
+        positions.update(range(n_cols)[cols])
+    return sorted(positions)
+
+
+def _convert_cell(value):
+    """Convert a cell value the way pandas' openpyxl reader does (blank
+    cells become '', integral numbers int and error cells NaN)."""
+    from openpyxl.cell.cell import ERROR_CODES
+
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return int(value) if int(value) == value else float(value)
+    if isinstance(value, str) and value in ERROR_CODES:
+        return numpy.nan
+    return value
+
+
+def stream_dashboard(fname, header=2, footer=3, usecols=None,
+                     na_values=NA_VALUES):
+    """Read the first sheet of a dashboard workbook one row at a time.
+
+    `pandas.read_excel` loads the whole sheet into memory before it drops
+    the title rows and the footer.  This reads the rows through a
+    read-only `openpyxl` worksheet instead, keeps only the columns in
+    `usecols` and holds back the last `footer` rows in a short queue so
+    the notes below the data are never stored.  As in `read_excel`, blank
+    rows inside the data become rows of NaN and blank rows at the bottom
+    of the sheet are dropped before the footer is counted.  The kept rows
+    go through the parser `read_excel` uses, so column names, types and
+    missing values (`na_values` and pandas' default NA strings) come out
+    the same.
+
+    Args:
+      fname (str): dashboard workbook
+      header (int): 0-based row of the column names
+      footer (int): number of rows to drop at the bottom
+      usecols (list of slice): sheet column positions to keep, e.g.
+        `[slice(0, 2), slice(-4, None)]` (default all columns)
+      na_values (list): cell values that mean missing
+
+    Returns:
+      DataFrame: one row per drug
+    """
+    from openpyxl import load_workbook
+    from pandas.io.parsers import TextParser
+
+    wb = load_workbook(fname, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[0]
+        rows = ws.iter_rows(min_row=header + 1, values_only=True)
+        cells = [_convert_cell(v) for v in next(rows, ())]
+        while cells and cells[-1] == '':
+            cells.pop()
+        names = TextParser([cells], header=0).read().columns
+        positions = _resolve_usecols(usecols, len(names))
+        kept = []
+        pending = deque()
+        blank = [''] * len(positions)
+        n_blank = 0
+        for row in rows:
+            values = [_convert_cell(v) for v in row[:len(names)]]
+            if all(v == '' for v in values):
+                # only blank rows followed by data are kept
+                n_blank += 1
+                continue
+            values += [''] * (len(names) - len(values))
+            pending.extend([blank] * n_blank)
+            pending.append([values[i] for i in positions])
+            n_blank = 0
+            while len(pending) > footer:
+                kept.append(pending.popleft())
+    finally:
+        wb.close()
+
+    df = TextParser(
+        kept, names=list(names[positions]), header=None,
+        na_values=na_values, skip_blank_lines=False).read()
+    df.columns = names[positions]
+    return df
+
+
+def _file_digest(fname, chunk_bytes=2**20):
+    digest = hashlib.sha256()
+    with open(fname, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_bytes), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def dashboard_cache_fname(fname, cache_dir=None, **kwargs):
+    """Return the cache file of a workbook read with `stream_dashboard`
+    keyword arguments `kwargs`.
+
+    The name holds the sha256 of the workbook and of the arguments, so an
+    edited workbook or a different projection never hits a stale cache.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(
+            os.path.dirname(os.path.abspath(fname)), DEFAULT_CACHE_DIR)
+    options = dict(kwargs)
+    if options.get('usecols') is not None:
+        options['usecols'] = [
+            [cols.start, cols.stop, cols.step] for cols in options['usecols']]
+    options_hash = hashlib.sha256(
+        json.dumps(options, sort_keys=True).encode('utf8')).hexdigest()
+    return os.path.join(cache_dir, '{}-{}-{}.npz'.format(
+        os.path.splitext(os.path.basename(fname))[0],
+        _file_digest(fname)[:16], options_hash[:8]))
+
+
+def save_dashboard_cache(df, cache_fname):
+    """Write a frame from `stream_dashboard` as typed arrays.
+
+    Number, boolean and datetime columns are stored as they are, text
+    columns as a unicode array plus a mask of missing cells and columns
+    that mix types cell by cell (see `_encode_cells`), so the cache loads
+    without pickle.  The kind of every column is kept in the metadata.
+    """
+    arrays = {}
+    kinds = []
+    for i, col in enumerate(df.columns):
+        values = df[col].to_numpy()
+        if values.dtype.kind in 'biufM':
+            kinds.append('array')
+            arrays['c{}'.format(i)] = values
+            continue
+        missing = pandas.isnull(values)
+        if all(isinstance(v, str) for v in values[~missing]):
+            kinds.append('text')
+            arrays['c{}'.format(i)] = numpy.array(
+                ['' if m else v for v, m in zip(values, missing)], dtype=str)
+            arrays['m{}'.format(i)] = missing
+        else:
+            kinds.append('cells')
+            for name, array in _encode_cells(values).items():
+                arrays['{}{}'.format(name, i)] = array
+    meta = {'columns': [str(col) for col in df.columns],
+            'labels': [_label_type(col) for col in df.columns],
+            'columns_dtype': str(df.columns.dtype),
+            'kinds': kinds}
+    os.makedirs(os.path.dirname(cache_fname), exist_ok=True)
+    tmp_fname = cache_fname + '.tmp'
+    with open(tmp_fname, 'wb') as fp:
+        numpy.savez(fp, meta=numpy.array(json.dumps(meta)), **arrays)
+    os.replace(tmp_fname, cache_fname)
+
+
+# type codes of the cells of mixed columns
+CELL_MISSING, CELL_TEXT, CELL_FLOAT, CELL_INT, CELL_BOOL, CELL_DATETIME, \
+    CELL_TIME = range(7)
+
+
+def _encode_cells(values):
+    """Split an object column into a type code per cell and one typed
+    array per type (text and times as unicode, datetimes as datetime64)."""
+    n = len(values)
+    code = numpy.zeros(n, dtype=numpy.int8)
+    text = [''] * n
+    number = numpy.zeros(n, dtype=numpy.float64)
+    integer = numpy.zeros(n, dtype=numpy.int64)
+    when = numpy.full(n, numpy.datetime64('NaT'), dtype='datetime64[us]')
+    for k, v in enumerate(values):
+        if isinstance(v, str):
+            code[k], text[k] = CELL_TEXT, v
+        elif isinstance(v, (bool, numpy.bool_)):
+            code[k], integer[k] = CELL_BOOL, v
+        elif isinstance(v, (int, numpy.integer)):
+            code[k], integer[k] = CELL_INT, v
+        elif isinstance(v, (float, numpy.floating)):
+            if not numpy.isnan(v):
+                code[k], number[k] = CELL_FLOAT, v
+        elif isinstance(v, datetime.datetime):
+            code[k], when[k] = CELL_DATETIME, numpy.datetime64(v, 'us')
+        elif isinstance(v, datetime.time):
+            code[k], text[k] = CELL_TIME, v.isoformat()
+        elif not pandas.isnull(v):
+            raise TypeError('cannot cache cell {!r}'.format(v))
+    return {'k': code, 't': numpy.array(text, dtype=str), 'f': number,
+            'i': integer, 'd': when}
+
+
+def _decode_cells(code, text, number, integer, when):
+    values = numpy.full(code.size, numpy.nan, dtype=object)
+    for k, c in enumerate(code):
+        if c == CELL_TEXT:
+            values[k] = str(text[k])
+        elif c == CELL_FLOAT:
+            values[k] = float(number[k])
+        elif c == CELL_INT:
+            values[k] = int(integer[k])
+        elif c == CELL_BOOL:
+            values[k] = bool(integer[k])
+        elif c == CELL_DATETIME:
+            values[k] = when[k].astype(datetime.datetime)
+        elif c == CELL_TIME:
+            values[k] = datetime.time.fromisoformat(str(text[k]))
+    return values
+
+
+def _label_type(label):
+    if isinstance(label, (bool, numpy.bool_)):
+        raise TypeError('cannot cache column label {!r}'.format(label))
+    if isinstance(label, (int, numpy.integer)):
+        return 'int'
+    if isinstance(label, (float, numpy.floating)):
+        return 'float'
+    if isinstance(label, datetime.datetime):
+        return 'datetime'
+    return 'str'
+
+
+def load_dashboard_cache(cache_fname):
+    """Read a frame written by `save_dashboard_cache`."""
+    parse_label = {
+        'int': int, 'float': float, 'str': str,
+        'datetime': datetime.datetime.fromisoformat}
+    with numpy.load(cache_fname, allow_pickle=False) as npz:
+        meta = json.loads(str(npz['meta']))
+        columns = [
+            parse_label[label](col)
+            for col, label in zip(meta['columns'], meta['labels'])]
+        data = {}
+        for i, kind in enumerate(meta['kinds']):
+            if kind == 'array':
+                values = npz['c{}'.format(i)]
+            elif kind == 'text':
+                values = npz['c{}'.format(i)].astype(object)
+                values[npz['m{}'.format(i)]] = numpy.nan
+            else:
+                values = _decode_cells(*[
+                    npz['{}{}'.format(name, i)] for name in 'ktfid'])
+            data[i] = values
+    df = pandas.DataFrame(data)
+    df.columns = pandas.Index(columns, dtype=meta['columns_dtype'])
+    return df
+
+
+def cached_dashboard(fname, cache_dir=None, use_cache=True, **kwargs):
+    """Return `stream_dashboard(fname, **kwargs)` from the cache when the
+    workbook has been read with the same arguments before.
+
+    Args:
+      fname (str): dashboard workbook
+      cache_dir (str): cache directory (default DEFAULT_CACHE_DIR next to
+        the workbook)
+      use_cache (bool): if False always parse the workbook (the cache is
+        still refreshed)
+      kwargs: passed to `stream_dashboard`
+    """
+    cache_fname = dashboard_cache_fname(fname, cache_dir, **kwargs)
+    if use_cache and os.path.exists(cache_fname):
+        return load_dashboard_cache(cache_fname)
+    df = stream_dashboard(fname, **kwargs)
+    save_dashboard_cache(df, cache_fname)
+    return df
+
+
+def check_dashboard_read(fname, usecols=None, cache_dir=None):
+    """Check that `stream_dashboard`, its cache and `pandas.read_excel`
+    give the same frame for a workbook.
+
+    Raises:
+      AssertionError: if the frames differ
+    """
+    import tempfile
+
+    expected = pandas.read_excel(
+        fname, header=2, skipfooter=3, na_values=NA_VALUES)
+    if usecols is not None:
+        expected = expected.iloc[:, _resolve_usecols(
+            usecols, expected.shape[1])]
+    streamed = stream_dashboard(fname, usecols=usecols)
+    with tempfile.TemporaryDirectory(dir=cache_dir) as tmp_dir:
+        cache_fname = os.path.join(tmp_dir, 'check.npz')
+        save_dashboard_cache(streamed, cache_fname)
+        cached = load_dashboard_cache(cache_fname)
+    pandas.testing.assert_frame_equal(streamed, expected)
+    pandas.testing.assert_frame_equal(cached, expected)
+
+
+def read_dashboards(fnames, usecols=None, method='stream', cache_dir=None,
+                    use_cache=True):
+    """Read one or more dashboard workbooks and stack their rows.
+
+    The workbooks have two title rows above the header and three rows of
+    notes below the data.
+
+    Args:
+      fnames (str or list of str): dashboard workbook(s)
+      usecols (list of slice): sheet columns to keep (see
+        `stream_dashboard`, e.g. `[FEATURE_COLUMNS['percent']]`)
+      method (str): 'stream' reads through `cached_dashboard`, 'pandas'
+        with `pandas.read_excel`
+      cache_dir (str): see `cached_dashboard`
+      use_cache (bool): see `cached_dashboard`
+    """
+    if isinstance(fnames, str):
+        fnames = [fnames]
+    if method == 'stream':
+        dfs = [
+            cached_dashboard(fname, cache_dir=cache_dir, use_cache=use_cache,
+                             usecols=usecols)
+            for fname in fnames]
+    elif method == 'pandas':
+        dfs = []
+        for fname in fnames:
+            df = pandas.read_excel(
+                fname, header=2, skipfooter=3, na_values=NA_VALUES)
+            if usecols is not None:
+                df = df.iloc[:, _resolve_usecols(usecols, df.shape[1])]
+            dfs.append(df)
+    else:
+        raise ValueError('method must be one of {}'.format(READ_METHODS))
+    return pandas.concat(dfs, ignore_index=True)
+
+
+def select_features(df, feature_set='percent',
+                    frac_thresh=DEFAULT_FRAC_THRESH, projected=False):
+    """Return the feature columns to cluster on.
+
+    Args:
+      df (DataFrame): dashboard rows (see `read_dashboards`)
+      feature_set (str): 'percent' for the last four (percent change)
+        columns or 'dense' for all numeric columns with less than
+        `frac_thresh` missing values
+      frac_thresh (float): threshold for the 'dense' feature set
+      projected (bool): `df` was read with
+        `usecols=[FEATURE_COLUMNS[feature_set]]` and holds only the
+        feature columns
+
+    Returns:
+      DataFrame: the feature columns with rows that have missing values
+        dropped
+    """
+    if feature_set not in FEATURE_SETS:
+        raise ValueError('feature_set must be one of {}'.format(FEATURE_SETS))
+    features = df if projected else df.iloc[:, FEATURE_COLUMNS[feature_set]]
+    if feature_set == 'dense':
+        frac_null = features.isnull().sum() / features.shape[0]
+        features = features.loc[:, frac_null < frac_thresh]
+    return features.dropna()
+
+
+def knn_affinity_propagation(X, n_neighbors=DEFAULT_N_NEIGHBORS,
+                             preference=None, damping=0.5, max_iter=200,
+                             convergence_iter=15, random_state=0):
+    """Affinity propagation restricted to a k-nearest-neighbour graph.
+
+    Responsibilities and availabilities are only kept for the edges of the
+    symmetrized kNN graph (plus one self edge per sample that holds the
+    preference), so memory is O(n k) instead of O(n^2).  The updates are
+    the ones of dense affinity propagation with the maximum over all
+    candidate exemplars replaced by a maximum over the neighbours, done
+    with `numpy.maximum.reduceat` over the rows of the edge list and
+    `numpy.bincount` over its columns.  Similarities are negative squared
+    euclidean distances as in `sklearn.cluster.AffinityPropagation`.
+
+    After convergence every sample is assigned to its nearest exemplar
+    (which need not be one of its neighbours) and the exemplars are
+    refined as in sklearn.  Like sklearn a `ConvergenceWarning` is issued
+    if the exemplars are still changing after `max_iter` iterations.
+
+    Each sample only competes with its neighbours for exemplars, so the
+    same preference gives many more (smaller) clusters than dense affinity
+    propagation and, with a preference that is too high for the graph,
+    the exemplars may keep changing until `max_iter`.
+
+    Args:
+      X (array): samples x features
+      n_neighbors (int): neighbours of each sample in the graph
+      preference (float): self similarity (default is the median of the
+        edge similarities).  Lower values give fewer clusters.
+      damping (float): damping factor of the message updates
+      max_iter (int): maximum number of iterations
+      convergence_iter (int): stop once the exemplars have not changed for
+        this many iterations
+      random_state (int): seed of the noise used to break ties
+
+    Returns:
+      tuple: (exemplars, labels, n_iter, converged)
+    """
+    from sklearn.exceptions import ConvergenceWarning
+    from sklearn.neighbors import NearestNeighbors
+
+    X = numpy.asarray(X, dtype=numpy.float64)
+    n_samples = X.shape[0]
+    n_neighbors = min(n_neighbors, n_samples - 1)
+    if n_neighbors < 1:
+        return numpy.arange(n_samples), numpy.arange(n_samples), 0, True
+
+    nn = NearestNeighbors(n_neighbors=n_neighbors+1).fit(X)
+    dist, neighbors = nn.kneighbors(X)
+    rows = numpy.repeat(numpy.arange(n_samples), neighbors.shape[1])
+    cols = neighbors.ravel()
+    sims = -dist.ravel()**2
+    not_self = rows != cols
+    rows, cols, sims = rows[not_self], cols[not_self], sims[not_self]
+
+    # make the graph symmetric and drop duplicate edges
+    keys = numpy.concatenate([rows * n_samples + cols, cols * n_samples + rows])
+    sims = numpy.concatenate([sims, sims])
+    keys, first = numpy.unique(keys, return_index=True)
+    sims = sims[first]
+    if preference is None:
+        preference = numpy.median(sims)
+
+    # add the self edges and order the edges by row
+    self_keys = numpy.arange(n_samples) * (n_samples + 1)
+    keys = numpy.concatenate([keys, self_keys])
+    sims = numpy.concatenate([sims, numpy.full(n_samples, preference)])
+    order = numpy.argsort(keys, kind='stable')
+    keys, S = keys[order], sims[order]
+    rows, cols = numpy.divmod(keys, n_samples)
+    row_starts = numpy.searchsorted(rows, numpy.arange(n_samples))
+    self_idx = numpy.flatnonzero(rows == cols)
+
+    # remove degeneracies like sklearn does
+    rng = numpy.random.RandomState(random_state)
+    finfo = numpy.finfo(numpy.float64)
+    S = S + (finfo.eps * S + finfo.tiny * 100) * rng.standard_normal(S.size)
+
+    R = numpy.zeros_like(S)
+    A = numpy.zeros_like(S)
+    history = numpy.zeros((n_samples, convergence_iter), dtype=bool)
+    converged = False
+    for it in range(max_iter):
+        # responsibilities
+        AS = A + S
+        first_max = numpy.maximum.reduceat(AS, row_starts)
+        candidates = numpy.flatnonzero(AS == first_max[rows])
+        cand_rows = rows[candidates]
+        is_first = numpy.ones(candidates.size, dtype=bool)
+        is_first[1:] = cand_rows[1:] != cand_rows[:-1]
+        max_pos = candidates[is_first]
+        AS[max_pos] = -numpy.inf
+        second_max = numpy.maximum.reduceat(AS, row_starts)
+        R_new = S - first_max[rows]
+        R_new[max_pos] = S[max_pos] - second_max
+        R = damping * R + (1.0 - damping) * R_new
+
+        # availabilities
+        Rp = numpy.maximum(R, 0.0)
+        Rp[self_idx] = R[self_idx]
+        col_sums = numpy.bincount(cols, weights=Rp, minlength=n_samples)
+        A_new = col_sums[cols] - Rp
+        self_avail = A_new[self_idx]
+        numpy.minimum(A_new, 0.0, out=A_new)
+        A_new[self_idx] = self_avail
+        A = damping * A + (1.0 - damping) * A_new
+
+        is_exemplar = (A[self_idx] + R[self_idx]) > 0
+        history[:, it % convergence_iter] = is_exemplar
+        if it >= convergence_iter:
+            n_same = history.sum(axis=1)
+            stable = numpy.all((n_same == 0) | (n_same == convergence_iter))
+            if stable and is_exemplar.any():
+                converged = True
+                break
+    if not converged:
+        warnings.warn(
+            'kNN affinity propagation did not converge in {} iterations, '
+            'try a lower preference or more neighbours'.format(max_iter),
+            ConvergenceWarning)
+
+    exemplars = numpy.flatnonzero(is_exemplar)
+    if exemplars.size == 0:
+        return exemplars, numpy.full(n_samples, -1), it + 1, converged
+    labels = _nearest_exemplar(X, exemplars)
+
+    # like sklearn, move every exemplar to the member with the largest
+    # total similarity to the rest of its cluster.  With squared euclidean
+    # distances that member minimizes m |x_j|^2 - 2 x_j . sum_i x_i, so no
+    # pairwise distances are needed.
+    n_members = numpy.bincount(labels, minlength=exemplars.size)
+    sums = numpy.zeros((exemplars.size, X.shape[1]))
+    numpy.add.at(sums, labels, X)
+    cost = (n_members[labels] * numpy.einsum('ij,ij->i', X, X) -
+            2.0 * numpy.einsum('ij,ij->i', X, sums[labels]))
+    order = numpy.lexsort((cost, labels))
+    exemplars = order[numpy.searchsorted(labels[order], numpy.arange(
+        exemplars.size))]
+    labels = _nearest_exemplar(X, exemplars)
+    return exemplars, labels, it + 1, converged
+
+
+def _nearest_exemplar(X, exemplars):
+    """Return the index into `exemplars` of the nearest exemplar of every
+    row (exemplars are labeled with their own index)."""
+    from sklearn.neighbors import NearestNeighbors
+
+    nearest = NearestNeighbors(n_neighbors=1).fit(X[exemplars])
+    labels = nearest.kneighbors(X, return_distance=False).ravel()
+    labels[exemplars] = numpy.arange(exemplars.size)
+    return labels
+
+
+def cluster_drugs(X, engine=DEFAULT_ENGINE, preference=DEFAULT_PREFERENCE,
+                  n_neighbors=DEFAULT_N_NEIGHBORS,
+                  n_clusters=DEFAULT_N_CLUSTERS, batch_size=1024,
+                  random_state=0, stages=None):
+    """Cluster the rows of a scaled feature matrix.
+
+    Args:
+      X (array): samples x features (see `scale_features`)
+      engine (str): one of CLUSTER_ENGINES (see the module docstring)
+      preference (float): preference of the affinity propagation engines
+      n_neighbors (int): neighbours per sample for 'knn_affinity'
+      n_clusters (int): number of clusters for 'minibatch_kmeans'
+      batch_size (int): mini-batch size for 'minibatch_kmeans'
+      random_state (int): seed of the random number generators
+      stages (list): StageStats of earlier stages to include in the result
+
+    Returns:
+      ClusterResult: labels, centers and per-stage statistics
+    """
+    from sklearn.cluster import AffinityPropagation
+    from sklearn.cluster import MiniBatchKMeans
+
+    if engine not in CLUSTER_ENGINES:
+        raise ValueError('engine must be one of {}'.format(CLUSTER_ENGINES))
+    stages = list(stages) if stages is not None else []
+
+    with timed_stage(stages, 'cluster: {}'.format(engine), rows=X.shape[0]):
+        if engine == 'affinity':
+            af = AffinityPropagation(
+                preference=preference, random_state=random_state).fit(X)
+            exemplars = af.cluster_centers_indices_
+            labels = af.labels_
+            n_iter = af.n_iter_
+            converged = n_iter < af.max_iter
+            centers = X[exemplars]
+        elif engine == 'knn_affinity':
+            exemplars, labels, n_iter, converged = knn_affinity_propagation(
+                X, n_neighbors=n_neighbors, preference=preference,
+                random_state=random_state)
+            centers = X[exemplars]
+        else:
+            km = MiniBatchKMeans(
+                n_clusters=n_clusters, batch_size=batch_size, n_init=3,
+                random_state=random_state).fit(X)
+            exemplars = None
+            labels = km.labels_
+            n_iter = km.n_iter_
+            converged = n_iter < km.max_iter
+            centers = km.cluster_centers_
+
+    return ClusterResult(
+        engine=engine,
+        labels=labels,
+        centers=centers,
+        exemplars=exemplars,
+        n_clusters=len(centers),
+        n_iter=n_iter,
+        converged=converged,
+        stages=stages,
+    )
+
+
+def scale_features(features):
+    """Scale features such that they have zero mean and unit standard
+    deviation."""
+    from sklearn.preprocessing import StandardScaler
+
+    scaler = StandardScaler()
+    return scaler.fit_transform(features)
+
+
+def plot_clusters(X, result):
+    """Plot the first two features colored by cluster with a line from every
+    member to its cluster center."""
+    import matplotlib.pyplot as plt
+
+    plt.close('all')
+    plt.figure(1)
+    plt.clf()
+
+    colors = cycle('bgrcmykbgrcmykbgrcmykbgrcmyk')
+    for k, col in zip(range(result.n_clusters), colors):
+        class_members = result.labels == k
+        cluster_center = result.centers[k]
+        members = X[class_members]
+        plt.plot(members[:, 0], members[:, 1], col + '.')
+        plt.plot(cluster_center[0], cluster_center[1], 'o', markerfacecolor=col,
+                 markeredgecolor='k', markersize=14)
+        # one nan separated polyline instead of one line per member
+        segments = numpy.full((members.shape[0], 3, 2), numpy.nan)
+        segments[:, 0] = cluster_center[:2]
+        segments[:, 1] = members[:, :2]
+        segments = segments.reshape(-1, 2)
+        plt.plot(segments[:, 0], segments[:, 1], col)
+
+    plt.title('Estimated number of clusters: %d' % result.n_clusters)
+    plt.show()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--fname',
+        type=str,
+        nargs='+',
+        default=[DEFAULT_FNAME],
+        help='dashboard workbook(s), rows of several files are stacked')
+    parser.add_argument(
+        '--features',
+        default='percent',
+        choices=FEATURE_SETS,
+        help='columns to cluster on')
+    parser.add_argument(
+        '--engine',
+        default=DEFAULT_ENGINE,
+        choices=CLUSTER_ENGINES,
+        help='clustering engine')
+    parser.add_argument(
+        '--preference',
+        type=float,
+        default=DEFAULT_PREFERENCE,
+        help='preference of the affinity propagation engines')
+    parser.add_argument(
+        '--n-neighbors',
+        type=int,
+        default=DEFAULT_N_NEIGHBORS,
+        help='neighbours per drug for knn_affinity')
+    parser.add_argument(
+        '--n-clusters',
+        type=int,
+        default=DEFAULT_N_CLUSTERS,
+        help='number of clusters for minibatch_kmeans')
+    parser.add_argument(
+        '--read-method',
+        default='stream',
+        choices=READ_METHODS,
+        help='read the workbooks through the cached row stream or pandas')
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='parse the workbooks even if they are cached')
+    parser.add_argument(
+        '--check-read',
+        action='store_true',
+        help='check that the streamed, cached and pandas reads agree')
+    parser.add_argument(
+        '--trace-memory',
+        action='store_true',
+        help='record the peak memory of every stage (slower)')
+    parser.add_argument(
+        '--no-plot',
+        action='store_true',
+        help='only print the stage report')
+    args = parser.parse_args()
+
+    if args.check_read:
+        for fname in args.fname:
+            check_dashboard_read(fname)
+            print('streamed, cached and read_excel frames agree: {}'.format(
+                fname))
+        sys.exit(0)
+
+    if args.trace_memory:
+        tracemalloc.start()
+    stages = []
+    with timed_stage(stages, 'read'):
+        df = read_dashboards(
+            args.fname, usecols=[FEATURE_COLUMNS[args.features]],
+            method=args.read_method, use_cache=not args.no_cache)
+    with timed_stage(stages, 'features'):
+        features = select_features(df, args.features, projected=True)
+    with timed_stage(stages, 'scale'):
+        X = scale_features(features)
+
+    result = cluster_drugs(
+        X, engine=args.engine, preference=args.preference,
+        n_neighbors=args.n_neighbors, n_clusters=args.n_clusters,
+        stages=stages)
+    print('drugs: {}, clusters: {}, iterations: {}, converged: {}'.format(
+        X.shape[0], result.n_clusters, result.n_iter, result.converged))
+    print(stage_report(result.stages))
 
-plt.close('all')
-plt.figure(1)
-plt.clf()
-
-colors = cycle('bgrcmykbgrcmykbgrcmykbgrcmyk')
-for k, col in zip(range(n_clusters_), colors):
-    class_members = labels == k
-    cluster_center = X[cluster_centers_indices[k]]
-    plt.plot(X[class_members, 0], X[class_members, 1], col + '.')
-    plt.plot(cluster_center[0], cluster_center[1], 'o', markerfacecolor=col,
-             markeredgecolor='k', markersize=14)
-    for x in X[class_members]:
-        plt.plot([cluster_center[0], x[0]], [cluster_center[1], x[1]], col)
-
-plt.title('Estimated number of clusters: %d' % n_clusters_)
-plt.show()
+    if not args.no_plot:
+        plot_clusters(X, result)
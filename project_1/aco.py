@@ -0,0 +1,433 @@
+"""
+Medicare Shared Savings Program (MSSP) ACO performance results and their
+join with the geographic variation State/County table.
+
+https://data.cms.gov/ACO/Medicare-Shared-Savings-Program-Accountable-Care-O/ucce-hhpu
+
+The results file has one row per ACO with its financial and quality
+results.  It doesn't say which counties an ACO serves, only the states of
+its service area (e.g. "Alabama, Florida, Georgia"), so by default ACOs are
+joined to the state total rows.  A table of (ACO, State, County) assignments
+(e.g. from the CMS assigned beneficiaries by county files) joins them to
+county rows instead.
+
+ > python aco.py --aco-fname ./data/Medicare_Shared_Savings_Program_Accountable_Care_Organizations_Performance_Year_2014_Results.csv --data-dir ./data
+"""
+
+import re
+import argparse
+from collections import namedtuple
+import numpy
+import pandas
+import us_states
+from geo_var_state_county import CmsGeoVarCountyTable
+from geo_var_state_county import PositionIndex
+from geo_var_state_county import discover_csv_fnames
+from geo_var_state_county import DEFAULT_DATA_DIR
+
+
+DEFAULT_ACO_FNAME = './data/Medicare_Shared_Savings_Program_Accountable_Care_Organizations_Performance_Year_2014_Results.csv'
+ACO_NAME_COL = 'ACO Name'
+SERVICE_AREA_COL = 'ACO Service Area'
+START_DATE_COL = 'Agreement Start Date'
+BENEFICIARIES_COL = 'Total Assigned Beneficiaries'
+BENCHMARK_COL = 'Total Benchmark Expenditures'
+EXPENDITURES_COL = 'Total Expenditures'
+SAVINGS_COL = 'Generated Total Savings/Losses'
+EARNED_COL = 'Earned Shared Savings Payments/Owe Losses'
+TEXT_COLS = [ACO_NAME_COL, SERVICE_AREA_COL, START_DATE_COL]
+
+# other spellings of the columns above in the CMS files
+ACO_COL_ALIASES = {
+    'ACO Name (LBN or DBA, if applicable)': ACO_NAME_COL,
+    'ACO Legal or Name Doing Business As': ACO_NAME_COL,
+    'ACO_Name': ACO_NAME_COL,
+    'Service Area': SERVICE_AREA_COL,
+    'ACO_Serv': SERVICE_AREA_COL,
+    'N_AB': BENEFICIARIES_COL,
+    'ABtotBnchmk': BENCHMARK_COL,
+    'ABtotExp': EXPENDITURES_COL,
+    'Generated Savings/Losses': SAVINGS_COL,
+    'GenSaveLoss': SAVINGS_COL,
+    'EarnSaveLoss': EARNED_COL,
+}
+
+# footnote markers at the end of column names, e.g. "Savings Rate (1,2)"
+FOOTNOTE_REGEX = re.compile(r'\s*\(\d+(\s*,\s*\d+)*\)$')
+# dollar signs, thousands separators and percent signs in numeric columns
+NUMBER_JUNK_REGEX = r'[$,%\s]'
+SERVICE_AREA_SEP = r'\s*[,;]\s*'
+
+AcoJoinResult = namedtuple(
+    'AcoJoinResult',
+    ['aco_values', 'geo_values', 'aco', 'key', 'year', 'share'])
+
+
+def read_aco_csv(fname=DEFAULT_ACO_FNAME):
+    """Read the MSSP ACO performance results into a DataFrame.
+
+    Column names are stripped of footnote markers and the spellings in
+    `ACO_COL_ALIASES` are renamed, so the `*_COL` constants of this module
+    can be used.  Columns other than `TEXT_COLS` whose values are all
+    numbers once dollar signs, thousands separators and percent signs are
+    removed are converted to float ("(1,234)" is read as -1234).
+
+    Args:
+      fname (str): name of the ACO results CSV file
+
+    Returns:
+      DataFrame: one row per ACO
+    """
+    df = pandas.read_csv(fname, dtype=str)
+    df.columns = [
+        ACO_COL_ALIASES.get(name, name)
+        for name in (FOOTNOTE_REGEX.sub('', col.strip()) for col in df.columns)]
+    for col in [ACO_NAME_COL, SERVICE_AREA_COL]:
+        if col not in df.columns:
+            raise ValueError('ACO file has no {!r} column'.format(col))
+
+    for col in df.columns:
+        if col in TEXT_COLS:
+            continue
+        text = df[col].str.strip()
+        negative = text.str.startswith('(') & text.str.endswith(')')
+        text = text.str.strip('()').str.replace(
+            NUMBER_JUNK_REGEX, '', regex=True)
+        numbers = pandas.to_numeric(text, errors='coerce')
+        if numbers.isnull().sum() == (text.isnull() | (text == '')).sum():
+            df[col] = numbers.where(~negative, -numbers).astype('float64')
+    return df
+
+
+def service_area_states(service_areas):
+    """Split service areas into (ACO position, State) pairs.
+
+    Args:
+      service_areas (Series): comma separated state names or
+        abbreviations, one entry per ACO
+
+    Returns:
+      tuple: (positions of the ACOs, state abbreviations) of equal length.
+        Names that aren't states are dropped.
+    """
+    names = service_areas.reset_index(drop=True).str.split(SERVICE_AREA_SEP)
+    names = names.explode().dropna()
+    lookup = {abbr: abbr for abbr in us_states.STATES}
+    lookup.update(
+        {name.upper(): abbr for abbr, name in us_states.STATES.items()})
+    abbrs = names.str.upper().map(lookup)
+    found = abbrs.notnull().values
+    return (
+        names.index.values[found].astype(numpy.int64),
+        abbrs.values[found].astype(str))
+
+
+def grouped_sum(values, groups, n_groups, weights=None):
+    """Return weighted sums of `values` per group with one `bincount`.
+
+    NaN values (and NaN weights) are left out.
+
+    Args:
+      values (array): 1-D or 2-D (rows, columns) values
+      groups (array of int): group of each row in range(n_groups)
+      n_groups (int): number of groups
+      weights (array): weight of each row (default 1)
+
+    Returns:
+      tuple: (sums, sums of weights) with shape (n_groups,) or
+        (n_groups, columns)
+    """
+    values = numpy.asarray(values, dtype=numpy.float64)
+    squeeze = values.ndim == 1
+    values = values.reshape(values.shape[0], -1)
+    n_cols = values.shape[1]
+    if weights is None:
+        weights = numpy.ones(values.shape[0])
+    weights = numpy.broadcast_to(
+        numpy.asarray(weights, dtype=numpy.float64)[:, numpy.newaxis],
+        values.shape)
+
+    # one bincount over (group, column) codes instead of one per column
+    valid = numpy.isfinite(values) & numpy.isfinite(weights)
+    codes = (
+        numpy.asarray(groups, dtype=numpy.int64)[:, numpy.newaxis] * n_cols +
+        numpy.arange(n_cols)).ravel()
+    size = n_groups * n_cols
+    sums = numpy.bincount(
+        codes, weights=numpy.where(valid, values * weights, 0.0).ravel(),
+        minlength=size).reshape(n_groups, n_cols)
+    wsums = numpy.bincount(
+        codes, weights=numpy.where(valid, weights, 0.0).ravel(),
+        minlength=size).reshape(n_groups, n_cols)
+    if squeeze:
+        return sums[:, 0], wsums[:, 0]
+    return sums, wsums
+
+
+def grouped_mean(values, groups, n_groups, weights=None):
+    """Return weighted means of `values` per group (NaN for groups without
+    values).  See `grouped_sum`."""
+    sums, wsums = grouped_sum(values, groups, n_groups, weights=weights)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return numpy.where(wsums > 0, sums / wsums, numpy.nan)
+
+
+class AcoGeoJoin:
+    """Join of ACO results to the rows of one or more State/County tables.
+
+    The join is built once from integer codes,
+
+      - every ACO is its position in `aco_df`
+      - every geographic key (a State, or a (State, County) pair) is its
+        position in `self.keys`
+      - the join is two aligned arrays of codes, `self.pair_aco` and
+        `self.pair_key`, plus the share of each ACO assigned to each key
+      - for every year the row of each key is looked up once with the hash
+        indexes of `CmsGeoVarCountyTable` (`self.key_rows[year]`, -1 for
+        keys missing that year)
+
+    Joining columns is then a gather of the geo rows of the keys followed by
+    a gather by `pair_key`, and grouped aggregates are `bincount`s over the
+    codes.  Adding years only adds one row lookup per key and year.
+    """
+
+
+    def __init__(self, aco_df, tables, assignments=None, share_col=None):
+        """Initialize class with the ACO results and the geo tables.
+
+        Args:
+          aco_df (DataFrame): ACO results, see `read_aco_csv`
+          tables: a `CmsGeoVarCountyTable`, a dict of year -> table or a
+            `CmsGeoVarCountyPanel`
+          assignments (DataFrame): (ACO name, State, County) rows with the
+            columns `ACO_NAME_COL`, 'State' and 'County'.  If given ACOs are
+            joined to county rows, otherwise to the state total rows of
+            their service area.
+          share_col (str): column of `assignments` (e.g. assigned
+            beneficiaries) that splits each ACO between its counties.  By
+            default each ACO is split evenly between its keys.
+        """
+        self.aco_df = aco_df.reset_index(drop=True)
+        self.tables = _year_tables(tables)
+        self.years = sorted(self.tables)
+
+        if assignments is None:
+            self.level = 'state'
+            pair_aco, states = service_area_states(
+                self.aco_df[SERVICE_AREA_COL])
+            key_codes, key_states = pandas.factorize(states, sort=True)
+            self.keys = pandas.DataFrame({'State': key_states})
+            weights = None
+        else:
+            self.level = 'county'
+            names = PositionIndex(
+                self.aco_df[ACO_NAME_COL].str.strip().str.upper().values,
+                numpy.arange(self.aco_df.shape[0]))
+            pair_aco = names.get_indexer(
+                assignments[ACO_NAME_COL].str.strip().str.upper().values)
+            found = pair_aco >= 0
+            pair_aco = pair_aco[found]
+            key_codes, uniques = pandas.MultiIndex.from_arrays([
+                assignments['State'].astype(str).values[found],
+                assignments['County'].astype(str).values[found]]
+            ).factorize(sort=True)
+            self.keys = uniques.to_frame(
+                index=False, name=['State', 'County'])
+            weights = None
+            if share_col is not None:
+                weights = assignments[share_col].to_numpy(
+                    numpy.float64, na_value=numpy.nan)[found]
+
+        self.pair_aco = numpy.asarray(pair_aco, dtype=numpy.int64)
+        self.pair_key = numpy.asarray(key_codes, dtype=numpy.int64)
+        self.share = _aco_shares(
+            self.pair_aco, self.aco_df.shape[0], weights)
+        self.key_rows = {
+            year: self._locate_keys(table)
+            for year, table in self.tables.items()}
+        self._geo_values = {}
+
+
+    @property
+    def n_keys(self):
+        """Number of geographic keys."""
+        return self.keys.shape[0]
+
+
+    def join(self, aco_cols, geo_cols, years=None):
+        """Return aligned ACO and geo values for every (ACO, key, year).
+
+        Args:
+          aco_cols (list of str): columns of the ACO results
+          geo_cols (list of str): columns of the State/County tables
+          years (list of int): years of the geo tables (default all)
+
+        Returns:
+          AcoJoinResult: `aco_values` (pairs, aco columns) and
+            `geo_values` (pairs, geo columns) float64 arrays and per pair
+            the ACO position, the key code, the year and the share of the
+            ACO assigned to the key.  Geo values of keys missing in a year
+            are NaN.
+        """
+        if years is None:
+            years = self.years
+        aco_values = self.aco_df[aco_cols].to_numpy(
+            numpy.float64, na_value=numpy.nan)[self.pair_aco]
+        n_pairs, n_years = self.pair_aco.size, len(years)
+        geo_values = numpy.concatenate([
+            self.key_values(geo_cols, year)[self.pair_key] for year in years]
+        ) if n_years else numpy.empty((0, len(geo_cols)))
+        return AcoJoinResult(
+            aco_values=numpy.tile(aco_values, (n_years, 1)),
+            geo_values=geo_values,
+            aco=numpy.tile(self.pair_aco, n_years),
+            key=numpy.tile(self.pair_key, n_years),
+            year=numpy.repeat(numpy.asarray(years, dtype=numpy.int64), n_pairs),
+            share=numpy.tile(self.share, n_years))
+
+
+    def key_values(self, geo_cols, year):
+        """Return a (keys, columns) float64 array with the geo values of
+        every key in one year (NaN for keys missing that year).  Results
+        are kept so later joins only gather."""
+        cache_key = (year, tuple(geo_cols))
+        if cache_key not in self._geo_values:
+            table = self.tables[year]
+            rows = self.key_rows[year]
+            found = rows >= 0
+            values = numpy.full((self.n_keys, len(geo_cols)), numpy.nan)
+            positions = table.df.columns.get_indexer(geo_cols)
+            if (positions < 0).any():
+                missing = [
+                    col for col, pos in zip(geo_cols, positions) if pos < 0]
+                raise KeyError('columns not in table: {}'.format(missing))
+            values[found] = table.df.iloc[rows[found], positions].to_numpy(
+                numpy.float64, na_value=numpy.nan)
+            values.flags.writeable = False
+            self._geo_values[cache_key] = values
+        return self._geo_values[cache_key]
+
+
+    def key_means(self, aco_cols, weight_col=EXPENDITURES_COL, years=None):
+        """Return weighted means of ACO columns per key (e.g. the
+        cost-weighted savings rate of the ACOs in each state).
+
+        The weight of an ACO for a key is its `weight_col` value times the
+        share of the ACO assigned to the key.
+
+        Args:
+          aco_cols (list of str): columns of the ACO results
+          weight_col (str): ACO column to weight by (None for equal
+            weights)
+          years (list of int): only use keys found in these geo years
+            (default is all keys)
+
+        Returns:
+          DataFrame: one row per key with the means and the summed weight
+        """
+        values = self.aco_df[aco_cols].to_numpy(
+            numpy.float64, na_value=numpy.nan)[self.pair_aco]
+        weights = self.share.copy()
+        if weight_col is not None:
+            weights *= self.aco_df[weight_col].to_numpy(
+                numpy.float64, na_value=numpy.nan)[self.pair_aco]
+        means = grouped_mean(values, self.pair_key, self.n_keys, weights)
+        total = numpy.bincount(
+            self.pair_key, weights=numpy.nan_to_num(weights),
+            minlength=self.n_keys)
+
+        df = pandas.DataFrame(means, columns=aco_cols)
+        df['weight'] = total
+        df.index = pandas.MultiIndex.from_frame(self.keys) \
+            if self.level == 'county' else pandas.Index(
+                self.keys['State'], name='State')
+        if years is not None:
+            found = numpy.zeros(self.n_keys, dtype=bool)
+            for year in years:
+                found |= self.key_rows[year] >= 0
+            df = df[found]
+        return df
+
+
+    def aco_means(self, geo_cols, years=None, weight_col=None):
+        """Return the geo values of each ACO's service area, averaged over
+        its keys.
+
+        Args:
+          geo_cols (list of str): columns of the State/County tables
+          years (list of int): years of the geo tables (default all)
+          weight_col (str): geo column to weight the keys of an ACO by
+            (e.g. 'FFS Beneficiaries'), in addition to the shares
+
+        Returns:
+          DataFrame: one row per (year, ACO name)
+        """
+        if years is None:
+            years = self.years
+        n_acos = self.aco_df.shape[0]
+        frames = []
+        for year in years:
+            values = self.key_values(geo_cols, year)[self.pair_key]
+            weights = self.share
+            if weight_col is not None:
+                weights = weights * self.key_values(
+                    [weight_col], year)[self.pair_key, 0]
+            means = grouped_mean(values, self.pair_aco, n_acos, weights)
+            frames.append(pandas.DataFrame(
+                means, columns=geo_cols, index=self.aco_df[ACO_NAME_COL]))
+        return pandas.concat(frames, keys=years, names=['year'])
+
+
+    def _locate_keys(self, table):
+        """Return the row position of every key in a table."""
+        if self.level == 'state':
+            return table.locate_states(self.keys['State'].values)
+        return table.locate_counties(
+            self.keys['State'].values, self.keys['County'].values)
+
+
+def _year_tables(tables):
+    """Return a dict of year -> `CmsGeoVarCountyTable`."""
+    if isinstance(tables, CmsGeoVarCountyTable):
+        return {0: tables}
+    if isinstance(tables, dict):
+        return dict(tables)
+    return {year: tables.table(year) for year in tables.years}
+
+
+def _aco_shares(pair_aco, n_acos, weights=None):
+    """Return the share of each ACO assigned to each of its pairs (they sum
+    to one per ACO).  Without weights ACOs are split evenly."""
+    if weights is None:
+        weights = numpy.ones(pair_aco.size)
+    weights = numpy.nan_to_num(weights)
+    totals = numpy.bincount(pair_aco, weights=weights, minlength=n_acos)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return numpy.where(
+            totals[pair_aco] > 0, weights / totals[pair_aco], 0.0)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--aco-fname',
+        type=str,
+        default=DEFAULT_ACO_FNAME,
+        help='name of the MSSP ACO results file')
+    parser.add_argument(
+        '--data-dir',
+        type=str,
+        default=DEFAULT_DATA_DIR,
+        help='directory with the yearly State/County CSV files')
+    args = parser.parse_args()
+
+    aco_df = read_aco_csv(args.aco_fname)
+    tables = {
+        year: CmsGeoVarCountyTable(fname, columns='features')
+        for year, fname in discover_csv_fnames(args.data_dir).items()}
+    aco_df['Savings Rate'] = aco_df[SAVINGS_COL] / aco_df[BENCHMARK_COL]
+    join = AcoGeoJoin(aco_df, tables)
+    print('ACOs: {}, states: {}, pairs: {}'.format(
+        aco_df.shape[0], join.n_keys, join.pair_aco.size))
+    print(join.key_means(['Savings Rate', EXPENDITURES_COL]))
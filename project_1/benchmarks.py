@@ -0,0 +1,627 @@
+"""
+Benchmarks for the geographic variation code.
+
+The benchmarks run on synthetic State/County tables (see
+`synthetic_data.py`) so they work offline and at any scale.  Most classes
+are parametrized by `scale`, the multiplier of the number of counties, which
+shows how each operation scales with the size of the table.  To benchmark
+a real file set the `GVCT_BENCH_CSV` environment variable (or use `--fname`).
+
+The classes follow the airspeed velocity (asv) conventions (`params`, a
+`setup` method and methods prefixed with `time_`) so they can be collected
+by asv, but they can also be run directly,
+
+ > python benchmarks.py
+ > python benchmarks.py --scales 1 10 100 --bench TimeLoad
+
+`--check-startup` checks that `cli.py` keeps its heavy imports out of
+`--help` and the data-only subcommands (see `check_startup`) and exits with
+status 1 if it doesn't,
+
+ > python benchmarks.py --check-startup
+"""
+
+import os
+import sys
+import time
+import atexit
+import shutil
+import timeit
+import argparse
+import tempfile
+import subprocess
+
+import numpy
+import pandas
+
+import profiling
+import us_states
+from aco import AcoGeoJoin
+from aco import EXPENDITURES_COL
+from aco import SAVINGS_COL
+from aco import SERVICE_AREA_COL
+from aco import read_aco_csv
+from correlations import numeric_cols
+from correlations import pairwise_corr
+from explore import binned_kde
+from geo_var_state_county import FIPS_COL
+from geo_var_state_county import CmsGeoVarCountyTable
+from geo_var_state_county import CmsGeoVarCountyPanel
+from geo_var_state_county import discover_csv_fnames
+from geo_var_state_county import reconcile_csv_files
+from outliers import fit_outlier_model
+from outliers import mahalanobis_sq
+from pca_on_dense_features import array_chunks
+from pca_on_dense_features import bootstrap_pca
+from pca_on_dense_features import dense_feature_pca
+from synthetic_data import DEFAULT_YEARS
+from synthetic_data import make_aco_table
+from synthetic_data import write_county_tables
+
+
+BENCH_CSV_FNAME = os.environ.get('GVCT_BENCH_CSV')
+BENCH_SCALES = [1, 10]
+BENCH_YEAR = DEFAULT_YEARS[-1]
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# `cli.py --help` may take at most this fraction of the time it takes to
+# import the libraries the scripts used to import at the top
+STARTUP_BUDGET = 0.25
+HEAVY_MODULES = ['pandas', 'matplotlib', 'seaborn', 'sklearn', 'scipy']
+PLOTTING_MODULES = ['matplotlib', 'seaborn', 'sklearn']
+
+_DATA_DIRS = {}
+
+
+def synthetic_data_dir(scale, years=(BENCH_YEAR,)):
+    """Return a temporary directory with synthetic yearly CSV files.
+
+    Files are written once per (scale, years) and removed at exit.
+    """
+    key = (scale, tuple(years))
+    if key not in _DATA_DIRS:
+        data_dir = tempfile.mkdtemp(prefix='gvct_bench_')
+        atexit.register(shutil.rmtree, data_dir, True)
+        write_county_tables(data_dir, years=years, scale=scale)
+        _DATA_DIRS[key] = data_dir
+    return _DATA_DIRS[key]
+
+
+def bench_csv_fname(scale):
+    """Return the CSV file to benchmark (`BENCH_CSV_FNAME` if set)."""
+    if BENCH_CSV_FNAME is not None:
+        return BENCH_CSV_FNAME
+    return discover_csv_fnames(synthetic_data_dir(scale))[BENCH_YEAR]
+
+
+def mask_select_rows(df, level, exclude=None):
+    """Select rows with boolean masks over the whole DataFrame.
+
+    This is how `CmsGeoVarCountyTable.select_rows` worked before the level
+    index was added and serves as the baseline for `TimeSelectRows`.
+    """
+    if exclude is None:
+        exclude = []
+    if level == 'national':
+        return df[df['State']=='National'].iloc[0]
+    elif level == 'state':
+        bmask = df['County'] == 'STATE TOTAL'
+        bmask = bmask & ~(df['State'].isin(exclude))
+        return df[bmask]
+    elif level == 'county':
+        grpd_df = df.groupby('State', observed=True).size()
+        single_row_states = grpd_df[grpd_df==1].index.tolist()
+        single_row_states.remove('National')
+        bmask1 = df['State'].isin(single_row_states)
+        bmask2 = ~bmask1 & (df['County'] != 'STATE TOTAL')
+        bmask3 = df['State'] != 'National'
+        bmask4 = ~(df['County'].isin(exclude))
+        bmask = (bmask1 | bmask2) & bmask3 & bmask4
+        return df[bmask]
+
+
+def merge_aco_states(aco_df, tables, geo_cols):
+    """Join ACOs to the state rows of every year with string key merges
+    and weight the ACO savings by expenditures per (year, State).
+
+    This is the by hand join `AcoGeoJoin` replaces and serves as the
+    baseline for `TimeAcoJoin`.
+    """
+    names = {name: abbr for abbr, name in us_states.STATES.items()}
+    pairs = aco_df[[SERVICE_AREA_COL, SAVINGS_COL, EXPENDITURES_COL]].copy()
+    pairs['State'] = pairs[SERVICE_AREA_COL].str.split(', ')
+    pairs = pairs.explode('State')
+    pairs['State'] = pairs['State'].map(names)
+    frames = []
+    for year, table in tables.items():
+        state_df = table.select_rows('state')[['State'] + geo_cols]
+        state_df = state_df.assign(State=state_df['State'].astype(str))
+        frames.append(pairs.merge(state_df, on='State').assign(year=year))
+    df = pandas.concat(frames)
+    df['weighted'] = df[SAVINGS_COL] * df[EXPENDITURES_COL]
+    sums = df.groupby(['year', 'State'])[['weighted', EXPENDITURES_COL]].sum()
+    return df, sums['weighted'] / sums[EXPENDITURES_COL]
+
+
+def startup_seconds(code, repeat=5):
+    """Return the best wall time of running `python -c code` in the project
+    directory."""
+    times = []
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        subprocess.run(
+            [sys.executable, '-c', code], cwd=PROJECT_DIR, check=True,
+            stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - t1)
+    return min(times)
+
+
+def loaded_modules(code):
+    """Return the top level packages in `HEAVY_MODULES` that are imported
+    after running `code` in a fresh interpreter."""
+    code = '{}\nimport sys\nprint(" ".join(sys.modules))'.format(code)
+    out = subprocess.run(
+        [sys.executable, '-c', code], cwd=PROJECT_DIR, check=True,
+        stdout=subprocess.PIPE, universal_newlines=True).stdout
+    packages = set(name.split('.')[0] for name in out.split())
+    return sorted(packages & set(HEAVY_MODULES))
+
+
+def check_startup(budget=STARTUP_BUDGET):
+    """Check the startup time and the imports of `cli.py`.
+
+    This guards against heavy imports creeping back to the top of the
+    modules used by the command line.  The checks are,
+
+      - importing `cli` and building its parser imports none of
+        `HEAVY_MODULES`
+      - importing the modules behind `convert`, `validate` and `select`
+        imports none of `PLOTTING_MODULES`
+      - `cli.py --help` takes less than `budget` times the time it takes
+        to import pandas, matplotlib, seaborn and sklearn
+
+    Returns:
+      list of str: a description of every failed check (empty if all pass)
+    """
+    failures = []
+    heavy = loaded_modules('import cli; cli.build_parser()')
+    if heavy:
+        failures.append('importing cli loads {}'.format(heavy))
+    plotting = sorted(set(loaded_modules(
+        'import convert_geo_var_state_county_to_csv, geo_var_state_county'))
+        & set(PLOTTING_MODULES))
+    if plotting:
+        failures.append('data-only subcommands load {}'.format(plotting))
+
+    baseline = startup_seconds(
+        'import pandas, matplotlib.pyplot, seaborn, sklearn.decomposition')
+    cli_help = startup_seconds(
+        'import sys, cli; sys.argv = ["cli.py", "--help"]\n'
+        'try:\n    cli.main()\nexcept SystemExit:\n    pass')
+    print('cli.py --help: {:.3f} s, heavy imports: {:.3f} s'.format(
+        cli_help, baseline))
+    if cli_help > budget * baseline:
+        failures.append(
+            'cli.py --help took {:.3f} s, more than {} x {:.3f} s'.format(
+                cli_help, budget, baseline))
+    return failures
+
+
+class TimeStartup:
+    """Startup time of the command line."""
+
+    def setup(self):
+        pass
+
+    def time_cli_help(self):
+        subprocess.run(
+            [sys.executable, 'cli.py', '--help'], cwd=PROJECT_DIR,
+            check=True, stdout=subprocess.DEVNULL)
+
+
+class TimeLoad:
+    """Loading a table from CSV (all columns, feature columns) and from
+    the parse cache."""
+
+    params = BENCH_SCALES
+    param_names = ['scale']
+
+    def setup(self, scale):
+        self.fname = bench_csv_fname(scale)
+        self.cache_dir = tempfile.mkdtemp(prefix='gvct_bench_cache_')
+        CmsGeoVarCountyTable(self.fname, cache_dir=self.cache_dir)
+
+    def teardown(self, scale):
+        shutil.rmtree(self.cache_dir, True)
+
+    def time_load_csv(self, scale):
+        CmsGeoVarCountyTable(self.fname, use_cache=False)
+
+    def time_load_csv_inferred_dtypes(self, scale):
+        CmsGeoVarCountyTable(self.fname, use_cache=False, schema=False)
+
+    def time_load_csv_features(self, scale):
+        CmsGeoVarCountyTable(self.fname, use_cache=False, columns='features')
+
+    def time_load_cached(self, scale):
+        CmsGeoVarCountyTable(self.fname, cache_dir=self.cache_dir)
+
+
+class TimeSelectRows:
+    """Level index slices vs. boolean masks in `select_rows`."""
+
+    params = BENCH_SCALES
+    param_names = ['scale']
+
+    def setup(self, scale):
+        self.gvct = CmsGeoVarCountyTable(
+            bench_csv_fname(scale), use_cache=False)
+
+    def time_national_index(self, scale):
+        self.gvct.select_rows('national')
+
+    def time_national_mask(self, scale):
+        mask_select_rows(self.gvct.df, 'national')
+
+    def time_state_index(self, scale):
+        self.gvct.select_rows('state')
+
+    def time_state_mask(self, scale):
+        mask_select_rows(self.gvct.df, 'state')
+
+    def time_state_exclude_index(self, scale):
+        self.gvct.select_rows('state', exclude=['XX', 'PR', 'VI'])
+
+    def time_state_exclude_mask(self, scale):
+        mask_select_rows(self.gvct.df, 'state', exclude=['XX', 'PR', 'VI'])
+
+    def time_county_index(self, scale):
+        self.gvct.select_rows('county')
+
+    def time_county_mask(self, scale):
+        mask_select_rows(self.gvct.df, 'county')
+
+
+class TimeFeatureCols:
+    """Building the list of feature columns."""
+
+    def setup(self):
+        pass
+
+    def time_return_feature_cols(self):
+        CmsGeoVarCountyTable.return_feature_cols()
+
+
+class TimeFeatureMatrix:
+    """The county feature array from the frame vs. `feature_matrix` (first
+    and memoized call)."""
+
+    params = BENCH_SCALES
+    param_names = ['scale']
+
+    def setup(self, scale):
+        self.gvct = CmsGeoVarCountyTable(
+            bench_csv_fname(scale), use_cache=False)
+        self.feature_cols = self.gvct.return_feature_cols()
+        self.gvct.feature_matrix('county', max_nan_frac=0.1)
+
+    def time_frame_values(self, scale):
+        df = self.gvct.select_rows('county')[self.feature_cols]
+        frac_nan = df.isnull().sum() / df.shape[0]
+        df.loc[:, frac_nan <= 0.1].values.astype('float64')
+
+    def time_feature_matrix(self, scale):
+        self.gvct._feature_matrices.clear()
+        self.gvct.feature_matrix('county', max_nan_frac=0.1)
+
+    def time_feature_matrix_memoized(self, scale):
+        self.gvct.feature_matrix('county', max_nan_frac=0.1)
+
+
+class TimeLookups:
+    """Looking up 1000 counties and FIPS codes one boolean mask at a time
+    vs. the batched `locate_counties` and `locate_fips`."""
+
+    params = BENCH_SCALES
+    param_names = ['scale']
+
+    def setup(self, scale):
+        self.gvct = CmsGeoVarCountyTable(
+            bench_csv_fname(scale), use_cache=False)
+        df = self.gvct.df
+        rng = numpy.random.RandomState(0)
+        sample = rng.randint(0, df.shape[0], 1000)
+        self.states = list(df['State'].astype(str).values[sample])
+        self.counties = list(df['County'].astype(str).values[sample])
+        self.fips = list(df[FIPS_COL].values[sample])
+        self.gvct.locate_counties(self.states[:1], self.counties[:1])
+        self.gvct.locate_fips(self.fips[:1])
+
+    def time_counties_mask(self, scale):
+        df = self.gvct.df
+        for state, county in zip(self.states, self.counties):
+            numpy.flatnonzero(
+                (df['State'] == state) & (df['County'] == county))
+
+    def time_locate_counties(self, scale):
+        self.gvct.locate_counties(self.states, self.counties)
+
+    def time_fips_mask(self, scale):
+        df = self.gvct.df
+        for code in self.fips:
+            numpy.flatnonzero(df[FIPS_COL] == code)
+
+    def time_locate_fips(self, scale):
+        self.gvct.locate_fips(self.fips)
+
+
+class TimeAcoJoin:
+    """Joining ACO results to the state rows of all years with string key
+    merges vs. the integer coded `AcoGeoJoin`."""
+
+    params = BENCH_SCALES
+    param_names = ['scale']
+
+    def setup(self, scale):
+        data_dir = synthetic_data_dir(scale, DEFAULT_YEARS)
+        aco_fname = os.path.join(data_dir, 'aco_results.csv')
+        if not os.path.exists(aco_fname):
+            make_aco_table(seed=0).to_csv(aco_fname, index=False)
+        self.aco_df = read_aco_csv(aco_fname)
+        self.tables = {
+            year: CmsGeoVarCountyTable(fname, use_cache=False)
+            for year, fname in discover_csv_fnames(data_dir).items()}
+        self.geo_cols = ['Average HCC Score', 'Actual Per Capita Costs']
+        self.join = AcoGeoJoin(self.aco_df, self.tables)
+
+    def time_merge_strings(self, scale):
+        merge_aco_states(self.aco_df, self.tables, self.geo_cols)
+
+    def time_build_join(self, scale):
+        AcoGeoJoin(self.aco_df, self.tables)
+
+    def time_join_and_means(self, scale):
+        self.join.join([SAVINGS_COL], self.geo_cols)
+        self.join.key_means([SAVINGS_COL])
+
+
+class TimeProfiling:
+    """Overhead of 1000 empty profiling stages when profiling is off and
+    on.  Off should cost about as much as 1000 function calls."""
+
+    def setup(self):
+        profiling.disable()
+
+    def teardown(self):
+        profiling.disable()
+
+    def time_stages_disabled(self):
+        for _ in range(1000):
+            with profiling.stage('bench'):
+                pass
+
+    def time_stages_enabled(self):
+        profiling.enable()
+        for _ in range(1000):
+            with profiling.stage('bench'):
+                pass
+        profiling.disable()
+
+
+class TimeDensePca:
+    """The impute -> standardize -> PCA pipeline on county rows."""
+
+    params = BENCH_SCALES
+    param_names = ['scale']
+
+    def setup(self, scale):
+        gvct = CmsGeoVarCountyTable(
+            bench_csv_fname(scale), use_cache=False, columns='features')
+        self.feature_cols = gvct.return_feature_cols()
+        self.X = gvct.select_rows('county')[self.feature_cols].values
+
+    def time_dense_pca_incremental(self, scale):
+        dense_feature_pca(
+            array_chunks(self.X), self.feature_cols, method='incremental')
+
+    def time_dense_pca_full(self, scale):
+        dense_feature_pca(
+            array_chunks(self.X), self.feature_cols, method='full')
+
+
+class TimeBootstrapPca:
+    """Bootstrap refits of the dense PCA with one process and with all
+    cores (the speedup should be close to the number of cores)."""
+
+    params = BENCH_SCALES
+    param_names = ['scale']
+
+    def setup(self, scale):
+        gvct = CmsGeoVarCountyTable(
+            bench_csv_fname(scale), use_cache=False, columns='features')
+        self.feature_cols = gvct.return_feature_cols()
+        self.chunks = array_chunks(
+            gvct.select_rows('county')[self.feature_cols].values)
+        self.result = dense_feature_pca(
+            self.chunks, self.feature_cols, method='full')
+
+    def time_bootstrap_one_worker(self, scale):
+        bootstrap_pca(self.result, self.chunks, self.feature_cols,
+                      n_boot=50, max_workers=1)
+
+    def time_bootstrap_all_workers(self, scale):
+        bootstrap_pca(self.result, self.chunks, self.feature_cols,
+                      n_boot=50, max_workers=os.cpu_count())
+
+
+class TimeOutliers:
+    """Fitting the Gaussian outlier model and scoring county rows in
+    blocks against its Cholesky factor."""
+
+    params = BENCH_SCALES
+    param_names = ['scale']
+
+    def setup(self, scale):
+        gvct = CmsGeoVarCountyTable(
+            bench_csv_fname(scale), use_cache=False, columns='features')
+        self.feature_cols = gvct.return_feature_cols()
+        self.X = gvct.select_rows('county')[self.feature_cols].values
+        self.model = fit_outlier_model(
+            array_chunks(self.X), self.feature_cols)
+        self.X_model = numpy.ascontiguousarray(
+            gvct.select_rows('county')[self.model.feature_cols].values)
+
+    def time_fit_outlier_model(self, scale):
+        fit_outlier_model(array_chunks(self.X), self.feature_cols)
+
+    def time_mahalanobis_sq(self, scale):
+        mahalanobis_sq(self.model, self.X_model)
+
+
+class TimeDensity:
+    """KDE of one pair of county columns on a grid: scipy's gaussian_kde
+    evaluated at every grid point (what the exact pair plot does) against
+    the binned FFT KDE of the fast mode."""
+
+    params = BENCH_SCALES
+    param_names = ['scale']
+    gridsize = 128
+
+    def setup(self, scale):
+        gvct = CmsGeoVarCountyTable(bench_csv_fname(scale), use_cache=False)
+        df = gvct.select_rows('county')[
+            ['Average HCC Score', 'Standardized Per Capita Costs']].dropna()
+        self.x = df.values[:, 0].astype(float)
+        self.y = df.values[:, 1].astype(float)
+
+    def time_gaussian_kde_grid(self, scale):
+        from scipy.stats import gaussian_kde
+        xgrid, ygrid, _ = binned_kde(self.x, self.y, gridsize=self.gridsize)
+        xx, yy = numpy.meshgrid(xgrid, ygrid, indexing='ij')
+        gaussian_kde(numpy.vstack([self.x, self.y]))(
+            numpy.vstack([xx.ravel(), yy.ravel()]))
+
+    def time_binned_kde(self, scale):
+        binned_kde(self.x, self.y, gridsize=self.gridsize)
+
+
+class TimeCorrelations:
+    """Pairwise complete correlations of all numeric columns of the county
+    rows: pandas (one pass per pair) against the masked matrix products."""
+
+    params = BENCH_SCALES
+    param_names = ['scale']
+
+    def setup(self, scale):
+        gvct = CmsGeoVarCountyTable(bench_csv_fname(scale), use_cache=False)
+        self.columns = numeric_cols(gvct.df)
+        self.df = gvct.select_rows('county')[self.columns].astype(
+            numpy.float64)
+        self.X = self.df.values
+
+    def time_pandas_corr(self, scale):
+        self.df.corr(min_periods=10)
+
+    def time_pairwise_corr(self, scale):
+        pairwise_corr(array_chunks(self.X), self.columns)
+
+    def time_pairwise_corr_blocked(self, scale):
+        pairwise_corr(array_chunks(self.X), self.columns, block_cols=64)
+
+
+class TimePanel:
+    """Multi-year loading and reconciliation over all years."""
+
+    params = BENCH_SCALES
+    param_names = ['scale']
+
+    def setup(self, scale):
+        self.data_dir = synthetic_data_dir(scale, DEFAULT_YEARS)
+
+    def time_panel_feature_frame(self, scale):
+        panel = CmsGeoVarCountyPanel(self.data_dir)
+        panel.frame(CmsGeoVarCountyTable.return_feature_cols())
+
+    def time_reconcile_csv_files(self, scale):
+        reconcile_csv_files(discover_csv_fnames(self.data_dir))
+
+
+BENCHMARKS = [TimeLoad, TimeSelectRows, TimeFeatureCols, TimeFeatureMatrix,
+              TimeLookups, TimeAcoJoin, TimeProfiling, TimeDensePca,
+              TimeBootstrapPca, TimeOutliers, TimeDensity, TimeCorrelations,
+              TimePanel, TimeStartup]
+
+
+def run_benchmarks(classes, scales=None, repeat=3):
+    """Run the `time_` methods of each class and print the best time.
+
+    The number of calls per timing is chosen with `Timer.autorange`.  If
+    `scales` is given it replaces the `params` of classes parametrized by
+    scale.
+
+    Returns:
+      list of tuple: (class name, method name, param, best seconds per call)
+    """
+    results = []
+    for cls in classes:
+        params = getattr(cls, 'params', [None])
+        if scales is not None and getattr(cls, 'param_names', []) == ['scale']:
+            params = scales
+        for param in params:
+            args = () if param is None else (param,)
+            bench = cls()
+            bench.setup(*args)
+            names = sorted(
+                name for name in dir(bench) if name.startswith('time_'))
+            for name in names:
+                method = getattr(bench, name)
+                timer = timeit.Timer(lambda: method(*args))
+                number, _ = timer.autorange()
+                best = min(timer.repeat(repeat=repeat, number=number)) / number
+                results.append((cls.__name__, name, param, best))
+                print('{:<16} {:<32} {:>8} {:>14.3f} ms'.format(
+                    cls.__name__, name, str(param), best * 1.0e3))
+            if hasattr(bench, 'teardown'):
+                bench.teardown(*args)
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--fname',
+        type=str,
+        default=BENCH_CSV_FNAME,
+        help='benchmark this file instead of synthetic single year tables')
+    parser.add_argument(
+        '--scales',
+        type=float,
+        nargs='+',
+        default=None,
+        help='scales of the synthetic tables (default {})'.format(
+            BENCH_SCALES))
+    parser.add_argument(
+        '--bench',
+        type=str,
+        nargs='+',
+        default=None,
+        choices=[cls.__name__ for cls in BENCHMARKS],
+        help='benchmark classes to run (default all)')
+    parser.add_argument(
+        '--check-startup',
+        action='store_true',
+        help='only check the startup time and imports of cli.py')
+    args = parser.parse_args()
+
+    if args.check_startup:
+        failures = check_startup()
+        for failure in failures:
+            print('FAILED: {}'.format(failure))
+        sys.exit(1 if failures else 0)
+
+    BENCH_CSV_FNAME = args.fname
+    classes = BENCHMARKS
+    if args.bench is not None:
+        classes = [cls for cls in BENCHMARKS if cls.__name__ in args.bench]
+    run_benchmarks(classes, scales=args.scales)
@@ -0,0 +1,400 @@
+"""
+One command line entry point for the geographic variation and drug spending
+scripts.
+
+ > python cli.py --help
+ > python cli.py convert ./data/County_All_Table.xlsx --parallel
+ > python cli.py validate --data-dir ./data
+ > python cli.py select --level state --columns "Average HCC Score"
+ > python cli.py pca --all-years ./data
+ > python cli.py pairplot --level county --density binned
+ > python cli.py cluster --engine minibatch_kmeans
+ > python cli.py serve --data-dir ./data --years 2014
+ > python cli.py --profile --profile-jsonl stages.jsonl pca --no-plot
+
+Only the standard library is imported at the top of this module.  Each
+subcommand imports what it needs when it runs, so `--help` doesn't load
+pandas and `convert`, `validate` and `select` never load matplotlib,
+seaborn or sklearn (see `check_startup` in `benchmarks.py`).
+
+With `--profile` the stages of the pipelines (see `profiling.py`) are
+recorded and a summary table is printed to stderr when the command ends.
+"""
+
+import os
+import sys
+import argparse
+
+import profiling
+
+
+DEFAULT_CSV_FNAME = './data/County_All_Table_2014.csv'
+VALID_LEVELS = ['national', 'state', 'county']
+MEDICARE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'medicare_drug_spending')
+
+
+def cmd_convert(args):
+    """Convert the sheets of the Excel workbook to CSV files."""
+    from convert_geo_var_state_county_to_csv import convert_xlsx_parallel
+    from convert_geo_var_state_county_to_csv import convert_xlsx_to_csv
+
+    if args.parallel:
+        convert_xlsx_parallel(
+            args.excel_fname, fmt=args.format, max_workers=args.workers)
+    else:
+        convert_xlsx_to_csv(args.excel_fname)
+    return 0
+
+
+def cmd_validate(args):
+    """Check that totals add up through the State/County hierarchy.
+
+    Returns 1 if any total is outside the tolerance.
+    """
+    from geo_var_state_county import discover_csv_fnames
+    from geo_var_state_county import reconcile_csv_files
+
+    if args.data_dir is not None:
+        csv_fnames = discover_csv_fnames(args.data_dir)
+    else:
+        csv_fnames = {0: args.fname}
+    recon = reconcile_csv_files(
+        csv_fnames, rtol=args.rtol, atol=args.atol, only_failures=False)
+    print(recon.groupby('check')['ok'].agg(['size', 'sum']))
+    failures = recon[~recon['ok']]
+    if len(failures) > 0:
+        print()
+        print('totals outside tolerance:')
+        print(failures.sort_values('rel_diff', ascending=False))
+        return 1
+    return 0
+
+
+def cmd_select(args):
+    """Select the rows of one level and write them as CSV."""
+    from geo_var_state_county import CmsGeoVarCountyTable
+
+    gvct = CmsGeoVarCountyTable(args.fname, columns=args.columns)
+    df = gvct.select_rows(args.level, exclude=args.exclude)
+    if args.level == 'national':
+        df = df.to_frame().T
+    df.to_csv(args.output if args.output is not None else sys.stdout)
+    return 0
+
+
+def cmd_pca(args):
+    """PCA on the dense feature columns."""
+    from geo_var_state_county import CmsGeoVarCountyTable
+    from geo_var_state_county import discover_csv_fnames
+    from pca_on_dense_features import array_chunks
+    from pca_on_dense_features import csv_feature_chunks
+    from pca_on_dense_features import dense_feature_pca
+
+    if args.all_years is not None:
+        feature_cols = CmsGeoVarCountyTable.return_feature_cols()
+        chunks = csv_feature_chunks(
+            discover_csv_fnames(args.all_years), feature_cols)
+    else:
+        gvct = CmsGeoVarCountyTable(args.fname, columns='features')
+        fm = gvct.feature_matrix('county')
+        feature_cols = fm.columns
+        chunks = array_chunks(fm.values)
+
+    result = dense_feature_pca(chunks, feature_cols, method=args.method)
+    print('dense columns: {}'.format(len(result.feature_cols)))
+    print('sparse columns: {}'.format(len(result.sparse_cols)))
+    if not args.no_plot:
+        from pca_on_dense_features import plot_components_2d
+        from pca_on_dense_features import plot_explained_variance
+        from pca_on_dense_features import transform_chunks
+        plot_explained_variance(result)
+        plot_components_2d(transform_chunks(result, chunks, feature_cols))
+    return 0
+
+
+def cmd_pairplot(args):
+    """Pair plot of a few columns for one level."""
+    from explore import make_pair_plot
+
+    make_pair_plot(fname=args.fname, level=args.level, density=args.density)
+    return 0
+
+
+def cmd_cluster(args):
+    """Cluster the drugs in the Medicare Drug Spending workbook(s)."""
+    if MEDICARE_DIR not in sys.path:
+        sys.path.append(MEDICARE_DIR)
+    import medicare_drug_spending as mds
+
+    # timed_stage hands the stages to profiling.stage when profiling is on
+    stages = []
+    with mds.timed_stage(stages, 'cluster: read') as st:
+        df = mds.read_dashboards(
+            args.fname or [mds.DEFAULT_FNAME],
+            usecols=[mds.FEATURE_COLUMNS[args.features]],
+            method=args.read_method, use_cache=not args.no_cache)
+        st.add_rows(df.shape[0])
+    with mds.timed_stage(stages, 'cluster: features', rows=df.shape[0]):
+        features = mds.select_features(df, args.features, projected=True)
+    with mds.timed_stage(stages, 'cluster: scale', rows=df.shape[0]):
+        X = mds.scale_features(features)
+    result = mds.cluster_drugs(
+        X, engine=args.engine, preference=args.preference,
+        n_neighbors=args.n_neighbors, n_clusters=args.n_clusters,
+        stages=stages)
+    print('drugs: {}, clusters: {}, iterations: {}, converged: {}'.format(
+        X.shape[0], result.n_clusters, result.n_iter, result.converged))
+    print(mds.stage_report(result.stages))
+    if not args.no_plot:
+        mds.plot_clusters(X, result)
+    return 0
+
+
+def cmd_serve(args):
+    """Keep the yearly tables loaded and answer queries on localhost."""
+    from table_server import serve
+
+    serve(args.data_dir, years=args.years, port=args.port,
+          cache_mb=args.cache_mb, verbose=args.verbose)
+    return 0
+
+
+def build_parser():
+    """Return the argument parser with one sub-parser per subcommand.
+
+    Choices that live in the analysis modules are repeated here so building
+    the parser doesn't import them.
+    """
+    parser = argparse.ArgumentParser(
+        description='geographic variation and drug spending tools')
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='record the pipeline stages and print a summary to stderr')
+    parser.add_argument(
+        '--profile-jsonl',
+        type=str,
+        default=None,
+        help='also append every stage to this JSON lines file')
+    parser.add_argument(
+        '--trace-memory',
+        action='store_true',
+        help='record the peak memory of every stage (slower)')
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    subparsers.required = True
+
+    sub = subparsers.add_parser('convert', help=cmd_convert.__doc__)
+    sub.add_argument(
+        'excel_fname',
+        type=str,
+        help='name of geographical variation state/county Excel file')
+    sub.add_argument(
+        '--parallel',
+        action='store_true',
+        help='parse the workbook once and write sheets in a process pool')
+    sub.add_argument(
+        '--format',
+        default='parquet',
+        choices=['parquet', 'feather'],
+        help='columnar format written next to the CSVs in parallel mode')
+    sub.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help='number of worker processes in parallel mode')
+    sub.set_defaults(func=cmd_convert)
+
+    sub = subparsers.add_parser(
+        'validate', help=cmd_validate.__doc__.splitlines()[0])
+    sub.add_argument(
+        '--fname',
+        type=str,
+        default=DEFAULT_CSV_FNAME,
+        help='name of geographical variation state/county file')
+    sub.add_argument(
+        '--data-dir',
+        type=str,
+        default=None,
+        help='check all yearly files in this directory instead')
+    sub.add_argument(
+        '--rtol',
+        type=float,
+        default=1.0e-6,
+        help='relative tolerance')
+    sub.add_argument(
+        '--atol',
+        type=float,
+        default=0.5,
+        help='absolute tolerance')
+    sub.set_defaults(func=cmd_validate)
+
+    sub = subparsers.add_parser('select', help=cmd_select.__doc__)
+    sub.add_argument(
+        '--fname',
+        type=str,
+        default=DEFAULT_CSV_FNAME,
+        help='name of geographical variation state/county file')
+    sub.add_argument(
+        '--level',
+        default='state',
+        choices=VALID_LEVELS,
+        help='rows to select from data')
+    sub.add_argument(
+        '--columns',
+        type=str,
+        nargs='+',
+        default=None,
+        help='columns to keep besides State and County (default all)')
+    sub.add_argument(
+        '--exclude',
+        type=str,
+        nargs='+',
+        default=None,
+        help='states (or counties) to leave out')
+    sub.add_argument(
+        '--output',
+        type=str,
+        default=None,
+        help='CSV file to write (default stdout)')
+    sub.set_defaults(func=cmd_select)
+
+    sub = subparsers.add_parser('pca', help=cmd_pca.__doc__)
+    sub.add_argument(
+        '--fname',
+        type=str,
+        default=DEFAULT_CSV_FNAME,
+        help='name of geographical variation state/county file')
+    sub.add_argument(
+        '--all-years',
+        type=str,
+        default=None,
+        metavar='DATA_DIR',
+        help='use the counties of all yearly files in DATA_DIR')
+    sub.add_argument(
+        '--method',
+        default='incremental',
+        choices=['incremental', 'randomized', 'full'],
+        help='how to fit the PCA')
+    sub.add_argument(
+        '--no-plot',
+        action='store_true',
+        help='only print the summary')
+    sub.set_defaults(func=cmd_pca)
+
+    sub = subparsers.add_parser('pairplot', help=cmd_pairplot.__doc__)
+    sub.add_argument(
+        '--fname',
+        type=str,
+        default=DEFAULT_CSV_FNAME,
+        help='name of geographical variation state/county file')
+    sub.add_argument(
+        '--level',
+        default='state',
+        choices=['state', 'county'],
+        help='rows to select from data')
+    sub.add_argument(
+        '--density',
+        default='exact',
+        choices=['exact', 'binned'],
+        help="'binned' draws a hexbin and FFT KDE contours (fast for "
+             "counties)")
+    sub.set_defaults(func=cmd_pairplot)
+
+    sub = subparsers.add_parser('cluster', help=cmd_cluster.__doc__)
+    sub.add_argument(
+        '--fname',
+        type=str,
+        nargs='+',
+        default=None,
+        help='dashboard workbook(s), rows of several files are stacked')
+    sub.add_argument(
+        '--features',
+        default='percent',
+        choices=['percent', 'dense'],
+        help='columns to cluster on')
+    sub.add_argument(
+        '--engine',
+        default='affinity',
+        choices=['affinity', 'knn_affinity', 'minibatch_kmeans'],
+        help='clustering engine')
+    sub.add_argument(
+        '--preference',
+        type=float,
+        default=-50,
+        help='preference of the affinity propagation engines')
+    sub.add_argument(
+        '--n-neighbors',
+        type=int,
+        default=30,
+        help='neighbours per drug for knn_affinity')
+    sub.add_argument(
+        '--n-clusters',
+        type=int,
+        default=8,
+        help='number of clusters for minibatch_kmeans')
+    sub.add_argument(
+        '--read-method',
+        default='stream',
+        choices=['stream', 'pandas'],
+        help='read the workbooks through the cached row stream or pandas')
+    sub.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='parse the workbooks even if they are cached')
+    sub.add_argument(
+        '--no-plot',
+        action='store_true',
+        help='only print the stage report')
+    sub.set_defaults(func=cmd_cluster)
+
+    sub = subparsers.add_parser('serve', help=cmd_serve.__doc__)
+    sub.add_argument(
+        '--data-dir',
+        type=str,
+        default='./data',
+        help='directory with the yearly CSV files')
+    sub.add_argument(
+        '--years',
+        type=int,
+        nargs='+',
+        default=None,
+        help='years to load (default all)')
+    sub.add_argument(
+        '--port',
+        type=int,
+        default=8642,
+        help='port to listen on (on 127.0.0.1)')
+    sub.add_argument(
+        '--cache-mb',
+        type=float,
+        default=256,
+        help='size of the response cache [MB]')
+    sub.add_argument(
+        '--verbose',
+        action='store_true',
+        help='log every request')
+    sub.set_defaults(func=cmd_serve)
+
+    return parser
+
+
+def main(argv=None):
+    """Parse the command line and run a subcommand (returns the exit
+    status)."""
+    args = build_parser().parse_args(argv)
+    if not (args.profile or args.profile_jsonl or args.trace_memory):
+        return args.func(args)
+
+    profiling.enable(
+        jsonl_fname=args.profile_jsonl, trace_memory=args.trace_memory)
+    try:
+        return args.func(args)
+    finally:
+        records = profiling.disable()
+        if records:
+            print(profiling.summary(records).to_string(), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
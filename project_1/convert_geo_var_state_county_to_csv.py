@@ -1,8 +1,29 @@
 import os
-import sys
+import re
 import time
+import hashlib
+import zipfile
+import argparse
+from xml.etree import ElementTree
+from concurrent.futures import ProcessPoolExecutor
 import pandas
 
+import profiling
+from manifest import file_sha256
+from manifest import read_manifest
+from manifest import write_manifest
+
+
+NA_VALUES = ['.', '*']
+COLUMNAR_FORMATS = ['parquet', 'feather']
+XLSX_MAIN_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+XLSX_REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+# a cell holding an index into the shared strings, e.g.
+# <c r="A3" s="1" t="s"><v>12</v></c>
+SHARED_CELL_RE = re.compile(rb'<c\b[^>]*\bt="s"[^>]*>\s*<v>(\d+)</v>')
+SHARED_STRING_RE = re.compile(rb'<si(?:\s*/>|>(.*?)</si>)', re.DOTALL)
+
+
 def convert_xlsx_to_csv(excel_fname):
     """Convert sheets in Excel file to CSVs for faster I/O"""
 
@@ -27,23 +48,291 @@ def convert_xlsx_to_csv(excel_fname):
                 continue
             print('reading file: {}, sheet: {}'.format(excel_fname, sheetname))
             t1 = time.time()
-            df = pandas.read_excel(
-                excel_fname, sheetname=sheetname, header=1, engine='xlrd',
-                na_values=['.', '*'])
+            with profiling.stage('excel read') as st:
+                df = pandas.read_excel(
+                    excel_fname, sheetname=sheetname, header=1, engine='xlrd',
+                    na_values=NA_VALUES)
+                st.add_rows(df.shape[0])
             t2 = time.time()
             print('I/O took {} seconds'.format(t2-t1))
             print('writing to {}'.format(csv_fname))
-            df.to_csv(csv_fname)
+            with profiling.stage('csv write', rows=df.shape[0]):
+                df.to_csv(csv_fname)
 
 
-if __name__ == '__main__':
+def convert_xlsx_parallel(excel_fname, fmt='parquet', max_workers=None):
+    """Convert sheets in Excel file to CSVs and typed columnar files.
+
+    Every sheet is converted by its own task in a process pool: the worker
+    opens the workbook, parses its sheet and writes the output files
+    itself (see `_convert_sheet`), so the sheets are parsed in parallel
+    and no frame is sent between processes.  Next to every CSV a Parquet
+    or Feather file is written in which the '.' and '*' markers are stored
+    as nulls.
+
+    A manifest (`<fbase>_manifest.json`) records the SHA-256 hash of the
+    workbook each sheet was converted from and a fingerprint of the sheet
+    itself (see `sheet_fingerprints`).  A sheet is skipped if its output
+    files still exist and either the workbook hash or the sheet fingerprint
+    is unchanged, so when a new year is added to the workbook only the new
+    (and any changed) sheets are converted.
 
-    USAGE = """
-     > python convert_geo_var_state_county_to_csv.py ./data/County_All_Table.xlsx
+    Args:
+      excel_fname (str): path to the Excel workbook
+      fmt (str): columnar format, one of ['parquet', 'feather']
+      max_workers (int): size of the process pool (default is the
+        number of CPUs)
+
+    Returns:
+      dict: the manifest that was written
     """
+    if fmt not in COLUMNAR_FORMATS:
+        raise ValueError('fmt must be one of {}'.format(COLUMNAR_FORMATS))
+
+    print()
+    print('converting Excel file to CSVs and {} files ...'.format(fmt))
+    print('excel file: {}'.format(excel_fname))
+    dirname = os.path.dirname(excel_fname)
+    basename = os.path.basename(excel_fname)
+    fbase, ext = basename.split('.')
+    out_base = os.path.join(dirname, fbase)
+    manifest_fname = '{}_manifest.json'.format(out_base)
+
+    t1 = time.time()
+    source_sha256 = file_sha256(excel_fname)
+    t2 = time.time()
+    print('sha256: {} (took {} seconds)'.format(source_sha256, t2-t1))
+
+    manifest = read_manifest(manifest_fname)
+    if (manifest.get('source_sha256') == source_sha256 and
+            manifest.get('sheets') and
+            all(_is_up_to_date(entry, entry, dirname)
+                for entry in manifest['sheets'].values())):
+        print('all sheets are up to date')
+        return manifest
+    manifest['source'] = basename
+    manifest['source_sha256'] = source_sha256
+    sheets = manifest.setdefault('sheets', {})
+    fingerprints = sheet_fingerprints(excel_fname)
+
+    print('reading sheetnames ...')
+    t1 = time.time()
+    with profiling.stage('excel open'):
+        with pandas.ExcelFile(excel_fname) as excel_file:
+            sheetnames = [
+                sn for sn in excel_file.sheet_names if sn != 'Documentation']
+    print('sheetnames: {}'.format(sheetnames))
+
+    futures = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for sheetname in sheetnames:
+            year = sheetname.split(' ')[-1]
+            entry = {
+                'year': year,
+                'csv': '{}_{}.csv'.format(fbase, year),
+                'columnar': '{}_{}.{}'.format(fbase, year, fmt),
+                'format': fmt,
+                'source_sha256': source_sha256,
+                'fingerprint': fingerprints.get(sheetname),
+            }
+            if _is_up_to_date(sheets.get(sheetname), entry, dirname):
+                print('sheet {} is up to date'.format(sheetname))
+                sheets[sheetname]['source_sha256'] = source_sha256
+                continue
+            print('converting sheet: {}'.format(sheetname))
+            future = executor.submit(
+                _convert_sheet, excel_fname, sheetname,
+                os.path.join(dirname, entry['csv']),
+                os.path.join(dirname, entry['columnar']),
+                fmt)
+            futures[future] = (sheetname, entry)
+
+        for future, (sheetname, entry) in futures.items():
+            rows, io_time = future.result()
+            print('converted sheet {} in {} seconds'.format(
+                sheetname, io_time))
+            entry['rows'] = rows
+            sheets[sheetname] = entry
+            write_manifest(manifest_fname, manifest)
+
+    write_manifest(manifest_fname, manifest)
+    t2 = time.time()
+    print('conversion took {} seconds'.format(t2-t1))
+    return manifest
+
+
+def _is_up_to_date(old_entry, new_entry, dirname):
+    """Return True if a manifest entry matches and its outputs exist.
+
+    The entries match if they have the same outputs and either the same
+    workbook hash or the same sheet fingerprint.
+    """
+    if old_entry is None:
+        return False
+    for key in ['format', 'csv', 'columnar']:
+        if old_entry.get(key) != new_entry[key]:
+            return False
+    same_source = old_entry.get('source_sha256') == new_entry['source_sha256']
+    same_sheet = (
+        new_entry.get('fingerprint') is not None and
+        old_entry.get('fingerprint') == new_entry['fingerprint'])
+    if not (same_source or same_sheet):
+        return False
+    return (
+        os.path.isfile(os.path.join(dirname, new_entry['csv'])) and
+        os.path.isfile(os.path.join(dirname, new_entry['columnar'])))
+
+
+def _convert_sheet(excel_fname, sheetname, csv_fname, columnar_fname, fmt):
+    """Parse one sheet and write it to CSV and to a columnar file (worker
+    process).
+
+    Profiling stages of the worker are only kept in the JSON lines file of
+    the profiler it inherited, if any (its in memory records are lost when
+    it exits).
+
+    Returns:
+      tuple: (number of rows, seconds taken)
+    """
+    t1 = time.time()
+    with profiling.stage('excel read') as st:
+        df = pandas.read_excel(
+            excel_fname, sheet_name=sheetname, header=1,
+            na_values=NA_VALUES)
+        st.add_rows(df.shape[0])
+    with profiling.stage('csv write', rows=df.shape[0]):
+        df.to_csv(csv_fname)
+    with profiling.stage('{} write'.format(fmt), rows=df.shape[0]):
+        typed_df = coerce_column_types(df)
+        if fmt == 'parquet':
+            typed_df.to_parquet(columnar_fname)
+        elif fmt == 'feather':
+            typed_df.reset_index(drop=True).to_feather(columnar_fname)
+    t2 = time.time()
+    return int(df.shape[0]), t2-t1
+
+
+def coerce_column_types(df):
+    """Return a copy of `df` with a single type per column.
+
+    Excel columns can mix numbers and text.  Object columns whose non-null
+    values are all numbers become float columns and all others become
+    string columns.  Missing values stay missing in both cases (text is not
+    parsed, so codes with leading zeros such as FIPS codes are preserved).
+    """
+    df = df.copy()
+    for col in df.columns[df.dtypes == object]:
+        ser = df[col]
+        values = ser[ser.notnull()]
+        is_number = values.map(
+            lambda x: isinstance(x, (int, float)) and not isinstance(x, bool))
+        if is_number.all():
+            df[col] = ser.astype(float)
+        else:
+            df[col] = ser.where(ser.isnull(), ser.astype(str))
+    return df
+
+
+def sheet_fingerprints(excel_fname):
+    """Return a fingerprint of every sheet in an xlsx workbook.
+
+    An xlsx file is a zip archive with one XML part per worksheet.  The zip
+    directory stores the CRC-32 and size of every part, which covers the
+    numbers in a sheet.  Text cells only hold an index into a part shared
+    by all sheets, so the text of the shared strings a sheet refers to is
+    hashed as well (see `_shared_string_refs`).  New strings are appended
+    to the shared part, so adding a sheet leaves the fingerprints of the
+    other sheets unchanged.
+
+    Returns:
+      dict: sheet name -> '<crc32>-<size>-<sha256 of its strings>' (empty
+        if the file is not an xlsx workbook)
+    """
+    try:
+        archive = zipfile.ZipFile(excel_fname)
+    except zipfile.BadZipFile:
+        return {}
+    with archive:
+        infos = {info.filename: info for info in archive.infolist()}
+        workbook = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+        rels = ElementTree.fromstring(
+            archive.read('xl/_rels/workbook.xml.rels'))
+        targets = {rel.get('Id'): rel.get('Target') for rel in rels}
+        strings = None
+
+        fingerprints = {}
+        for sheet in workbook.iter('{{{}}}sheet'.format(XLSX_MAIN_NS)):
+            target = targets.get(sheet.get('{{{}}}id'.format(XLSX_REL_NS)), '')
+            part = (target.lstrip('/') if target.startswith('/')
+                    else 'xl/' + target)
+            if part not in infos:
+                continue
+            info = infos[part]
+            refs = _shared_string_refs(archive, part)
+            if strings is None:
+                strings = _shared_strings(archive, infos)
+            sha = hashlib.sha256()
+            for index in sorted(refs):
+                text = strings[index] if index < len(strings) else b''
+                sha.update('{}\0'.format(index).encode('ascii'))
+                sha.update(text + b'\0')
+            fingerprints[sheet.get('name')] = '{:08x}-{}-{}'.format(
+                info.CRC, info.file_size, sha.hexdigest())
+    return fingerprints
+
+
+def _shared_string_refs(archive, part, blocksize=1 << 20):
+    """Return the set of shared string indices used by a worksheet part.
+
+    The part is scanned as bytes, one decompressed block at a time, for
+    cells of type 's' (a block is only scanned up to its last complete
+    cell).
+    """
+    refs = set()
+    tail = b''
+    with archive.open(part) as fp:
+        for block in iter(lambda: fp.read(blocksize), b''):
+            buf = tail + block
+            end = buf.rfind(b'</c>')
+            end = 0 if end < 0 else end + len(b'</c>')
+            refs.update(int(m) for m in SHARED_CELL_RE.findall(buf, 0, end))
+            tail = buf[end:]
+    return refs
+
+
+def _shared_strings(archive, infos):
+    """Return the raw XML of every shared string of an xlsx archive."""
+    part = 'xl/sharedStrings.xml'
+    if part not in infos:
+        return []
+    return SHARED_STRING_RE.findall(archive.read(part))
+
+
+if __name__ == '__main__':
 
-    if len(sys.argv) != 2:
-        print(USAGE)
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'excel_fname',
+        type=str,
+        help='name of geographical variation state/county Excel file')
+    parser.add_argument(
+        '--parallel',
+        action='store_true',
+        help='convert the sheets in a process pool')
+    parser.add_argument(
+        '--format',
+        default='parquet',
+        choices=COLUMNAR_FORMATS,
+        help='columnar format written next to the CSVs in parallel mode')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help='number of worker processes in parallel mode')
+    args = parser.parse_args()
 
-    excel_fname = sys.argv[1]
-    convert_xlsx_to_csv(excel_fname)
+    if args.parallel:
+        convert_xlsx_parallel(
+            args.excel_fname, fmt=args.format, max_workers=args.workers)
+    else:
+        convert_xlsx_to_csv(args.excel_fname)
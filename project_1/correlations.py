@@ -0,0 +1,230 @@
+"""
+Screening for correlated columns of the State/County table.
+
+`pairwise_corr` returns the same matrix as `DataFrame.corr()` (Pearson
+correlation of every pair of columns over the rows where both are
+observed) but computes it with a handful of matrix products of the data
+and the mask of observed values instead of one `dropna` per pair.  For
+columns i and j, with x set to 0 where it is missing and m the mask,
+
+    n_ij    = sum m_i m_j           sxy_ij = sum x_i x_j
+    sx_ij   = sum x_i m_j           sxx_ij = sum x_i^2 m_j
+
+which are `M.T M`, `X.T M`, `X.T X` and `(X^2).T M`.  The sums add up
+over chunks of rows, so the rows are streamed in a single pass (e.g. one
+year at a time with `csv_feature_chunks`).  The four sums are full
+columns x columns matrices: reading the rows once is worth more than the
+memory they take, as it is the rows, not the columns, that grow.  The
+correlations are then computed for a block of rows of the matrix at a
+time (`block_cols`), which bounds the temporaries of that step, and
+`top_correlated_pairs` keeps only the pairs above a threshold from each
+block.
+
+ > python correlations.py --all-years ./data --threshold 0.9
+"""
+
+import argparse
+
+import numpy
+import pandas
+
+import profiling
+from geo_var_state_county import CmsGeoVarCountyTable
+from geo_var_state_county import KEY_COLS
+from geo_var_state_county import discover_csv_fnames
+from pca_on_dense_features import array_chunks
+from pca_on_dense_features import csv_feature_chunks
+
+
+DEFAULT_MIN_PERIODS = 10
+DEFAULT_THRESHOLD = 0.9
+
+
+def numeric_cols(df):
+    """Return the numeric columns of a State/County frame (without the
+    key columns)."""
+    return [
+        col for col in df.select_dtypes('number').columns
+        if col not in KEY_COLS]
+
+
+def iter_corr_blocks(chunks, n_cols, block_cols=None,
+                     min_periods=DEFAULT_MIN_PERIODS):
+    """Yield the pairwise complete correlation matrix one block of rows at
+    a time.
+
+    The chunks are read once.  `M.T M`, `X.T M`, `(X^2).T M` and `X.T X`
+    are accumulated over all chunks (the sums with x and y swapped are
+    their transposes), so four `n_cols x n_cols` arrays are held whatever
+    `block_cols` is.  The correlations are then computed one block of rows
+    at a time, which only bounds the temporaries of that step.
+
+    Args:
+      chunks (callable): returns an iterator over 2-D float arrays of rows
+        with `n_cols` columns (NaN for missing values).  It is called once.
+      n_cols (int): number of columns
+      block_cols (int): rows of the correlation matrix per block (default
+        all of them in one block).  It doesn't bound the memory of the
+        sums.
+      min_periods (int): correlations of pairs observed together in fewer
+        rows are NaN
+
+    Yields:
+      tuple: (start, corr, count) where `corr` and `count` hold rows
+        start:start+len(corr) of the correlation matrix and of the number
+        of rows each pair is observed in
+    """
+    if block_cols is None:
+        block_cols = n_cols
+    n = numpy.zeros((n_cols, n_cols))
+    sx = numpy.zeros((n_cols, n_cols))
+    sxx = numpy.zeros((n_cols, n_cols))
+    sxy = numpy.zeros((n_cols, n_cols))
+    shift = None
+    with profiling.stage('correlations: sums') as st:
+        for chunk in chunks():
+            chunk = numpy.asarray(chunk, dtype=numpy.float64)
+            observed = ~numpy.isnan(chunk)
+            if shift is None:
+                # a rough center keeps the sums of squares small
+                with numpy.errstate(invalid='ignore'):
+                    shift = numpy.nan_to_num(numpy.nanmean(chunk, axis=0))
+            M = observed.astype(numpy.float64)
+            X = numpy.where(observed, chunk - shift, 0.0)
+            n += M.T.dot(M)
+            sx += X.T.dot(M)
+            sxx += (X * X).T.dot(M)
+            sxy += X.T.dot(X)
+            st.add_rows(chunk.shape[0])
+
+    for start in range(0, n_cols, block_cols):
+        block = slice(start, min(start + block_cols, n_cols))
+        sums = {
+            'n': n[block], 'sx': sx[block], 'sy': sx.T[block],
+            'sxx': sxx[block], 'syy': sxx.T[block], 'sxy': sxy[block]}
+        yield start, _corr_from_sums(sums, min_periods), sums['n']
+
+
+def _corr_from_sums(sums, min_periods):
+    n = sums['n']
+    cov = n * sums['sxy'] - sums['sx'] * sums['sy']
+    var_x = n * sums['sxx'] - sums['sx']**2
+    var_y = n * sums['syy'] - sums['sy']**2
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        corr = cov / numpy.sqrt(var_x * var_y)
+    undefined = (n < max(min_periods, 2)) | (var_x <= 0) | (var_y <= 0)
+    corr[undefined] = numpy.nan
+    return numpy.clip(corr, -1.0, 1.0)
+
+
+def pairwise_corr(chunks, columns, block_cols=None,
+                  min_periods=DEFAULT_MIN_PERIODS):
+    """Return the pairwise complete correlation matrix of `columns`.
+
+    Args:
+      chunks (callable): returns an iterator over 2-D arrays of rows with
+        one column per entry in `columns` (see `array_chunks` and
+        `csv_feature_chunks`)
+      columns (list of str): names of the columns in each chunk
+      block_cols (int): see `iter_corr_blocks`
+      min_periods (int): see `iter_corr_blocks`
+
+    Returns:
+      DataFrame: columns x columns
+    """
+    corr = numpy.empty((len(columns), len(columns)))
+    for start, block, _ in iter_corr_blocks(
+            chunks, len(columns), block_cols, min_periods):
+        corr[start:start+block.shape[0]] = block
+    return pandas.DataFrame(corr, index=columns, columns=columns)
+
+
+def top_correlated_pairs(chunks, columns, threshold=DEFAULT_THRESHOLD,
+                         top=None, block_cols=None,
+                         min_periods=DEFAULT_MIN_PERIODS):
+    """Return the pairs of different columns with |correlation| of at
+    least `threshold`, strongest first.
+
+    Only the pairs above the threshold are kept from each block, so the
+    result stays small however many columns are screened (the sums behind
+    the blocks are still `columns x columns`, see `iter_corr_blocks`).
+
+    Returns:
+      DataFrame: 'col_a', 'col_b', 'corr' and 'n_obs' (rows where both
+        are observed), one row per pair
+    """
+    frames = []
+    for start, corr, count in iter_corr_blocks(
+            chunks, len(columns), block_cols, min_periods):
+        rows, cols = numpy.nonzero(numpy.abs(corr) >= threshold)
+        rows += start
+        upper = rows < cols
+        rows, cols = rows[upper], cols[upper]
+        frames.append(pandas.DataFrame({
+            'col_a': numpy.asarray(columns, dtype=object)[rows],
+            'col_b': numpy.asarray(columns, dtype=object)[cols],
+            'corr': corr[rows - start, cols],
+            'n_obs': count[rows - start, cols].astype(numpy.int64),
+        }))
+    pairs = pandas.concat(frames, ignore_index=True)
+    order = numpy.argsort(-numpy.abs(pairs['corr'].values), kind='stable')
+    pairs = pairs.iloc[order].reset_index(drop=True)
+    return pairs if top is None else pairs.head(top)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--fname',
+        type=str,
+        default='./data/County_All_Table_2014.csv',
+        help='name of geographical variation state/county file')
+    parser.add_argument(
+        '--all-years',
+        type=str,
+        default=None,
+        metavar='DATA_DIR',
+        help='stack the rows of all yearly files in DATA_DIR')
+    parser.add_argument(
+        '--level',
+        default='county',
+        choices=['state', 'county'],
+        help='rows to correlate')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help='smallest |correlation| to report')
+    parser.add_argument(
+        '--top',
+        type=int,
+        default=30,
+        help='number of pairs to print')
+    parser.add_argument(
+        '--block-cols',
+        type=int,
+        default=None,
+        help='rows of the correlation matrix computed per block')
+    args = parser.parse_args()
+
+    if args.all_years is not None:
+        csv_fnames = discover_csv_fnames(args.all_years)
+        gvct = CmsGeoVarCountyTable(csv_fnames[max(csv_fnames)])
+        columns = numeric_cols(gvct.df)
+        chunks = csv_feature_chunks(csv_fnames, columns, level=args.level)
+    else:
+        gvct = CmsGeoVarCountyTable(args.fname)
+        columns = numeric_cols(gvct.df)
+        df = gvct.select_rows(args.level)
+        chunks = array_chunks(
+            df[columns].to_numpy(dtype=numpy.float64, na_value=numpy.nan))
+
+    pairs = top_correlated_pairs(
+        chunks, columns, threshold=args.threshold, block_cols=args.block_cols)
+    print('columns: {}, pairs with |corr| >= {}: {}'.format(
+        len(columns), args.threshold, len(pairs)))
+    with pandas.option_context('display.width', 200,
+                               'display.max_columns', 10,
+                               'display.max_colwidth', 60):
+        print(pairs.head(args.top))
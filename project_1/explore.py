@@ -1,16 +1,155 @@
+"""
+Pair plot of a few columns of the State/County table.
+
+The off-diagonal panels show the points and density contours.  With
+`density='exact'` they are drawn by `plt.scatter` and `sns.kdeplot`, which
+evaluates the KDE at every grid point from every row, so the cost grows
+with rows times grid points and the county plots take minutes.  With
+`density='binned'` the rows of each pair are linearly binned onto a grid
+once, the KDE is the FFT convolution of the bin counts with the Gaussian
+kernel (see `binned_kde`) and the points are drawn as a hexbin, so the
+cost depends on the grid size and barely on the number of rows.
+"""
+
 import sys
 import argparse
 
+import numpy
 import pandas
-import matplotlib.pyplot as plt
-from matplotlib.colors import ListedColormap
-import seaborn as sns
 
 import us_states
 from geo_var_state_county import CmsGeoVarCountyTable
 
 
-def make_pair_plot(fname, level):
+DENSITY_MODES = ['exact', 'binned']
+DEFAULT_GRIDSIZE = 128
+DEFAULT_CUT = 3.0
+
+
+def linear_binning(x, y, xedges, yedges):
+    """Spread unit weights of the points over the four nearest grid points
+    (bilinear weights).  The grid points are the values in `xedges` and
+    `yedges`, which must be evenly spaced.
+
+    Returns:
+      array: weights (len(xedges) x len(yedges)) that sum to len(x)
+    """
+    nx, ny = len(xedges), len(yedges)
+    fx = (numpy.asarray(x, dtype=float) - xedges[0]) / (xedges[1] - xedges[0])
+    fy = (numpy.asarray(y, dtype=float) - yedges[0]) / (yedges[1] - yedges[0])
+    fx = numpy.clip(fx, 0, nx - 1)
+    fy = numpy.clip(fy, 0, ny - 1)
+    ix = numpy.minimum(fx.astype(int), nx - 2)
+    iy = numpy.minimum(fy.astype(int), ny - 2)
+    wx = fx - ix
+    wy = fy - iy
+    counts = numpy.zeros(nx * ny)
+    for dx, dy, w in [(0, 0, (1 - wx) * (1 - wy)), (1, 0, wx * (1 - wy)),
+                      (0, 1, (1 - wx) * wy), (1, 1, wx * wy)]:
+        counts += numpy.bincount(
+            (ix + dx) * ny + (iy + dy), weights=w, minlength=nx * ny)
+    return counts.reshape(nx, ny)
+
+
+def binned_kde(x, y, gridsize=DEFAULT_GRIDSIZE, cut=DEFAULT_CUT,
+               bw_method='scott'):
+    """Gaussian KDE of 2-D points on a regular grid.
+
+    Uses the bandwidth of `scipy.stats.gaussian_kde` (the covariance of
+    the points times the square of Scott's or Silverman's factor) but
+    replaces the evaluation at every grid point from every point with a
+    linear binning of the points and an FFT convolution of the bins with
+    the kernel.
+
+    Args:
+      x, y (array): coordinates of the points
+      gridsize (int): grid points per axis
+      cut (float): the grid extends this many bandwidths beyond the data
+      bw_method (str): 'scott' or 'silverman'
+
+    Returns:
+      tuple: (xgrid, ygrid, density) with density[i, j] at
+        (xgrid[i], ygrid[j])
+    """
+    from scipy.signal import fftconvolve
+
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.asarray(y, dtype=float)
+    n, d = x.size, 2
+    if bw_method == 'scott':
+        factor = n ** (-1.0 / (d + 4))
+    elif bw_method == 'silverman':
+        factor = (n * (d + 2) / 4.0) ** (-1.0 / (d + 4))
+    else:
+        raise ValueError("bw_method must be 'scott' or 'silverman'")
+    cov = numpy.cov(x, y) * factor**2
+    bw = numpy.sqrt(numpy.diag(cov))
+    xgrid = numpy.linspace(x.min() - cut * bw[0], x.max() + cut * bw[0],
+                           gridsize)
+    ygrid = numpy.linspace(y.min() - cut * bw[1], y.max() + cut * bw[1],
+                           gridsize)
+    counts = linear_binning(x, y, xgrid, ygrid)
+
+    # the kernel on the grid offsets out to 4 bandwidths
+    step = numpy.array([xgrid[1] - xgrid[0], ygrid[1] - ygrid[0]])
+    half = numpy.minimum(numpy.ceil(4.0 * bw / step).astype(int), gridsize)
+    u = numpy.arange(-half[0], half[0] + 1) * step[0]
+    v = numpy.arange(-half[1], half[1] + 1) * step[1]
+    inv = numpy.linalg.inv(cov)
+    kernel = numpy.exp(-0.5 * (
+        inv[0, 0] * u[:, numpy.newaxis]**2 +
+        2.0 * inv[0, 1] * u[:, numpy.newaxis] * v[numpy.newaxis, :] +
+        inv[1, 1] * v[numpy.newaxis, :]**2))
+    kernel /= 2.0 * numpy.pi * numpy.sqrt(numpy.linalg.det(cov))
+
+    density = fftconvolve(counts, kernel, mode='same') / n
+    return xgrid, ygrid, numpy.maximum(density, 0.0)
+
+
+def iso_proportion_levels(density, n_levels, thresh=0.05):
+    """Return the density values whose contours enclose the fractions of
+    the mass between `thresh` and 1 (lowest density first), like seaborn's
+    `kdeplot` levels."""
+    values = numpy.sort(density.ravel())
+    mass = numpy.cumsum(values)
+    mass /= mass[-1]
+    proportions = numpy.linspace(thresh, 1.0, n_levels + 1)[:-1]
+    return numpy.unique(values[numpy.searchsorted(mass, proportions)])
+
+
+def binned_density_panel(x, y, gridsize=DEFAULT_GRIDSIZE, n_levels=5,
+                         cmap=None, hex_gridsize=40, **kwargs):
+    """Off-diagonal panel of the binned mode: a rasterized hexbin of the
+    points with the contours of `binned_kde` on top."""
+    import matplotlib.pyplot as plt
+
+    ax = plt.gca()
+    ax.hexbin(x, y, gridsize=hex_gridsize, mincnt=1, cmap='Greys',
+              linewidths=0.0, rasterized=True)
+    xgrid, ygrid, density = binned_kde(x, y, gridsize=gridsize)
+    ax.contour(xgrid, ygrid, density.T, cmap=cmap,
+               levels=iso_proportion_levels(density, n_levels))
+
+
+def make_pair_plot(fname, level, density='exact',
+                   gridsize=DEFAULT_GRIDSIZE):
+    """Pair plot of a few columns of the rows of `level`.
+
+    Args:
+      fname (str): name of geographical variation state/county file
+      level (str): 'state' or 'county'
+      density (str): 'exact' draws every point and seaborn's KDE contours,
+        'binned' a hexbin and the contours of `binned_kde` (much faster
+        for counties)
+      gridsize (int): grid points per axis of the binned KDE
+    """
+    if density not in DENSITY_MODES:
+        raise ValueError('density must be one of {}'.format(DENSITY_MODES))
+    # imported here so importing this module doesn't load the plotting
+    # libraries
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import ListedColormap
+    import seaborn as sns
 
     gvct = CmsGeoVarCountyTable(fname, verbose=True)
     df = gvct.select_rows(level)
@@ -29,10 +168,15 @@ def make_pair_plot(fname, level):
     palette = list(reversed(sns.color_palette("Reds_d", n_levels)))
     my_cmap = ListedColormap(palette)
 
-    g = sns.PairGrid(plt_df, size=2.5)
+    g = sns.PairGrid(plt_df, height=2.5)
     g.map_diag(plt.hist)
-    g.map_offdiag(plt.scatter, s=10, alpha=0.5)
-    g.map_offdiag(sns.kdeplot, cmap=my_cmap, n_levels=n_levels);
+    if density == 'exact':
+        g.map_offdiag(plt.scatter, s=10, alpha=0.5)
+        g.map_offdiag(sns.kdeplot, cmap=my_cmap, levels=n_levels)
+    else:
+        g.map_offdiag(
+            binned_density_panel, gridsize=gridsize, cmap=my_cmap,
+            n_levels=n_levels)
     g.savefig('gvct_pairplot_{}.png'.format(level))
 
 if __name__ == '__main__':
@@ -48,6 +192,17 @@ if __name__ == '__main__':
         default='state',
         choices=['state', 'county'],
         help='rows to select from data')
+    parser.add_argument(
+        '--density',
+        default='exact',
+        choices=DENSITY_MODES,
+        help='how to draw the points and density contours')
+    parser.add_argument(
+        '--gridsize',
+        type=int,
+        default=DEFAULT_GRIDSIZE,
+        help='grid points per axis of the binned density')
     args = parser.parse_args()
 
-    make_pair_plot(fname=args.fname, level=args.level)
+    make_pair_plot(fname=args.fname, level=args.level, density=args.density,
+                   gridsize=args.gridsize)
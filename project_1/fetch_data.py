@@ -0,0 +1,432 @@
+"""
+Download the CMS data, unzip it and convert the Excel workbook to CSVs.
+
+This replaces the wget/unzip steps of `get_data.sh` (which now just calls
+this script),
+
+ - all sources are downloaded at the same time by a pool of threads
+ - downloads go to a '.part' file first.  An interrupted download is
+   resumed with an HTTP range request (or a seek for file:// URLs) instead
+   of starting over, and the file is only renamed to its final name once
+   it is complete.
+ - the SHA-256 hash of every file is computed once it is complete and
+   recorded in a manifest (`data/fetch_manifest.json`).  Files that are
+   already there and still match the manifest are not downloaded again,
+   and a file whose hash doesn't match the expected one is rejected.
+ - zip members are extracted in blocks (never holding a member in memory)
+   and the conversion of the workbook starts as soon as it is extracted,
+   while the other downloads continue.  The conversion hands each sheet to
+   a process pool as soon as it is parsed (see `convert_xlsx_parallel`).
+
+The trust model is trust on first use.  CMS doesn't publish checksums
+and the ACO file is an export that is generated on request, so no hashes
+are pinned in SOURCES.  The first download of a file is accepted and its
+hash is recorded; every later download of it (after the file was deleted
+or from a mirror) must have the recorded hash.  To check first downloads
+too, pass a checksum file from a machine you trust (`--checksums`, either
+a fetch manifest or a JSON object of file name -> SHA-256) and add
+`--require-checksums` to refuse files without an expected hash.  To accept
+a new version of a file that CMS has updated, delete its entry from the
+manifest.
+
+The sources can be fetched from a mirror (a local directory or a local
+HTTP server with the same file names) to work offline,
+
+ > python fetch_data.py
+ > python fetch_data.py --mirror file:///path/to/mirror --data-dir ./data
+ > python fetch_data.py --mirror http://localhost:8000 --no-convert
+ > python fetch_data.py --checksums trusted_manifest.json --require-checksums
+"""
+
+import os
+import json
+import time
+import shutil
+import zipfile
+import argparse
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+
+from manifest import file_sha256
+from manifest import read_manifest
+from manifest import write_manifest
+
+
+DEFAULT_DATA_DIR = './data'
+MANIFEST_FNAME = 'fetch_manifest.json'
+PART_SUFFIX = '.part'
+BLOCK_SIZE = 1 << 20
+DEFAULT_RETRIES = 3
+DEFAULT_TIMEOUT = 60
+WORKBOOK_FNAME = 'County_All_Table.xlsx'
+
+
+Source = namedtuple('Source', [
+    'url',              # where to download the file from
+    'fname',            # file name in the data directory
+    'sha256',           # expected SHA-256 hex digest (None to trust the
+                        # first download, see the module docstring)
+    'unzip',            # extract the members of the file (a zip archive)
+])
+
+
+SOURCES = [
+    Source(
+        url='https://www.cms.gov/Research-Statistics-Data-and-Systems/Statistics-Trends-and-Reports/Medicare-Geographic-Variation/Downloads/State_County_Table_All.zip',
+        fname='State_County_Table_All.zip',
+        sha256=None,
+        unzip=True),
+    Source(
+        url='https://data.cms.gov/api/views/ucce-hhpu/rows.csv',
+        fname='Medicare_Shared_Savings_Program_Accountable_Care_Organizations_Performance_Year_2014_Results.csv',
+        sha256=None,
+        unzip=False),
+]
+
+
+class ChecksumError(ValueError):
+    """A downloaded file doesn't have the expected SHA-256 hash."""
+
+
+def mirror_sources(sources, mirror):
+    """Return the sources with their URLs pointing at a mirror.
+
+    Args:
+      sources (list of Source): sources to redirect
+      mirror (str): base URL (http://, https:// or file://) or local
+        directory holding files with the same names
+    """
+    if '://' not in mirror:
+        mirror = 'file://' + urllib.request.pathname2url(
+            os.path.abspath(mirror))
+    base = mirror.rstrip('/') + '/'
+    return [
+        source._replace(url=base + urllib.parse.quote(source.fname))
+        for source in sources]
+
+
+def load_checksums(fname):
+    """Read expected hashes from a JSON file.
+
+    The file is either a fetch manifest (file name -> entry with a
+    'sha256') or an object of file name -> SHA-256 hex digest.
+
+    Returns:
+      dict: file name -> SHA-256 hex digest
+    """
+    with open(fname) as fp:
+        checksums = json.load(fp)
+    return {
+        name: value['sha256'] if isinstance(value, dict) else value
+        for name, value in checksums.items()
+        if isinstance(value, str) or value.get('sha256')}
+
+
+def pin_sources(sources, checksums):
+    """Return the sources with the expected hashes of `checksums` (see
+    `load_checksums`) filled in where they have none."""
+    return [
+        source._replace(sha256=checksums.get(source.fname))
+        if source.sha256 is None else source
+        for source in sources]
+
+
+def fetch_file(url, fname, sha256=None, retries=DEFAULT_RETRIES,
+               timeout=DEFAULT_TIMEOUT, verbose=True):
+    """Download a URL to a file, resuming an earlier partial download.
+
+    The bytes go to `fname + PART_SUFFIX`.  If that file exists the
+    download continues where it stopped (a range request for HTTP URLs, a
+    seek for file:// URLs).  A server that ignores the range request sends
+    the whole file again, which then replaces the partial file.  Failed
+    attempts are retried (resuming each time) up to `retries` times, except
+    for HTTP client errors such as 404.
+
+    Args:
+      url (str): http://, https:// or file:// URL
+      fname (str): destination file
+      sha256 (str): expected SHA-256 hex digest
+      retries (int): number of attempts after the first one fails
+      timeout (float): socket timeout in seconds
+      verbose (bool): print progress
+
+    Returns:
+      dict: 'url', 'size', 'sha256' and 'seconds' of the download
+
+    Raises:
+      ChecksumError: if the file doesn't match `sha256`.  The partial file
+        is removed so the next attempt starts over.
+    """
+    part_fname = fname + PART_SUFFIX
+    t1 = time.time()
+    for attempt in range(retries + 1):
+        try:
+            size = _download(url, part_fname, timeout, verbose)
+            break
+        except (OSError, ValueError) as err:
+            client_error = (
+                isinstance(err, urllib.error.HTTPError) and err.code < 500)
+            if attempt == retries or client_error:
+                raise
+            if verbose: print('retrying {} after error: {}'.format(url, err))
+            time.sleep(min(2 ** attempt, 30))
+
+    digest = file_sha256(part_fname)
+    if sha256 is not None and digest != sha256.lower():
+        os.remove(part_fname)
+        raise ChecksumError(
+            '{}: sha256 {} != expected {} (if the file was updated at its '
+            'source, remove its entry from the manifest to accept '
+            'it)'.format(url, digest, sha256))
+    os.replace(part_fname, fname)
+    t2 = time.time()
+    if verbose: print('fetched {} ({} bytes in {:.1f} seconds)'.format(
+        os.path.basename(fname), size, t2-t1))
+    return {'url': url, 'size': size, 'sha256': digest, 'seconds': t2-t1}
+
+
+def _download(url, part_fname, timeout, verbose):
+    """Append the missing bytes of `url` to `part_fname` and return the
+    size of the complete file."""
+    offset = os.path.getsize(part_fname) if os.path.isfile(part_fname) else 0
+    stream, total, resumed = _open_range(url, offset, timeout)
+    if resumed and total is not None and offset > total:
+        # a partial file longer than the file is corrupt, start over
+        if verbose: print('discarding {} ({} of {} bytes)'.format(
+            part_fname, offset, total))
+        stream.close()
+        offset = 0
+        stream, total, resumed = _open_range(url, offset, timeout)
+    with stream:
+        if offset > 0 and resumed:
+            if verbose: print('resuming {} at byte {}'.format(url, offset))
+        else:
+            offset = 0
+        if total is not None and offset >= total:
+            return offset
+        with open(part_fname, 'ab' if offset > 0 else 'wb') as fp:
+            for block in iter(lambda: stream.read(BLOCK_SIZE), b''):
+                fp.write(block)
+    size = os.path.getsize(part_fname)
+    if total is not None and size != total:
+        raise ValueError('{}: got {} of {} bytes'.format(url, size, total))
+    return size
+
+
+def _open_range(url, offset, timeout):
+    """Open `url` at byte `offset`.
+
+    Returns:
+      tuple: (readable stream, total size of the file or None, True if the
+        stream starts at `offset` rather than at the beginning)
+    """
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == 'file':
+        path = urllib.request.url2pathname(parsed.path)
+        total = os.path.getsize(path)
+        resumed = offset <= total
+        stream = open(path, 'rb')
+        if resumed:
+            stream.seek(offset)
+        return stream, total, resumed
+
+    request = urllib.request.Request(url)
+    if offset > 0:
+        request.add_header('Range', 'bytes={}-'.format(offset))
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as err:
+        if err.code == 416:
+            # range not satisfiable, the partial file is already complete
+            # (or longer than the file), so fetch the whole file again
+            if offset > 0:
+                return _open_range(url, 0, timeout)
+        raise
+
+    if response.status == 206:
+        # Content-Range: bytes <first>-<last>/<total>
+        content_range = response.headers.get('Content-Range', '')
+        first = content_range.split(' ')[-1].split('-')[0]
+        if not first.isdigit() or int(first) != offset:
+            response.close()
+            if offset == 0:
+                raise ValueError('{}: unexpected Content-Range {!r}'.format(
+                    url, content_range))
+            return _open_range(url, 0, timeout)
+        total = content_range.rsplit('/', 1)[-1]
+        return response, int(total) if total.isdigit() else None, True
+
+    length = response.headers.get('Content-Length')
+    return response, int(length) if length is not None else None, False
+
+
+def extract_zip(zip_fname, dirname, verbose=True):
+    """Extract the members of a zip file, copying each one in blocks.
+
+    A member is written to a temporary name and renamed when it is
+    complete, so a member that exists was extracted in full.  Members that
+    already exist with the size recorded in the archive are skipped.
+
+    Yields:
+      str: the path of each member as soon as it is extracted
+    """
+    with zipfile.ZipFile(zip_fname) as archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            name = os.path.basename(info.filename)
+            fname = os.path.join(dirname, name)
+            if os.path.isfile(fname) and \
+                    os.path.getsize(fname) == info.file_size:
+                if verbose: print('{} already extracted'.format(name))
+                yield fname
+                continue
+            tmp_fname = fname + PART_SUFFIX
+            with archive.open(info) as src, open(tmp_fname, 'wb') as dst:
+                shutil.copyfileobj(src, dst, BLOCK_SIZE)
+            os.replace(tmp_fname, fname)
+            if verbose: print('extracted {}'.format(name))
+            yield fname
+
+
+def is_fetched(source, entry, fname):
+    """Return True if `fname` exists and matches its manifest entry (and
+    the expected hash of the source)."""
+    if entry is None or not os.path.isfile(fname):
+        return False
+    if os.path.getsize(fname) != entry.get('size'):
+        return False
+    expected = source.sha256 or entry.get('sha256')
+    return expected is not None and file_sha256(fname) == expected.lower()
+
+
+def fetch_data(sources=SOURCES, data_dir=DEFAULT_DATA_DIR, convert=True,
+               fmt='parquet', max_workers=None, retries=DEFAULT_RETRIES,
+               require_checksums=False, verbose=True):
+    """Download, unzip and convert all sources.
+
+    Sources are downloaded concurrently.  Each finished download is
+    unzipped (if it is a zip archive) while the others continue, and the
+    workbook conversion (`convert_xlsx_parallel`) starts as soon as the
+    workbook is extracted.
+
+    A download must match the hash of its source or, if the source has
+    none, the hash recorded in the manifest by an earlier download.
+
+    Args:
+      sources (list of Source): files to fetch (see `mirror_sources`)
+      data_dir (str): directory to write to
+      convert (bool): convert the workbook sheets to CSV files
+      fmt (str): columnar format written next to the CSVs
+      max_workers (int): number of download threads (default one per
+        source)
+      retries (int): retries per download
+      require_checksums (bool): raise ChecksumError for a source without
+        an expected hash instead of trusting its first download
+      verbose (bool): print progress
+
+    Returns:
+      dict: the fetch manifest (file name -> url, size, sha256)
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    manifest_fname = os.path.join(data_dir, MANIFEST_FNAME)
+    manifest = read_manifest(manifest_fname)
+
+    def fetch(source):
+        fname = os.path.join(data_dir, source.fname)
+        entry = manifest.get(source.fname)
+        if is_fetched(source, entry, fname):
+            if verbose: print('{} is up to date'.format(source.fname))
+            return source, entry
+        expected = source.sha256 or (entry or {}).get('sha256')
+        if expected is None:
+            if require_checksums:
+                raise ChecksumError(
+                    'no expected sha256 for {}'.format(source.fname))
+            if verbose: print('no expected sha256 for {}, trusting the '
+                              'first download'.format(source.fname))
+        entry = fetch_file(
+            source.url, fname, sha256=expected, retries=retries,
+            verbose=verbose)
+        return source, entry
+
+    workbooks = []
+    with ThreadPoolExecutor(
+            max_workers=max_workers or max(len(sources), 1)) as executor:
+        futures = [executor.submit(fetch, source) for source in sources]
+        for future in as_completed(futures):
+            source, entry = future.result()
+            manifest[source.fname] = entry
+            write_manifest(manifest_fname, manifest)
+            if not source.unzip:
+                continue
+            zip_fname = os.path.join(data_dir, source.fname)
+            for fname in extract_zip(zip_fname, data_dir, verbose=verbose):
+                if os.path.basename(fname) == WORKBOOK_FNAME:
+                    workbooks.append(fname)
+                    if convert:
+                        _convert(fname, fmt)
+
+    if convert and not workbooks:
+        print('no {} found in the sources'.format(WORKBOOK_FNAME))
+    return manifest
+
+
+def _convert(excel_fname, fmt):
+    """Convert the workbook sheets to CSV and columnar files."""
+    from convert_geo_var_state_county_to_csv import convert_xlsx_parallel
+    convert_xlsx_parallel(excel_fname, fmt=fmt)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--data-dir',
+        type=str,
+        default=DEFAULT_DATA_DIR,
+        help='directory to download to')
+    parser.add_argument(
+        '--mirror',
+        type=str,
+        default=None,
+        help='base URL or directory with the source files (for offline use)')
+    parser.add_argument(
+        '--no-convert',
+        action='store_true',
+        help='only download and unzip')
+    parser.add_argument(
+        '--format',
+        default='parquet',
+        choices=['parquet', 'feather'],
+        help='columnar format written next to the CSVs')
+    parser.add_argument(
+        '--checksums',
+        type=str,
+        default=None,
+        help='JSON file with the expected SHA-256 of the files (e.g. a '
+             'fetch manifest from a trusted machine)')
+    parser.add_argument(
+        '--require-checksums',
+        action='store_true',
+        help='refuse files that have no expected SHA-256')
+    parser.add_argument(
+        '--retries',
+        type=int,
+        default=DEFAULT_RETRIES,
+        help='retries per download')
+    args = parser.parse_args()
+
+    sources = SOURCES
+    if args.mirror is not None:
+        sources = mirror_sources(sources, args.mirror)
+    if args.checksums is not None:
+        sources = pin_sources(sources, load_checksums(args.checksums))
+    fetch_data(
+        sources, data_dir=args.data_dir, convert=not args.no_convert,
+        fmt=args.format, retries=args.retries,
+        require_checksums=args.require_checksums)
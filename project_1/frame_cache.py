@@ -0,0 +1,290 @@
+"""
+On-disk cache of parsed DataFrames.
+
+A DataFrame is stored as a directory of `.npy` files plus a `meta.json`
+file.  Columns of the same numpy dtype are stored together as one 2-D array
+so they come back as a single pandas block, categorical columns are stored
+as their integer codes, nullable integer columns as values plus mask and
+string columns (e.g. FIPS codes) as fixed-width unicode arrays plus mask.
+When a frame is loaded the arrays are memory mapped (copy-on-write) so
+opening a cached frame costs almost nothing and no data is copied until it
+is touched.
+
+Entries are keyed on the absolute path of the source file and a "variant"
+string describing how it was parsed.  Each entry records the size,
+modification time and SHA-256 hash of the source file.  An entry is used if
+the size and modification time match, or if only the modification time
+changed but the content hash still matches.  The total size of the cache
+directory is bounded and the least recently used entries are evicted first.
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy
+import pandas
+
+from manifest import file_sha256
+
+
+DEFAULT_MAX_BYTES = 2 * 2**30
+META_FNAME = 'meta.json'
+
+
+class FrameCache:
+    """Size bounded cache of parsed DataFrames keyed on a source file."""
+
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES, verbose=False):
+        """Initialize class with a cache directory (created if needed).
+
+        Args:
+          cache_dir (str): directory that holds the cache entries
+          max_bytes (int): evict entries once the cache is larger than this
+          verbose (bool): print cache hits, misses and evictions
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.verbose = verbose
+        os.makedirs(cache_dir, exist_ok=True)
+
+
+    def load(self, source_fname, variant=''):
+        """Return (df, extra) for a valid entry or None.
+
+        An entry whose source file changed is removed.
+        """
+        entry_dir = self._entry_dir(source_fname, variant)
+        meta = read_meta(entry_dir)
+        if meta is None:
+            if self.verbose: print('cache miss: {}'.format(source_fname))
+            return None
+
+        stat = os.stat(source_fname)
+        source = meta['source']
+        if (source['size'] != stat.st_size or
+                source['mtime_ns'] != stat.st_mtime_ns):
+            if (source['size'] != stat.st_size or
+                    source['sha256'] != file_sha256(source_fname)):
+                if self.verbose: print('cache stale: {}'.format(source_fname))
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                return None
+            source['mtime_ns'] = stat.st_mtime_ns
+            write_meta(entry_dir, meta)
+
+        if self.verbose: print('cache hit: {}'.format(entry_dir))
+        os.utime(os.path.join(entry_dir, META_FNAME))
+        return load_frame(entry_dir, meta), meta['extra']
+
+
+    def store(self, source_fname, df, variant='', extra=None):
+        """Store a frame parsed from `source_fname` and evict old entries.
+
+        Args:
+          source_fname (str): file the frame was parsed from
+          df (DataFrame): the parsed frame
+          variant (str): describes how the file was parsed
+          extra (dict): JSON serializable data returned along with the frame
+        """
+        stat = os.stat(source_fname)
+        source = {
+            'path': os.path.abspath(source_fname),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha256': file_sha256(source_fname),
+        }
+        entry_dir = self._entry_dir(source_fname, variant)
+        tmp_dir = '{}.tmp{}'.format(entry_dir, os.getpid())
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        save_frame(df, tmp_dir, extra={
+            'source': source,
+            'variant': variant,
+            'extra': extra if extra is not None else {},
+        })
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.rename(tmp_dir, entry_dir)
+        if self.verbose: print('cache store: {}'.format(entry_dir))
+        self.evict(keep=entry_dir)
+
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache fits in
+        `max_bytes` (the entry `keep` is never removed)."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            meta_fname = os.path.join(entry_dir, META_FNAME)
+            if not os.path.isfile(meta_fname):
+                continue
+            entries.append(
+                (os.path.getmtime(meta_fname), dir_size(entry_dir), entry_dir))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if entry_dir == keep:
+                continue
+            if self.verbose: print('cache evict: {}'.format(entry_dir))
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+
+
+    def _entry_dir(self, source_fname, variant):
+        """Return the entry directory for a source file and variant."""
+        key = '{}\0{}'.format(os.path.abspath(source_fname), variant)
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, name)
+
+
+def save_frame(df, dirname, extra=None):
+    """Write a DataFrame to a directory of `.npy` files.
+
+    Args:
+      df (DataFrame): frame with a numeric index and unique column names
+      dirname (str): directory to create
+      extra (dict): JSON serializable data stored in the meta file
+    """
+    os.makedirs(dirname)
+    columns = []
+    blocks = {}
+    for icol, col in enumerate(df.columns):
+        ser = df[col]
+        entry = {'name': col, 'dtype': str(ser.dtype)}
+        if isinstance(ser.dtype, pandas.CategoricalDtype):
+            entry['kind'] = 'categorical'
+            entry['file'] = 'codes_{}.npy'.format(icol)
+            entry['categories'] = ser.cat.categories.tolist()
+            numpy.save(
+                os.path.join(dirname, entry['file']), ser.cat.codes.values)
+        elif (pandas.api.types.is_integer_dtype(ser.dtype) and
+                pandas.api.types.is_extension_array_dtype(ser.dtype)):
+            entry['kind'] = 'masked'
+            entry['file'] = 'values_{}.npy'.format(icol)
+            entry['mask_file'] = 'mask_{}.npy'.format(icol)
+            numpy_dtype = ser.dtype.numpy_dtype
+            numpy.save(
+                os.path.join(dirname, entry['file']),
+                ser.array.to_numpy(dtype=numpy_dtype, na_value=0))
+            numpy.save(
+                os.path.join(dirname, entry['mask_file']), ser.isnull().values)
+        elif isinstance(ser.dtype, numpy.dtype) and ser.dtype.kind in 'biuf':
+            entry['kind'] = 'block'
+            blocks.setdefault(ser.dtype.str, []).append(col)
+        elif is_text(ser):
+            entry['kind'] = 'text'
+            entry['file'] = 'text_{}.npy'.format(icol)
+            entry['mask_file'] = 'mask_{}.npy'.format(icol)
+            mask = ser.isnull().values
+            numpy.save(
+                os.path.join(dirname, entry['file']),
+                ser.to_numpy(dtype=object, na_value='').astype(str))
+            numpy.save(os.path.join(dirname, entry['mask_file']), mask)
+        else:
+            # mixed object columns, rare enough to keep in the meta file
+            entry['kind'] = 'json'
+            entry['values'] = [
+                None if pandas.isnull(x) else x for x in ser.tolist()]
+        columns.append(entry)
+
+    block_files = {}
+    for iblock, (dtype, cols) in enumerate(sorted(blocks.items())):
+        fname = 'block_{}.npy'.format(iblock)
+        arr = numpy.lib.format.open_memmap(
+            os.path.join(dirname, fname), mode='w+', dtype=dtype,
+            shape=(len(cols), df.shape[0]))
+        for irow, col in enumerate(cols):
+            arr[irow] = df[col].values
+        arr.flush()
+        del arr
+        block_files[fname] = cols
+
+    numpy.save(os.path.join(dirname, 'index.npy'), df.index.values)
+    meta = dict(extra) if extra is not None else {}
+    meta.update({
+        'created': time.time(),
+        'index_name': df.index.name,
+        'columns': columns,
+        'blocks': block_files,
+    })
+    write_meta(dirname, meta)
+
+
+def load_frame(dirname, meta=None, mmap_mode='c'):
+    """Read a DataFrame written by `save_frame`.
+
+    With the default `mmap_mode='c'` arrays are memory mapped copy-on-write,
+    so they can be modified in memory without changing the cache.
+    """
+    if meta is None:
+        meta = read_meta(dirname)
+
+    def load(fname):
+        return numpy.load(os.path.join(dirname, fname), mmap_mode=mmap_mode)
+
+    index = pandas.Index(load('index.npy'), name=meta['index_name'])
+    parts = []
+    for fname, cols in sorted(meta['blocks'].items()):
+        parts.append(pandas.DataFrame(
+            load(fname).T, index=index, columns=cols, copy=False))
+
+    single = {}
+    for entry in meta['columns']:
+        if entry['kind'] == 'categorical':
+            values = pandas.Categorical.from_codes(
+                load(entry['file']), entry['categories'])
+        elif entry['kind'] == 'masked':
+            values = pandas.arrays.IntegerArray(
+                load(entry['file']), load(entry['mask_file']))
+        elif entry['kind'] == 'text':
+            values = load(entry['file']).astype(object)
+            values[load(entry['mask_file'])] = numpy.nan
+            # a Series keeps object columns from being inferred as str
+            values = pandas.Series(
+                values, index=index, dtype=entry['dtype'], copy=False)
+        elif entry['kind'] == 'json':
+            values = pandas.array(entry['values'], dtype=entry['dtype'])
+        else:
+            continue
+        single[entry['name']] = values
+    if single:
+        parts.append(pandas.DataFrame(single, index=index, copy=False))
+
+    df = pandas.concat(parts, axis=1)
+    return df[[entry['name'] for entry in meta['columns']]]
+
+
+def is_text(ser):
+    """Return True if every non-missing value of a column is a string."""
+    if pandas.api.types.is_string_dtype(ser.dtype) and not isinstance(
+            ser.dtype, pandas.CategoricalDtype):
+        return pandas.api.types.infer_dtype(ser, skipna=True) in (
+            'string', 'empty')
+    return False
+
+
+def read_meta(dirname):
+    """Read the meta file of a cache entry (None if it doesn't exist)."""
+    meta_fname = os.path.join(dirname, META_FNAME)
+    if not os.path.isfile(meta_fname):
+        return None
+    with open(meta_fname) as fp:
+        return json.load(fp)
+
+
+def write_meta(dirname, meta):
+    """Atomically write the meta file of a cache entry."""
+    meta_fname = os.path.join(dirname, META_FNAME)
+    tmp_fname = meta_fname + '.tmp'
+    with open(tmp_fname, 'w') as fp:
+        json.dump(meta, fp)
+    os.replace(tmp_fname, meta_fname)
+
+
+def dir_size(dirname):
+    """Return the total size in bytes of the files in a directory."""
+    return sum(
+        os.path.getsize(os.path.join(dirname, fname))
+        for fname in os.listdir(dirname))
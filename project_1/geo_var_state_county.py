@@ -16,27 +16,408 @@ State level data includes all 50 states +
 """
 
 import os
+import re
+import json
 import time
+import argparse
+import functools
+import tracemalloc
+from collections import OrderedDict
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import numpy
 import pandas
 import us_states
+import profiling
+from frame_cache import FrameCache
+from frame_cache import DEFAULT_MAX_BYTES
 
 
 VALID_LEVELS = ['national', 'state', 'county']
 DEFAULT_CSV_FNAME = './data/County_All_Table_2014.csv'
+DEFAULT_DATA_DIR = './data'
+DEFAULT_CACHE_DIRNAME = '.gvct_cache'
+DEFAULT_RTOL = 1.0e-6
+DEFAULT_ATOL = 0.5
+DEFAULT_CHUNKSIZE = 100000
+CSV_FNAME_REGEX = re.compile(r'^County_All_Table_(\d{4})\.csv$')
+KEY_COLS = ['State', 'County']
+FIPS_COL = 'State and County FIPS Code'
+FEATURE_MATRIX_CACHE_SIZE = 8
+FEATURE_MATRIX_DTYPES = [numpy.dtype(numpy.float32), numpy.dtype(numpy.float64)]
+
+# Every row belongs to exactly one of these levels.  States that only have
+# a single row (e.g. 'XX', 'PR', 'VI') are part of both the 'state' and the
+# 'county' selections, so they are placed between the two.
+ROW_LEVELS = ['national', 'state_total', 'single_row_state', 'county']
+LEVEL_NATIONAL = 0
+LEVEL_STATE_TOTAL = 1
+LEVEL_SINGLE_ROW_STATE = 2
+LEVEL_COUNTY = 3
+
+# levels that make up each of the VALID_LEVELS selections
+LEVEL_ROWS = {
+    'national': [LEVEL_NATIONAL],
+    'state': [LEVEL_STATE_TOTAL, LEVEL_SINGLE_ROW_STATE],
+    'county': [LEVEL_SINGLE_ROW_STATE, LEVEL_COUNTY],
+}
+
+
+# Declared schema of the State/County table.  Every column is given a kind
+# by `column_kind` and each kind is stored with the dtype below.  Counts are
+# parsed as float64 and then converted to nullable integers.
+SCHEMA_DTYPES = {
+    'key': 'category',
+    'code': str,
+    'count': 'float64',
+    'amount': 'float64',
+    'metric': 'float32',
+}
+NON_ADDITIVE_TOKENS = [
+    'Per ', 'per ', '%', ' as ', 'Percent', 'Rate', 'Average']
+ADDITIVE_SUFFIXES = (
+    ' Costs', ' Beneficiaries', ' Stays', ' Days', ' Visits', ' Events')
+
+
+FeatureMatrix = namedtuple('FeatureMatrix', [
+    'values',           # C-contiguous (rows x columns) read-only array
+    'index',            # row labels (the index of the selected rows)
+    'columns',          # column names
+    'frac_nan',         # fraction of missing values in each column
+])
+
+
+def is_additive_col(col):
+    """Return True if a column holds a total that can be summed over
+    counties or states (e.g. 'Total Actual Costs' or 'IP Covered Stays')
+    as opposed to a rate, an average or a per capita value."""
+    if any(token in col for token in NON_ADDITIVE_TOKENS):
+        return False
+    return (
+        col.startswith('Total ') or
+        col.startswith('Beneficiaries') or
+        col.endswith(ADDITIVE_SUFFIXES))
+
+
+def column_kind(col):
+    """Return the kind of a column, one of ['key', 'code', 'count',
+    'amount', 'metric'], or None for the unnamed index column that pandas
+    writes into the CSV files."""
+    if col in KEY_COLS:
+        return 'key'
+    if 'FIPS' in col:
+        return 'code'
+    if col.startswith('Unnamed:'):
+        return None
+    if is_additive_col(col):
+        return 'amount' if col.endswith(' Costs') else 'count'
+    return 'metric'
+
+
+def read_county_csv(csv_fname, columns=None, schema=True):
+    """Read a State/County CSV file into a DataFrame.
+
+    Args:
+      csv_fname (str): name of CSV file
+      columns (list of str): columns to read in addition to 'State' and
+        'County' (default is all columns).  Columns that are not in the
+        file are ignored.
+      schema (bool): if True, apply the dtypes in `SCHEMA_DTYPES`
+        (categorical keys, float32 metrics and nullable integer counts)
+        instead of letting pandas infer float64/object columns.
+
+    Returns:
+      DataFrame: the requested columns in the order they were requested
+    """
+    header = pandas.read_csv(csv_fname, nrows=0).columns
+    if columns is None:
+        usecols = header.tolist()
+    else:
+        usecols = KEY_COLS + [
+            col for col in columns if col in header and col not in KEY_COLS]
+
+    dtype = None
+    if schema:
+        kinds = {col: column_kind(col) for col in usecols}
+        dtype = {col: SCHEMA_DTYPES[kind]
+                 for col, kind in kinds.items() if kind is not None}
+    df = pandas.read_csv(csv_fname, usecols=usecols, dtype=dtype)
+    if schema:
+        for col, kind in kinds.items():
+            if kind == 'count':
+                df[col] = _to_nullable_int(df[col])
+    if df.columns.tolist() != usecols:
+        df = df[usecols]
+    return df
+
+
+def _to_nullable_int(ser):
+    """Convert a float Series to a nullable integer Series if all of its
+    values are whole numbers (otherwise return it unchanged)."""
+    values = ser.values
+    finite = values[~numpy.isnan(values)]
+    if numpy.any(finite != numpy.round(finite)):
+        return ser
+    return ser.astype('Int64')
+
+
+def classify_rows(df):
+    """Return an array with the level (an index into `ROW_LEVELS`) of
+    each row in a State/County DataFrame."""
+    is_national = (df['State'] == 'National').values
+    is_state_total = (df['County'] == 'STATE TOTAL').values
+    state_size = df.groupby('State')['State'].transform('size').values
+    is_single_row_state = (state_size == 1) & is_state_total & ~is_national
+
+    levels = numpy.full(df.shape[0], LEVEL_COUNTY, dtype=numpy.int8)
+    levels[is_state_total] = LEVEL_STATE_TOTAL
+    levels[is_single_row_state] = LEVEL_SINGLE_ROW_STATE
+    levels[is_national] = LEVEL_NATIONAL
+    return levels
+
+
+@functools.lru_cache(maxsize=None)
+def _feature_cols():
+    """Build the feature columns of `CmsGeoVarCountyTable.return_feature_cols`
+    (once, as a tuple)."""
+
+    #===========================================
+    # Demographics features
+    #===========================================
+    demographics = [
+        'MA Participation Rate',
+        'Average Age',
+        'Percent Female',
+        'Percent Male',
+        'Percent Eligible for Medicaid',
+        'Average HCC Score',
+    ]
+
+    #===========================================
+    # Total Cost features
+    #===========================================
+    total_costs = [
+        'Actual Per Capita Costs',
+        'Standardized Per Capita Costs',
+        'Standardized Risk-Adjusted Per Capita Costs',
+    ]
+
+    #===========================================
+    # Service-Level Costs and Utilization
+    #===========================================
+    slcu_dict = {}
+
+    # All categories have these columns
+    #===========================================
+    slcu_categories = [
+        'IP', 'PAC: LTCH', 'PAC: IRF', 'PAC: SNF', 'PAC: HH',
+        'Hospice', 'OP', 'FQHC/RHC', 'Outpatient Dialysis Facility',
+        'ASC', 'E&M', 'Procedures', 'Imaging', 'DME', 'Tests',
+        'Part B Drugs', 'Ambulance']
+    slcu_lines = [
+        '{} Standardized Costs as % of Total Standardized Costs',
+        '{} Per Capita Standardized Costs',
+        '{} Per User Standardized Costs',
+        '% of Beneficiaries Using {}',
+    ]
+
+    for cat in slcu_categories:
+        cols = [line.format(cat) for line in slcu_lines]
+        slcu_dict[cat] = cols
+
+    # Covered Stays
+    #===========================================
+    slcu_categories = ['IP', 'PAC: LTCH', 'PAC: IRF', 'PAC: SNF', 'Hospice']
+    slcu_line = '{} Covered Stays Per 1000 Beneficiaries'
+    for cat in slcu_categories:
+        slcu_dict[cat].append(slcu_line.format(cat))
+
+    # Covered Days
+    #===========================================
+    slcu_categories = ['IP', 'PAC: LTCH', 'PAC: IRF', 'PAC: SNF', 'Hospice']
+    slcu_line = '{} Covered Days Per 1000 Beneficiaries'
+    for cat in slcu_categories:
+        slcu_dict[cat].append(slcu_line.format(cat))
+
+    # Visits
+    #===========================================
+    slcu_categories = ['PAC: HH', 'OP', 'FQHC/RHC']
+    slcu_line = '{} Visits Per 1000 Beneficiaries'
+    for cat in slcu_categories:
+        slcu_dict[cat].append(slcu_line.format(cat))
+
+    # Events
+    #===========================================
+    slcu_categories = [
+        'Outpatient Dialysis Facility', 'ASC', 'E&M',
+        'Procedures', 'Imaging', 'DME', 'Tests', 'Ambulance']
+    slcu_line = '{} Events Per 1000 Beneficiaries'
+    for cat in slcu_categories:
+        slcu_dict[cat].append(slcu_line.format(cat))
+
+    # fix plurality
+    slcu_dict['Procedures'][-1] = (
+        slcu_dict['Procedures'][-1].replace('Procedures', 'Procedure'))
+    slcu_dict['Tests'][-1] = (
+        slcu_dict['Tests'][-1].replace('Tests', 'Test'))
+
+    #===========================================
+    # Readmissions and ED Visits
+    #===========================================
+    readmission_ed = [
+        'Hospital Readmission Rate',
+        'Emergency Department Visits per 1000 Beneficiaries',
+    ]
+
+    #===========================================
+    # Combine all into a list of  feature columns
+    #===========================================
+    feature_cols = []
+    feature_cols += demographics
+    feature_cols += total_costs
+    # Service-Level Costs and Utilization
+    feature_cols += slcu_dict['IP']
+    feature_cols += slcu_dict['PAC: LTCH']
+    feature_cols += slcu_dict['PAC: IRF']
+    feature_cols += slcu_dict['PAC: SNF']
+    feature_cols += slcu_dict['PAC: HH']
+    feature_cols += slcu_dict['Hospice']
+    feature_cols += slcu_dict['OP']
+    feature_cols += slcu_dict['FQHC/RHC']
+    feature_cols += slcu_dict['Outpatient Dialysis Facility']
+    feature_cols += slcu_dict['ASC']
+    feature_cols += slcu_dict['E&M']
+    feature_cols += slcu_dict['Procedures']
+    feature_cols += slcu_dict['Imaging']
+    feature_cols += slcu_dict['DME']
+    feature_cols += slcu_dict['Tests']
+    feature_cols += slcu_dict['Part B Drugs']
+    feature_cols += slcu_dict['Ambulance']
+    # Readmissions and ED visits
+    feature_cols += readmission_ed
+
+    return tuple(feature_cols)
 
 
 class CmsGeoVarCountyTable:
-    """Class to handle Geographic Variation Public Use Files (State/County)"""
+    """Class to handle Geographic Variation Public Use Files (State/County)
+
+    When the table is loaded every row is classified once (see
+    `classify_rows`) and the rows of `self.df` are sorted by level and then
+    by state.  The original index labels are kept.  Offsets for each level
+    and for each state within a level are stored so that `select_rows`
+    returns a slice instead of scanning the whole table.
 
+    `feature_matrix` returns the feature columns of a selection of rows as
+    one array.  The positions of the feature columns are looked up once and
+    the last `FEATURE_MATRIX_CACHE_SIZE` results are kept.
 
-    def __init__(self, csv_fname=DEFAULT_CSV_FNAME, verbose=False):
+    Rows can be looked up by state (abbreviation or full name), by (state,
+    county) and by FIPS code with `locate_states`, `locate_counties` and
+    `locate_fips`.  These take lists of keys and resolve all of them with
+    one hash table lookup.  The hash tables are built on first use.
+    """
+
+
+    def __init__(self, csv_fname=DEFAULT_CSV_FNAME, verbose=False,
+                 columns=None, schema=True, use_cache=True, cache_dir=None,
+                 cache_max_bytes=DEFAULT_MAX_BYTES):
         """Initialize class with a CSV file name, it is read into a DataFrame.
+
+        The parsed (and level sorted) frame is kept in an on-disk cache (see
+        `frame_cache.py`) so later constructions memory map it instead of
+        parsing the CSV again.
+
+        Args:
+          csv_fname (str): name of CSV file
+          verbose (bool): print extra information
+          columns (str or list of str): columns to load in addition to
+            'State' and 'County'.  None loads all columns and 'features'
+            loads the columns in `return_feature_cols`.
+          schema (bool): apply the declared dtypes (see `read_county_csv`)
+          use_cache (bool): set to False to bypass the parse cache
+          cache_dir (str): cache directory (default is a '.gvct_cache'
+            directory next to the CSV file)
+          cache_max_bytes (int): size limit of the cache directory
         """
         self.verbose = verbose
+        self._feature_positions = None
+        self._feature_matrices = OrderedDict()
+        self._lookup_indexes = {}
         if self.verbose: print('csv fname: {}'.format(csv_fname))
-        self.df = pandas.read_csv(csv_fname)
+        if columns == 'features':
+            columns = self.return_feature_cols()
+
+        cache = None
+        if use_cache:
+            if cache_dir is None:
+                cache_dir = os.path.join(
+                    os.path.dirname(csv_fname), DEFAULT_CACHE_DIRNAME)
+            cache = FrameCache(cache_dir, cache_max_bytes, verbose=verbose)
+            variant = json.dumps({'columns': columns, 'schema': schema})
+            with profiling.stage('table load: cache') as st:
+                cached = cache.load(csv_fname, variant)
+                if cached is not None:
+                    self.df, offsets = cached
+                    self._set_offsets(offsets)
+                    st.add_rows(self.df.shape[0])
+            if cached is not None:
+                return
+
+        with profiling.stage('table load: csv') as st:
+            df = read_county_csv(csv_fname, columns=columns, schema=schema)
+            self._build_level_index(df)
+            st.add_rows(df.shape[0])
+        if cache is not None:
+            with profiling.stage('table load: cache store'):
+                cache.store(csv_fname, self.df, variant, extra={
+                    'level_offsets': self.level_offsets,
+                    'state_offsets': self.state_offsets,
+                })
+
+
+    def _set_offsets(self, offsets):
+        """Set the level and state offsets from their JSON form."""
+        self.level_offsets = {
+            level: tuple(bounds)
+            for level, bounds in offsets['level_offsets'].items()}
+        self.state_offsets = {
+            level: {state: tuple(bounds) for state, bounds in states.items()}
+            for level, states in offsets['state_offsets'].items()}
+
 
+    def _build_level_index(self, df):
+        """Sort `df` by (level, state) and record the level/state offsets.
 
+        Sets `self.df`, `self.level_offsets` (level -> (start, stop)) and
+        `self.state_offsets` (level -> {state -> (start, stop)}).
+        """
+        levels = classify_rows(df)
+        state_codes, states = pandas.factorize(df['State'], sort=True)
+        order = numpy.lexsort((state_codes, levels))
+        self.df = df.take(order)
+
+        levels = levels[order]
+        state_codes = state_codes[order]
+        bounds = numpy.searchsorted(levels, numpy.arange(len(ROW_LEVELS)+1))
+        self.level_offsets = {}
+        self.state_offsets = {}
+        for ilevel, level in enumerate(ROW_LEVELS):
+            start, stop = int(bounds[ilevel]), int(bounds[ilevel+1])
+            self.level_offsets[level] = (start, stop)
+            self.state_offsets[level] = {}
+            codes = state_codes[start:stop]
+            change = numpy.flatnonzero(numpy.diff(codes)) + 1
+            starts = numpy.concatenate([[0], change])
+            stops = numpy.concatenate([change, [len(codes)]])
+            for a, b in zip(starts, stops):
+                if b > a:
+                    state = states[codes[a]]
+                    self.state_offsets[level][state] = (
+                        start + int(a), start + int(b))
+
+
+    @profiling.profiled('select_rows', rows=profiling.row_count)
     def select_rows(self, level, exclude=None):
         """Return a selection of rows from the total DataFrame.
 
@@ -63,8 +444,8 @@ class CmsGeoVarCountyTable:
 
     def _select_national_row(self):
         """Select row that represents the national total."""
-        bmask = self.df['State']=='National'
-        return self.df[bmask].iloc[0]
+        start, stop = self.level_offsets['national']
+        return self.df.iloc[start]
 
 
     def _select_state_rows(self, exclude=None):
@@ -73,12 +454,11 @@ class CmsGeoVarCountyTable:
         By default state abbreviations 'XX', 'DC', 'PR', and 'VI' will be
         included.  The `exclude` keyword can be set to a list of strings
         to remove a set of state abbreviations from the return value.
+
+        States with county level data come first (sorted by abbreviation)
+        followed by the states that only have a single row.
         """
-        if exclude is None:
-            exclude = []
-        bmask = self.df['County'] == 'STATE TOTAL'
-        bmask = bmask & ~(self.df['State'].isin(exclude))
-        return self.df[bmask]
+        return self.df.iloc[self._state_positions(exclude)]
 
 
     def _select_county_rows(self, exclude=None):
@@ -90,183 +470,768 @@ class CmsGeoVarCountyTable:
 
         Note that some states don't have county level data ('XX', 'PR', VI').
         In that case the return value will contain the single state total row.
+        These rows come first followed by the counties sorted by state.
         """
-        if exclude is None:
-            exclude = []
+        return self.df.iloc[self._county_positions(exclude)]
+
+
+    def _row_positions(self, level, exclude=None):
+        """Return the positions of the rows of `level` in `self.df` (a
+        slice if no rows are excluded)."""
+        if level == 'national':
+            start, stop = self.level_offsets['national']
+            return slice(start, start + 1)
+        elif level == 'state':
+            return self._state_positions(exclude)
+        elif level == 'county':
+            return self._county_positions(exclude)
+
+
+    def _state_positions(self, exclude=None):
+        """Return the positions of the state rows, see `_select_state_rows`."""
+        start = self.level_offsets['state_total'][0]
+        stop = self.level_offsets['single_row_state'][1]
+        if not exclude:
+            return slice(start, stop)
+
+        drop = []
+        for level in ['state_total', 'single_row_state']:
+            for state in exclude:
+                if state in self.state_offsets[level]:
+                    drop.append(self.state_offsets[level][state])
+        keep = numpy.ones(stop-start, dtype=bool)
+        for a, b in drop:
+            keep[a-start:b-start] = False
+        return numpy.flatnonzero(keep) + start
+
+
+    def _county_positions(self, exclude=None):
+        """Return the positions of the county rows, see
+        `_select_county_rows`."""
+        start = self.level_offsets['single_row_state'][0]
+        stop = self.level_offsets['county'][1]
+        if not exclude:
+            return slice(start, stop)
+        counties = self.df['County'].iloc[start:stop]
+        return numpy.flatnonzero(~counties.isin(exclude).values) + start
+
+
+    @profiling.profiled(
+        'feature_matrix', rows=lambda result: result.values.shape[0])
+    def feature_matrix(self, level='county', exclude=None, max_nan_frac=1.0,
+                       dtype=numpy.float64):
+        """Return the feature columns of a selection of rows as one array.
+
+        The rows are the ones returned by `select_rows` and the columns are
+        the ones in `return_feature_cols` that are in the table, minus those
+        with more than `max_nan_frac` missing values in the selected rows.
+        The result is a C-contiguous array.
+
+        Results are memoized per argument set (the least recently used of
+        `FEATURE_MATRIX_CACHE_SIZE` results is dropped first), so the array
+        is read-only.  Copy it to modify it.
+
+        Args:
+          level (str): one of ['national', 'state', 'county']
+          exclude (list of str): states or counties to exclude, see
+            `select_rows`
+          max_nan_frac (float): drop columns with a larger fraction of
+            missing values
+          dtype: numpy.float32 or numpy.float64
+
+        Returns:
+          FeatureMatrix: the array with its row labels, column names and the
+            fraction of missing values in each column
+        """
+        if level not in VALID_LEVELS:
+            raise ValueError('level must be one of {}'.format(VALID_LEVELS))
+        dtype = numpy.dtype(dtype)
+        if dtype not in FEATURE_MATRIX_DTYPES:
+            raise ValueError('dtype must be one of {}'.format(
+                FEATURE_MATRIX_DTYPES))
+        key = (level, tuple(sorted(exclude)) if exclude else (),
+               float(max_nan_frac), dtype.str)
+        if key in self._feature_matrices:
+            self._feature_matrices.move_to_end(key)
+            return self._feature_matrices[key]
+
+        rows = self._row_positions(level, exclude)
+        index = self.df.index[rows]
+        names, positions = self.feature_positions()
+        # pandas copies the selected rows block by block into a column major
+        # array in which the missing values are counted before the single
+        # copy into row major order
+        X = self.df.iloc[rows, positions].to_numpy(
+            dtype=dtype, na_value=numpy.nan)
+        frac_nan = numpy.isnan(X).mean(axis=0) if len(index) > 0 else (
+            numpy.zeros(len(names)))
+        keep = frac_nan <= max_nan_frac
+        if not keep.all():
+            X = X.T[keep].T
+        X = numpy.ascontiguousarray(X)
+        X.flags.writeable = False
+        result = FeatureMatrix(
+            values=X,
+            index=index,
+            columns=[name for name, k in zip(names, keep) if k],
+            frac_nan=frac_nan[keep],
+        )
+        self._feature_matrices[key] = result
+        if len(self._feature_matrices) > FEATURE_MATRIX_CACHE_SIZE:
+            self._feature_matrices.popitem(last=False)
+        return result
+
+
+    def feature_positions(self):
+        """Return (names, positions) of the feature columns in `self.df`.
+
+        Feature columns that are not in the table are left out.  The lookup
+        is done once per table.
+        """
+        if self._feature_positions is None:
+            names = [
+                col for col in self.return_feature_cols()
+                if col in self.df.columns]
+            positions = self.df.columns.get_indexer(names)
+            self._feature_positions = (names, positions)
+        return self._feature_positions
+
+
+    def locate_states(self, states):
+        """Return the position in `self.df` of the state total row of each
+        state (-1 for unknown states).
+
+        Args:
+          states (list of str): abbreviations or full names (case
+            insensitive), 'National' gives the National row
+
+        Returns:
+          array of int: one position per state
+        """
+        codes = self._state_codes(states)
+        positions = self._lookup_index('state').positions
+        return numpy.where(codes >= 0, positions[codes], -1)
+
+
+    def locate_counties(self, states, counties):
+        """Return the position in `self.df` of each (state, county) pair
+        (-1 if it isn't in the table).
+
+        Args:
+          states (list of str): abbreviations or full names of the states
+          counties (list of str): county names (case insensitive), e.g.
+            'STATE TOTAL' gives the state total row
+
+        Returns:
+          array of int: one position per pair
+        """
+        state_codes = self._state_codes(states)
+        names = self._lookup_index('county_names')
+        name_codes = _upper_codes(counties, names)
+        keys = state_codes * names.keys.size + name_codes
+        keys[(state_codes < 0) | (name_codes < 0)] = -1
+        return self._lookup_index('county').get_indexer(keys)
+
+
+    def locate_fips(self, codes):
+        """Return the position in `self.df` of the row with each FIPS code
+        (-1 if it isn't in the table).
+
+        Args:
+          codes (list of str or int): five digit state and county FIPS
+            codes, e.g. '01001' or 1001
+
+        Returns:
+          array of int: one position per code
+        """
+        if FIPS_COL not in self.df.columns:
+            raise KeyError('table has no {!r} column'.format(FIPS_COL))
+        index = self._lookup_index('fips')
+        return index.get_indexer(_fips_keys(codes))
+
 
-        # get states that only have state level data
-        grpd_df = self.df.groupby('State').size()
-        single_row_states = grpd_df[grpd_df==1].index.tolist()
-        single_row_states.remove('National')
+    def select_state(self, state, level='county'):
+        """Return the rows of one state at `level` ('state' for its total
+        row, 'county' for its counties).  States without counties return
+        their single row for both levels."""
+        positions = self.locate_states([state])
+        if positions[0] < 0:
+            raise KeyError(state)
+        abbr = self.df['State'].iloc[positions[0]]
+        row_levels = {
+            'state': ['state_total', 'single_row_state'],
+            'county': ['single_row_state', 'county'],
+        }[level]
+        for row_level in row_levels:
+            if abbr in self.state_offsets[row_level]:
+                start, stop = self.state_offsets[row_level][abbr]
+                return self.df.iloc[start:stop]
+        return self.df.iloc[0:0]
 
-        # is a single row state
-        bmask1 = self.df['State'].isin(single_row_states)
-        # is not a single row state and is not a state total
-        bmask2 = ~bmask1 & (self.df['County'] != 'STATE TOTAL')
-        # is not a national total
-        bmask3 = self.df['State'] != 'National'
-        # is not in county exclude list
-        bmask4 = ~(self.df['County'].isin(exclude))
 
-        bmask = (bmask1 | bmask2) & bmask3 & bmask4
-        return self.df[bmask]
+    def _state_codes(self, states):
+        """Return the position of each state in the 'state' lookup index
+        (-1 for unknown states)."""
+        if isinstance(states, str):
+            raise TypeError('states must be a list of str')
+        return _upper_codes(states, self._lookup_index('state_names'))
 
 
-    def return_feature_cols(self):
+    def _lookup_index(self, name):
+        """Return (and build on first use) one of the lookup hash tables.
+
+        'state': State -> position of its total row,
+        'state_names': upper case State, abbreviation or full name -> state
+          code,
+        'county_names': upper case county name -> county name code,
+        'county': state code * number of county names + county name code
+          -> position
+
+        The codes are positions in the keys of the 'state' and
+        'county_names' indexes.
+        """
+        if name in self._lookup_indexes:
+            return self._lookup_indexes[name]
+
+        if name == 'state':
+            keys, positions = [], []
+            for level in ['national', 'state_total', 'single_row_state']:
+                for state, (start, stop) in self.state_offsets[level].items():
+                    keys.append(state)
+                    positions.append(start)
+            index = PositionIndex(keys, positions)
+        elif name == 'state_names':
+            states = list(self._lookup_index('state').keys)
+            names = {state.upper(): code for code, state in enumerate(states)}
+            for abbr, full_name in us_states.STATES.items():
+                if abbr in states:
+                    names.setdefault(full_name.upper(), states.index(abbr))
+            index = PositionIndex(list(names), list(names.values()))
+        elif name == 'county_names':
+            names = self.df['County'].astype(str).str.upper().unique()
+            index = PositionIndex(names, numpy.arange(len(names)))
+        elif name == 'county':
+            state_codes = self._state_codes(self.df['State'].astype(str))
+            names = self._lookup_index('county_names')
+            name_codes = _upper_codes(self.df['County'].astype(str), names)
+            keys = state_codes * names.keys.size + name_codes
+            index = PositionIndex(keys, numpy.arange(len(keys)))
+        elif name == 'fips':
+            keys = _fips_keys(self.df[FIPS_COL])
+            valid = numpy.flatnonzero(pandas.notnull(keys))
+            index = PositionIndex(keys[valid], valid)
+        self._lookup_indexes[name] = index
+        return index
+
+
+    @staticmethod
+    def return_feature_cols():
         """Return a list of column names that could be plausible features
         for a learning model.  For example we choose 'standardized' and
         'per capita' type columns.
+
+        The list is built once, each call returns a new copy of it.
         """
+        return list(_feature_cols())
 
-        #===========================================
-        # Demographics features
-        #===========================================
-        demographics = [
-            'MA Participation Rate',
-            'Average Age',
-            'Percent Female',
-            'Percent Male',
-            'Percent Eligible for Medicaid',
-            'Average HCC Score',
-        ]
-
-        #===========================================
-        # Total Cost features
-        #===========================================
-        total_costs = [
-            'Actual Per Capita Costs',
-            'Standardized Per Capita Costs',
-            'Standardized Risk-Adjusted Per Capita Costs',
-        ]
-
-        #===========================================
-        # Service-Level Costs and Utilization
-        #===========================================
-        slcu_dict = {}
-
-        # All categories have these columns
-        #===========================================
-        slcu_categories = [
-            'IP', 'PAC: LTCH', 'PAC: IRF', 'PAC: SNF', 'PAC: HH',
-            'Hospice', 'OP', 'FQHC/RHC', 'Outpatient Dialysis Facility',
-            'ASC', 'E&M', 'Procedures', 'Imaging', 'DME', 'Tests',
-            'Part B Drugs', 'Ambulance']
-        slcu_lines = [
-            '{} Standardized Costs as % of Total Standardized Costs',
-            '{} Per Capita Standardized Costs',
-            '{} Per User Standardized Costs',
-            '% of Beneficiaries Using {}',
-        ]
-
-        for cat in slcu_categories:
-            cols = [line.format(cat) for line in slcu_lines]
-            slcu_dict[cat] = cols
-
-        # Covered Stays
-        #===========================================
-        slcu_categories = ['IP', 'PAC: LTCH', 'PAC: IRF', 'PAC: SNF', 'Hospice']
-        slcu_line = '{} Covered Stays Per 1000 Beneficiaries'
-        for cat in slcu_categories:
-            slcu_dict[cat].append(slcu_line.format(cat))
-
-        # Covered Days
-        #===========================================
-        slcu_categories = ['IP', 'PAC: LTCH', 'PAC: IRF', 'PAC: SNF', 'Hospice']
-        slcu_line = '{} Covered Days Per 1000 Beneficiaries'
-        for cat in slcu_categories:
-            slcu_dict[cat].append(slcu_line.format(cat))
-
-        # Visits
-        #===========================================
-        slcu_categories = ['PAC: HH', 'OP', 'FQHC/RHC']
-        slcu_line = '{} Visits Per 1000 Beneficiaries'
-        for cat in slcu_categories:
-            slcu_dict[cat].append(slcu_line.format(cat))
-
-        # Events
-        #===========================================
-        slcu_categories = [
-            'Outpatient Dialysis Facility', 'ASC', 'E&M',
-            'Procedures', 'Imaging', 'DME', 'Tests', 'Ambulance']
-        slcu_line = '{} Events Per 1000 Beneficiaries'
-        for cat in slcu_categories:
-            slcu_dict[cat].append(slcu_line.format(cat))
-
-        # fix plurality
-        slcu_dict['Procedures'][-1] = (
-            slcu_dict['Procedures'][-1].replace('Procedures', 'Procedure'))
-        slcu_dict['Tests'][-1] = (
-            slcu_dict['Tests'][-1].replace('Tests', 'Test'))
-
-        #===========================================
-        # Readmissions and ED Visits
-        #===========================================
-        readmission_ed = [
-            'Hospital Readmission Rate',
-            'Emergency Department Visits per 1000 Beneficiaries',
-        ]
-
-        #===========================================
-        # Combine all into a list of  feature columns
-        #===========================================
-        feature_cols = []
-        feature_cols += demographics
-        feature_cols += total_costs
-        # Service-Level Costs and Utilization
-        feature_cols += slcu_dict['IP']
-        feature_cols += slcu_dict['PAC: LTCH']
-        feature_cols += slcu_dict['PAC: IRF']
-        feature_cols += slcu_dict['PAC: SNF']
-        feature_cols += slcu_dict['PAC: HH']
-        feature_cols += slcu_dict['Hospice']
-        feature_cols += slcu_dict['OP']
-        feature_cols += slcu_dict['FQHC/RHC']
-        feature_cols += slcu_dict['Outpatient Dialysis Facility']
-        feature_cols += slcu_dict['ASC']
-        feature_cols += slcu_dict['E&M']
-        feature_cols += slcu_dict['Procedures']
-        feature_cols += slcu_dict['Imaging']
-        feature_cols += slcu_dict['DME']
-        feature_cols += slcu_dict['Tests']
-        feature_cols += slcu_dict['Part B Drugs']
-        feature_cols += slcu_dict['Ambulance']
-        # Readmissions and ED visits
-        feature_cols += readmission_ed
-
-
-        return feature_cols
-
-
-def check_state_totals_sum_to_national(df_state_totals, ser_national):
-    """Check that summing the state level rows recovers the national total"""
-    state_sum = df_state_totals['Total Actual Costs'].sum()
-    national_total = ser_national['Total Actual Costs']
-    print('state sum vs national total')
-    print('state sum: {}'.format(state_sum))
-    print('national: {}'.format(national_total))
-    print(state_sum/national_total)
-    print()
 
+class PositionIndex:
+    """Hash table from keys to row positions with a vectorized lookup.
 
-def check_county_totals_sum_to_national(df_county_totals, ser_national):
-    """Check that summing the county level rows recovers the national total"""
-    county_sum = df_county_totals['Total Actual Costs'].sum()
-    national_total = ser_national['Total Actual Costs']
-    print('county sum vs national total')
-    print('county sum: {}'.format(county_sum))
-    print('national: {}'.format(national_total))
-    print(county_sum/national_total)
-    print()
+    The keys are held in a pandas Index, so `get_indexer` resolves a whole
+    list of keys with one hash table lookup.  Only the first position of a
+    duplicated key is kept.
+    """
+
+
+    def __init__(self, keys, positions):
+        keys = pandas.Index(keys)
+        unique = ~keys.duplicated()
+        self.keys = keys[unique]
+        self.positions = numpy.asarray(positions)[unique]
+
+
+    def get_indexer(self, keys):
+        """Return the position of every key (-1 for unknown keys)."""
+        ikeys = self.keys.get_indexer(keys)
+        return numpy.where(ikeys >= 0, self.positions[ikeys], -1)
+
+
+def _upper_codes(values, index):
+    """Look up the upper case of string values in a `PositionIndex` (-1 for
+    missing values).  Each distinct value is converted only once."""
+    codes, uniques = pandas.factorize(
+        pandas.Series(list(values), dtype=object))
+    upper = pandas.Series(uniques, dtype=object).str.strip().str.upper()
+    found = index.get_indexer(upper.values)
+    return numpy.where(codes >= 0, found[codes], -1)
+
+
+def _fips_keys(codes):
+    """Return FIPS codes as five character strings (None for missing or
+    malformed codes).
+
+    Codes can be strings ('01001') or numbers (1001 or 1001.0, e.g. from a
+    table read without the schema)."""
+    numbers = pandas.to_numeric(pandas.Series(list(codes)), errors='coerce')
+    valid = numbers.notnull().values
+    keys = numpy.full(len(numbers), None, dtype=object)
+    keys[valid] = numbers[valid].astype('int64').astype(str).str.zfill(5)
+    return keys
+
+
+class CmsGeoVarCountyPanel:
+    """Class to handle all years of the State/County table as one panel.
+
+    The yearly CSV files (`County_All_Table_20XX.csv`, see `get_data.sh`)
+    are discovered in a data directory but nothing is parsed until it is
+    needed.  Only the requested years and columns are read (concurrently,
+    one thread per file) and every column that has been read is kept so
+    later requests only parse what is missing.  Frames are returned with a
+    (year, State, County) index.
+    """
+
+
+    def __init__(self, data_dir=DEFAULT_DATA_DIR, years=None,
+                 max_workers=None, verbose=False):
+        """Initialize class with the directory holding the yearly CSVs.
+
+        Args:
+          data_dir (str): directory to search for yearly CSV files
+          years (list of int): restrict the panel to these years
+          max_workers (int): number of threads used to read files
+          verbose (bool): print file names as they are read
+        """
+        self.verbose = verbose
+        self.max_workers = max_workers
+        self.csv_fnames = discover_csv_fnames(data_dir)
+        if years is not None:
+            missing = set(years) - set(self.csv_fnames)
+            if missing:
+                raise ValueError('no CSV files for years {}'.format(
+                    sorted(missing)))
+            self.csv_fnames = {year: self.csv_fnames[year] for year in years}
+        self.years = sorted(self.csv_fnames)
+        self._frames = {}
+        self._levels = {}
+        self._header = {}
+
+
+    def table(self, year):
+        """Return a `CmsGeoVarCountyTable` for a single year."""
+        return CmsGeoVarCountyTable(
+            self.csv_fnames[year], verbose=self.verbose)
+
+
+    def frame(self, columns=None, years=None, level=None):
+        """Return a DataFrame with a (year, State, County) index.
+
+        Args:
+          columns (list of str): columns to return (default is all columns).
+            Columns that are missing in some years are filled with NaN.
+          years (list of int): years to return (default is all years)
+          level (str): if given, one of ['national', 'state', 'county']
+            with the same meaning as in `CmsGeoVarCountyTable.select_rows`
+
+        Returns:
+          DataFrame: selected rows and columns for the selected years
+        """
+        if level is not None and level not in VALID_LEVELS:
+            raise ValueError('level must be one of {}'.format(VALID_LEVELS))
+        if years is None:
+            years = self.years
+        if columns is not None:
+            columns = [col for col in columns if col not in KEY_COLS]
+        self._load(years, columns)
+
+        frames = []
+        for year in years:
+            df = self._frames[year]
+            if columns is not None:
+                df = df.reindex(columns=columns)
+            if level is not None:
+                df = df[numpy.isin(self._levels[year], LEVEL_ROWS[level])]
+            frames.append(df)
+        return pandas.concat(frames, keys=years, names=['year'])
+
+
+    def year_over_year(self, columns, years=None, level='county',
+                       periods=1, pct=False):
+        """Return the change in each column relative to `periods` years
+        earlier for every (State, County).
+
+        Rows are matched on the (State, County) labels of the exact earlier
+        year, so a county missing from a year gets NaN rather than being
+        compared with the wrong year.
+
+        Args:
+          columns (list of str): columns to compare
+          years (list of int): years to return changes for.  The earlier
+            years needed for the comparison are loaded as well.
+          level (str): rows to select, see `frame`
+          periods (int): number of years to look back
+          pct (bool): return fractional instead of absolute changes
+
+        Returns:
+          DataFrame: changes with a (year, State, County) index
+        """
+        if years is None:
+            years = self.years
+        load_years = sorted(
+            set(years) |
+            set(y - periods for y in years if y - periods in self.csv_fnames))
+        df = self.frame(columns=columns, years=load_years, level=level)
+        prev = df.rename(index=lambda year: year + periods, level='year')
+        prev = prev[~prev.index.duplicated()].reindex(df.index)
+        change = df - prev
+        if pct:
+            change = change / prev
+        return change.loc[list(years)]
+
+
+    def multi_year_features(self, columns, years=None, level='county',
+                            stats=('mean', 'std', 'min', 'max')):
+        """Return statistics of each column across years for every
+        (State, County).
+
+        Args:
+          columns (list of str): columns to summarize
+          years (list of int): years to include (default is all years)
+          level (str): rows to select, see `frame`
+          stats (sequence of str): aggregations understood by
+            `DataFrame.agg`
+
+        Returns:
+          DataFrame: one row per (State, County) with (column, stat)
+            columns
+        """
+        df = self.frame(columns=columns, years=years, level=level)
+        return df.groupby(level=['State', 'County']).agg(list(stats))
+
+
+    def _load(self, years, columns):
+        """Read the columns (default all) of the given years that are not
+        loaded yet."""
+        todo = {}
+        for year in years:
+            if year not in self.csv_fnames:
+                raise ValueError('no CSV file for year {}'.format(year))
+            missing = self._missing_columns(year, columns)
+            if year not in self._frames or missing:
+                todo[year] = missing
+        if not todo:
+            return
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                year: executor.submit(self._read_csv, year, missing)
+                for year, missing in todo.items()}
+            for year, future in futures.items():
+                df = future.result()
+                if year not in self._levels:
+                    self._levels[year] = classify_rows(df)
+                df = df.set_index(['State', 'County'])
+                if year in self._frames:
+                    df = pandas.concat([self._frames[year], df], axis=1)
+                self._frames[year] = df
+
+
+    def _missing_columns(self, year, columns):
+        """Return the requested columns of a year that are not loaded yet
+        (None means all columns)."""
+        if year not in self._header:
+            self._header[year] = pandas.read_csv(
+                self.csv_fnames[year], nrows=0).columns.tolist()
+        header = self._header[year]
+        if columns is None:
+            columns = header
+        available = [col for col in columns
+                     if col in header and col not in KEY_COLS]
+        if year not in self._frames:
+            return available
+        loaded = self._frames[year].columns
+        return [col for col in available if col not in loaded]
+
+
+    def _read_csv(self, year, columns):
+        """Read the key columns plus `columns` from a yearly CSV."""
+        csv_fname = self.csv_fnames[year]
+        if self.verbose: print('csv fname: {}'.format(csv_fname))
+        return read_county_csv(csv_fname, columns=columns)
+
+
+def discover_csv_fnames(data_dir=DEFAULT_DATA_DIR):
+    """Return a dictionary of year -> CSV file name for every yearly
+    State/County CSV file in `data_dir`."""
+    csv_fnames = {}
+    for fname in os.listdir(data_dir):
+        match = CSV_FNAME_REGEX.match(fname)
+        if match:
+            csv_fnames[int(match.group(1))] = os.path.join(data_dir, fname)
+    return csv_fnames
+
+
+def memory_usage_report(csv_fname=DEFAULT_CSV_FNAME):
+    """Compare parse time and memory of different ways to load a table.
+
+    Peak memory is measured with `tracemalloc` which sees the arrays
+    allocated by numpy/pandas but not the internal buffers of the CSV
+    parser.
+
+    Returns:
+      DataFrame: one row per loading mode with parse time [s], size of the
+        resulting frame [MB] and traced peak memory [MB]
+    """
+    modes = [
+        ('all columns, inferred dtypes', dict(columns=None, schema=False)),
+        ('all columns, schema dtypes', dict(columns=None, schema=True)),
+        ('features, schema dtypes', dict(columns='features', schema=True)),
+    ]
+    rows = []
+    for name, kwargs in modes:
+        tracemalloc.start()
+        t1 = time.time()
+        gvct = CmsGeoVarCountyTable(csv_fname, use_cache=False, **kwargs)
+        t2 = time.time()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        rows.append({
+            'mode': name,
+            'parse_seconds': t2-t1,
+            'frame_mb': gvct.df.memory_usage(deep=True).sum() / 2**20,
+            'peak_mb': peak / 2**20,
+        })
+    return pandas.DataFrame(rows).set_index('mode')
+
+
+def additive_cols(columns):
+    """Return the columns (in order) that hold totals, see `is_additive_col`.
+    """
+    return [col for col in columns if is_additive_col(col)]
+
+
+def reconcile_totals(df, columns=None, rtol=DEFAULT_RTOL, atol=DEFAULT_ATOL,
+                     only_failures=True, year=0):
+    """Check that totals add up through the State/County hierarchy.
+
+    All additive columns are checked at once with a single grouped sum.
+    Three checks are made,
+
+      - 'county_to_state': counties vs. their state total row
+      - 'state_to_national': state total rows vs. the National row
+      - 'county_to_national': counties (or the state total row for states
+        without counties) vs. the National row
+
+    Args:
+      df (DataFrame): State/County rows, e.g. `CmsGeoVarCountyTable.df` or
+        a `CmsGeoVarCountyPanel.frame` with a (year, State, County) index
+      columns (list of str): columns to check (default is all additive
+        columns, see `is_additive_col`)
+      rtol (float): relative tolerance (fraction of the parent value)
+      atol (float): absolute tolerance
+      only_failures (bool): only return comparisons outside the tolerance
+      year (int): year label used if `df` has no 'year' column or index
+
+    Returns:
+      DataFrame: one row per (check, year, State, column) comparison with
+        columns ['check', 'year', 'State', 'column', 'children_sum',
+        'parent_value', 'abs_diff', 'rel_diff', 'tolerance', 'ok'].
+        State is 'National' for the checks against the National row.
+        Comparisons where either side is missing are left out.
+    """
+    if columns is None:
+        columns = additive_cols(df.columns)
+    partials = _total_partials(df, columns, year)
+    return _compare_totals(partials, rtol, atol, only_failures)
+
+
+def reconcile_csv_files(csv_fnames, columns=None, rtol=DEFAULT_RTOL,
+                        atol=DEFAULT_ATOL, only_failures=True,
+                        chunksize=DEFAULT_CHUNKSIZE):
+    """Streaming version of `reconcile_totals` for many yearly CSV files.
+
+    Files are read in chunks of `chunksize` rows.  Each chunk is reduced
+    to per (role, year, State) sums which are merged into a running
+    aggregate, so memory use is bounded by the chunk size and the number
+    of states, not by the number of years or counties.
+
+    Args:
+      csv_fnames (dict): year -> CSV file name (e.g.
+        `CmsGeoVarCountyPanel.csv_fnames` or `discover_csv_fnames()`)
+      columns (list of str): columns to check (default is all additive
+        columns of each file)
+      chunksize (int): number of rows to read at a time
+
+    Returns:
+      DataFrame: same as `reconcile_totals`
+    """
+    aggregate = None
+    for year, csv_fname in sorted(csv_fnames.items()):
+        header = pandas.read_csv(csv_fname, nrows=0).columns
+        if columns is None:
+            cols = additive_cols(header)
+        else:
+            cols = [col for col in columns if col in header]
+        reader = pandas.read_csv(
+            csv_fname, usecols=KEY_COLS + cols, chunksize=chunksize,
+            dtype={col: 'float64' for col in cols})
+        for chunk in reader:
+            partials = _total_partials(chunk, cols, year)
+            if aggregate is None:
+                aggregate = partials
+            else:
+                aggregate = _merge_partials(aggregate, partials)
+    return _compare_totals(aggregate, rtol, atol, only_failures)
+
+
+def total_partials(df, columns=None, year=0):
+    """Return the per (role, year, State) sums that `reconcile_totals`
+    compares.
+
+    Partial sums of different chunks or years can be kept and compared
+    later with `reconcile_partials`, so adding a year doesn't require
+    reading the earlier years again.
+
+    Args:
+      df (DataFrame): State/County rows
+      columns (list of str): columns to sum (default is all additive
+        columns)
+      year (int): year label used if `df` has no 'year' column or index
+
+    Returns:
+      DataFrame: sums with a (role, year, State) index, where role is one
+        of ['county', 'state', 'national']
+    """
+    if columns is None:
+        columns = additive_cols(df.columns)
+    return _total_partials(df, columns, year)
+
+
+def reconcile_partials(partials, rtol=DEFAULT_RTOL, atol=DEFAULT_ATOL,
+                       only_failures=True):
+    """Compare totals from a list of partial sums (see `total_partials`).
+
+    Returns:
+      DataFrame: same as `reconcile_totals`
+    """
+    both = pandas.concat(partials)
+    aggregate = both.groupby(level=list(both.index.names)).sum(min_count=1)
+    return _compare_totals(aggregate, rtol, atol, only_failures)
+
+
+def _key_values(df, name, default=None):
+    """Return the values of a key that is either a column or an index
+    level of `df` (or `default` for every row if it is neither)."""
+    if name in df.columns:
+        return df[name].values
+    if name in df.index.names:
+        return df.index.get_level_values(name).values
+    return numpy.full(df.shape[0], default)
+
+
+def _total_partials(df, columns, year):
+    """Sum `columns` grouped by (role, year, State) where role is one of
+    ['county', 'state', 'national'].  `year` is used if `df` has no 'year'
+    column or index level."""
+    state = numpy.asarray(_key_values(df, 'State'), dtype=object)
+    county = numpy.asarray(_key_values(df, 'County'), dtype=object)
+    role = numpy.full(df.shape[0], 'county', dtype=object)
+    role[county == 'STATE TOTAL'] = 'state'
+    role[state == 'National'] = 'national'
+    keys = [
+        pandas.Index(role, name='role'),
+        pandas.Index(_key_values(df, 'year', year), name='year'),
+        pandas.Index(state, name='State'),
+    ]
+    values = df[columns].astype('float64')
+    values.index = pandas.RangeIndex(df.shape[0])
+    return values.groupby(keys).sum(min_count=1)
+
+
+def _merge_partials(first, second):
+    """Add two sets of partial sums from `_total_partials`."""
+    both = pandas.concat([first, second])
+    return both.groupby(level=list(both.index.names)).sum(min_count=1)
+
+
+def _compare_totals(partials, rtol, atol, only_failures):
+    """Turn partial sums from `_total_partials` into the comparison table
+    returned by `reconcile_totals`."""
+    columns = partials.columns.tolist()
+    roles = partials.index.get_level_values('role')
+    empty = partials.iloc[:0].droplevel('role')
+    county, state, national = [
+        partials[roles == role].droplevel('role') if (roles == role).any()
+        else empty
+        for role in ['county', 'state', 'national']]
+    national = national.groupby(level='year').sum(min_count=1)
+
+    has_counties = state.index.intersection(county.index)
+    leaves = state.copy()
+    leaves.loc[has_counties] = county.loc[has_counties]
+
+    checks = [
+        ('county_to_state',
+         county.loc[has_counties, columns],
+         state.loc[has_counties, columns]),
+        ('state_to_national',
+         state[columns].groupby(level='year').sum(min_count=1),
+         national[columns]),
+        ('county_to_national',
+         leaves[columns].groupby(level='year').sum(min_count=1),
+         national[columns]),
+    ]
+
+    tables = []
+    for check, children, parents in checks:
+        parents = parents.reindex(children.index)
+        nrows, ncols = children.shape
+        index = children.index
+        if 'State' in index.names:
+            states = index.get_level_values('State')
+        else:
+            states = ['National'] * nrows
+        tables.append(pandas.DataFrame({
+            'check': check,
+            'year': numpy.repeat(index.get_level_values('year'), ncols),
+            'State': numpy.repeat(states, ncols),
+            'column': numpy.tile(columns, nrows),
+            'children_sum': children.values.ravel(),
+            'parent_value': parents.values.ravel(),
+        }))
+    result = pandas.concat(tables, ignore_index=True)
+    result = result.dropna(subset=['children_sum', 'parent_value'])
+
+    result['abs_diff'] = (result['children_sum'] - result['parent_value']).abs()
+    result['rel_diff'] = result['abs_diff'] / result['parent_value'].abs()
+    result['tolerance'] = atol + rtol * result['parent_value'].abs()
+    result['ok'] = result['abs_diff'] <= result['tolerance']
+    if only_failures:
+        result = result[~result['ok']]
+    return result.reset_index(drop=True)
 
 
 
 if __name__ == '__main__':
 
-    fname = './data/County_All_Table_2014.csv'
-    gvct = CmsGeoVarCountyTable(fname, verbose=True)
-    st = gvct.select_rows('state')
-    ct = gvct.select_rows('county')
-    nt = gvct.select_rows('national')
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--fname',
+        type=str,
+        default=DEFAULT_CSV_FNAME,
+        help='name of geographical variation state/county file')
+    parser.add_argument(
+        '--memory-report',
+        action='store_true',
+        help='compare parse time and memory of the loading modes')
+    args = parser.parse_args()
+
+    if args.memory_report:
+        print(memory_usage_report(args.fname))
 
-    check_state_totals_sum_to_national(st, nt)
-    check_county_totals_sum_to_national(ct, nt)
+    gvct = CmsGeoVarCountyTable(args.fname, verbose=True)
+    recon = reconcile_totals(gvct.df, only_failures=False)
+    print(recon.groupby('check')['ok'].agg(['size', 'sum']))
+    print()
+    print('totals outside tolerance:')
+    print(recon[~recon['ok']].sort_values('rel_diff', ascending=False))
@@ -0,0 +1,36 @@
+"""
+Content hashes and the JSON manifests that record them.
+
+The conversion, download, refresh and outlier scripts and the parse cache
+all decide whether a file changed by its SHA-256 hash.  Only the standard
+library is imported so any of them can use these helpers cheaply.
+"""
+
+import os
+import json
+import hashlib
+
+
+def file_sha256(fname, blocksize=1 << 20):
+    """Return the hex SHA-256 digest of a file."""
+    sha = hashlib.sha256()
+    with open(fname, 'rb') as fp:
+        for block in iter(lambda: fp.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def read_manifest(manifest_fname):
+    """Read a manifest (an empty one if it doesn't exist)."""
+    if not os.path.isfile(manifest_fname):
+        return {}
+    with open(manifest_fname) as fp:
+        return json.load(fp)
+
+
+def write_manifest(manifest_fname, manifest):
+    """Atomically write a manifest."""
+    tmp_fname = manifest_fname + '.tmp'
+    with open(tmp_fname, 'w') as fp:
+        json.dump(manifest, fp, indent=2, sort_keys=True)
+    os.replace(tmp_fname, manifest_fname)
@@ -0,0 +1,347 @@
+"""
+Outlier scores for counties from a single multivariate Gaussian.
+
+The model is fitted on the dense feature columns of the county rows of
+all years, imputed and standardized like in `pca_on_dense_features.py`
+(and optionally projected onto the first principal axes).  Its mean and
+the Cholesky factor L of its covariance are computed once and cached on
+disk.  The score of a row z is the squared Mahalanobis distance
+
+    d^2 = |L^-1 (z - mean)|^2
+
+which is chi-squared distributed with one degree of freedom per model
+dimension if the rows are Gaussian.  Rows are scored in blocks with one
+triangular solve per block.
+
+`score_csv_files` keeps the scores in a CSV file and only scores the
+years that were added or changed since the last run (as long as the model
+is the same), and `score_frame` scores rows that arrive as a DataFrame.
+
+ > python outliers.py --data-dir ./data --top 20
+"""
+
+import os
+import json
+import hashlib
+import argparse
+from collections import namedtuple
+
+import numpy
+import pandas
+
+import profiling
+from geo_var_state_county import CmsGeoVarCountyTable
+from geo_var_state_county import KEY_COLS
+from geo_var_state_county import discover_csv_fnames
+from manifest import file_sha256
+from manifest import read_manifest
+from manifest import write_manifest
+from pca_on_dense_features import DEFAULT_FRAC_THRESH
+from pca_on_dense_features import column_stats
+from pca_on_dense_features import csv_feature_chunks
+from pca_on_dense_features import dense_feature_pca
+
+
+DEFAULT_BLOCK_ROWS = 4096
+DEFAULT_MODEL_FNAME = 'gvct_outlier_model.npz'
+DEFAULT_SCORES_FNAME = 'gvct_outlier_scores.csv'
+DEFAULT_RIDGE = 1.0e-8
+
+
+OutlierModel = namedtuple('OutlierModel', [
+    'feature_cols',     # dense input columns (in this order)
+    'impute_mean',      # mean of each input column (fills missing values)
+    'scale',            # standard deviation of each imputed input column
+    'axes',             # principal axes projected onto (or None)
+    'center',           # mean of the model features
+    'chol',             # lower Cholesky factor of their covariance
+    'n_samples',        # number of rows the model was fitted on
+    'sources',          # year -> SHA-256 of the CSV files it was fitted on
+])
+
+
+def model_id(model):
+    """Return a short hash that identifies the parameters of a model."""
+    sha = hashlib.sha256()
+    for arr in [model.impute_mean, model.scale, model.center, model.chol]:
+        sha.update(numpy.ascontiguousarray(arr).tobytes())
+    sha.update(json.dumps(model.feature_cols).encode())
+    return sha.hexdigest()[:16]
+
+
+def model_features(model, X):
+    """Impute, standardize and (optionally) project a block of rows with
+    one column per entry in `model.feature_cols`."""
+    Z = numpy.array(X, dtype=numpy.float64)
+    numpy.copyto(Z, model.impute_mean, where=numpy.isnan(Z))
+    Z -= model.impute_mean
+    Z /= model.scale
+    if model.axes is not None:
+        Z = Z.dot(model.axes.T)
+    return Z
+
+
+def fit_outlier_model(chunks, feature_cols, frac_thresh=DEFAULT_FRAC_THRESH,
+                      n_components=None, ridge=DEFAULT_RIDGE, sources=None):
+    """Fit the mean and covariance of the model features.
+
+    Two streaming passes are made over the chunks (three with
+    `n_components`, which fits an incremental PCA first).
+
+    Args:
+      chunks (callable): returns an iterator over 2-D arrays of rows with
+        one column per entry in `feature_cols` (see `csv_feature_chunks`)
+      feature_cols (list of str): names of the columns in each chunk
+      frac_thresh (float): columns with at least this fraction of missing
+        values are dropped
+      n_components (int): project onto this many principal axes (default
+        is to use the standardized columns)
+      ridge (float): added to the diagonal of the covariance (relative to
+        its mean) so the factorization succeeds for degenerate columns
+      sources (dict): year -> CSV hash, stored with the model
+
+    Returns:
+      OutlierModel
+    """
+    if n_components is None:
+        n_rows, frac_nan, mean, var = column_stats(chunks)
+        dense_idx = numpy.flatnonzero(frac_nan < frac_thresh)
+        impute_mean = mean[dense_idx]
+        scale = numpy.sqrt(var[dense_idx] * (1.0 - frac_nan[dense_idx]))
+        scale[scale == 0.0] = 1.0
+        axes = None
+    else:
+        result = dense_feature_pca(
+            chunks, feature_cols, frac_thresh=frac_thresh,
+            n_components=n_components)
+        dense_idx = [feature_cols.index(col) for col in result.feature_cols]
+        impute_mean = result.mean
+        scale = result.scale
+        axes = result.components[:n_components]
+    model = OutlierModel(
+        feature_cols=[feature_cols[i] for i in dense_idx],
+        impute_mean=impute_mean,
+        scale=scale,
+        axes=axes,
+        center=None,
+        chol=None,
+        n_samples=0,
+        sources=sources or {},
+    )
+
+    n_rows = 0
+    total = sumsq = None
+    with profiling.stage('outliers: fit') as st:
+        for chunk in chunks():
+            Z = model_features(model, numpy.take(chunk, dense_idx, axis=1))
+            if total is None:
+                total = numpy.zeros(Z.shape[1])
+                sumsq = numpy.zeros((Z.shape[1], Z.shape[1]))
+            total += Z.sum(axis=0)
+            sumsq += Z.T.dot(Z)
+            n_rows += Z.shape[0]
+        st.add_rows(n_rows)
+        center = total / n_rows
+        cov = (sumsq - n_rows * numpy.outer(center, center)) / (n_rows - 1)
+        cov[numpy.diag_indices_from(cov)] += (
+            ridge * numpy.trace(cov) / len(cov))
+        chol = numpy.linalg.cholesky(cov)
+    return model._replace(center=center, chol=chol, n_samples=n_rows)
+
+
+def save_outlier_model(model, fname):
+    """Write a model to an .npz file."""
+    tmp_fname = fname + '.tmp.npz'
+    numpy.savez(
+        tmp_fname,
+        feature_cols=numpy.array(model.feature_cols, dtype=str),
+        impute_mean=model.impute_mean,
+        scale=model.scale,
+        axes=model.axes if model.axes is not None else numpy.empty((0, 0)),
+        center=model.center,
+        chol=model.chol,
+        n_samples=model.n_samples,
+        sources=json.dumps(model.sources))
+    os.replace(tmp_fname, fname)
+
+
+def load_outlier_model(fname):
+    """Read a model written by `save_outlier_model`."""
+    with numpy.load(fname) as npz:
+        axes = npz['axes']
+        return OutlierModel(
+            feature_cols=npz['feature_cols'].tolist(),
+            impute_mean=npz['impute_mean'],
+            scale=npz['scale'],
+            axes=axes if axes.size else None,
+            center=npz['center'],
+            chol=npz['chol'],
+            n_samples=int(npz['n_samples']),
+            sources=json.loads(str(npz['sources'])),
+        )
+
+
+def cached_outlier_model(csv_fnames, model_fname,
+                         frac_thresh=DEFAULT_FRAC_THRESH, n_components=None,
+                         refit=False, verbose=False):
+    """Return the model cached in `model_fname`, or fit, cache and return
+    a new one if there is none (or it has a different `n_components`).
+
+    The cached model is kept when years are added or changed so new rows
+    are scored against it without refitting.  Pass `refit` to fit it on
+    the current files.
+
+    Args:
+      csv_fnames (dict): year -> CSV file name (see `discover_csv_fnames`)
+      model_fname (str): the cache file
+      frac_thresh (float): see `fit_outlier_model`
+      n_components (int): see `fit_outlier_model`
+      refit (bool): fit a new model even if one is cached
+    """
+    sources = {str(year): file_sha256(fname)
+               for year, fname in sorted(csv_fnames.items())}
+    if not refit and os.path.isfile(model_fname):
+        model = load_outlier_model(model_fname)
+        n_dims = model.axes.shape[0] if model.axes is not None else None
+        if n_dims == n_components:
+            if verbose:
+                print('using cached model: {}'.format(model_fname))
+                if model.sources != sources:
+                    print('the model was fitted on other CSV files '
+                          '(years {}), refit to update it'.format(
+                              sorted(model.sources)))
+            return model
+
+    if verbose: print('fitting model on {} years'.format(len(csv_fnames)))
+    feature_cols = CmsGeoVarCountyTable.return_feature_cols()
+    model = fit_outlier_model(
+        csv_feature_chunks(csv_fnames, feature_cols), feature_cols,
+        frac_thresh=frac_thresh, n_components=n_components, sources=sources)
+    save_outlier_model(model, model_fname)
+    return model
+
+
+def mahalanobis_sq(model, X, block_rows=DEFAULT_BLOCK_ROWS):
+    """Return the squared Mahalanobis distance of every row of `X` (with
+    one column per entry in `model.feature_cols`).
+
+    Each block of rows is solved against the Cholesky factor at once.
+    """
+    from scipy.linalg import solve_triangular
+
+    d2 = numpy.empty(X.shape[0])
+    with profiling.stage('outliers: score', rows=X.shape[0]):
+        for start in range(0, X.shape[0], block_rows):
+            Z = model_features(model, X[start:start+block_rows])
+            Z -= model.center
+            W = solve_triangular(
+                model.chol, Z.T, lower=True, check_finite=False)
+            d2[start:start+block_rows] = numpy.einsum('ij,ij->j', W, W)
+    return d2
+
+
+def outlier_pvalues(model, d2):
+    """Return the probability of a squared distance at least `d2` under
+    the model (chi-squared with one degree of freedom per dimension)."""
+    from scipy.stats import chi2
+
+    return chi2.sf(d2, df=model.center.size)
+
+
+def score_frame(model, df, block_rows=DEFAULT_BLOCK_ROWS):
+    """Score the rows of a DataFrame that holds the model's columns.
+
+    Returns:
+      DataFrame: 'mahalanobis_sq' and 'p_value' with the index of `df`
+    """
+    X = df.reindex(columns=model.feature_cols).values.astype(numpy.float64)
+    d2 = mahalanobis_sq(model, X, block_rows=block_rows)
+    return pandas.DataFrame(
+        {'mahalanobis_sq': d2, 'p_value': outlier_pvalues(model, d2)},
+        index=df.index)
+
+
+def score_csv_files(model, csv_fnames, scores_fname=None,
+                    block_rows=DEFAULT_BLOCK_ROWS, verbose=False):
+    """Score the county rows of every year.
+
+    If `scores_fname` is given the scores are kept there (with a manifest
+    of the model and the CSV hashes next to it) and only the years that
+    are new or changed, or all of them if the model changed, are scored.
+
+    Returns:
+      DataFrame: 'mahalanobis_sq' and 'p_value' with a (year, State,
+        County) index
+    """
+    model_hash = model_id(model)
+    manifest = {'model': model_hash, 'years': {}}
+    previous = None
+    if scores_fname is not None:
+        stored = read_manifest(scores_fname + '.json')
+        if (stored.get('model') == model_hash and
+                os.path.isfile(scores_fname)):
+            manifest = stored
+            previous = pandas.read_csv(scores_fname, index_col=[0, 1, 2])
+
+    frames = []
+    for year, csv_fname in sorted(csv_fnames.items()):
+        sha256 = file_sha256(csv_fname)
+        if (previous is not None and
+                manifest['years'].get(str(year)) == sha256):
+            frames.append(previous.loc[[year]])
+            continue
+        if verbose: print('scoring {}'.format(year))
+        gvct = CmsGeoVarCountyTable(csv_fname, columns='features')
+        df = gvct.select_rows('county')
+        scores = score_frame(model, df, block_rows=block_rows)
+        scores.index = pandas.MultiIndex.from_arrays(
+            [numpy.full(len(df), year)] +
+            [df[col].astype(str).values for col in KEY_COLS],
+            names=['year'] + KEY_COLS)
+        frames.append(scores)
+        manifest['years'][str(year)] = sha256
+    for year in list(manifest['years']):
+        if int(year) not in csv_fnames:
+            del manifest['years'][year]
+
+    scores = pandas.concat(frames)
+    if scores_fname is not None:
+        scores.to_csv(scores_fname)
+        write_manifest(scores_fname + '.json', manifest)
+    return scores
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--data-dir',
+        type=str,
+        default='./data',
+        help='directory with the yearly CSV files')
+    parser.add_argument(
+        '--n-components',
+        type=int,
+        default=None,
+        help='score in the space of the first principal components '
+             '(default is all standardized dense columns)')
+    parser.add_argument(
+        '--refit',
+        action='store_true',
+        help='fit the model even if the cached one is up to date')
+    parser.add_argument(
+        '--top',
+        type=int,
+        default=10,
+        help='number of outlying counties to print')
+    args = parser.parse_args()
+
+    csv_fnames = discover_csv_fnames(args.data_dir)
+    model = cached_outlier_model(
+        csv_fnames, os.path.join(args.data_dir, DEFAULT_MODEL_FNAME),
+        n_components=args.n_components, refit=args.refit, verbose=True)
+    scores = score_csv_files(
+        model, csv_fnames, os.path.join(args.data_dir, DEFAULT_SCORES_FNAME),
+        verbose=True)
+    print('dimensions: {}, rows: {}'.format(model.center.size, len(scores)))
+    print(scores.sort_values('mahalanobis_sq', ascending=False).head(args.top))
@@ -1,66 +1,509 @@
+"""
+PCA on the dense "per capita" style feature columns of the State/County
+table.
+
+The analysis is split into a reusable pipeline (`dense_feature_pca`) and
+plotting functions.  The pipeline makes two streaming passes over chunks of
+rows.  The first pass collects the per column statistics (fraction of
+missing values, mean and variance) and the second imputes missing values
+with the column means and standardizes the columns in place, chunk by
+chunk, while fitting the PCA.  With `method='incremental'` only one chunk is
+in memory at a time, so the same analysis works for all counties of all
+years.  The result is the same as running sklearn's mean imputation,
+`StandardScaler` and `PCA` on the whole matrix.
+
+`bootstrap_pca` measures the uncertainty of the fit.  The standardized
+matrix is written once into shared memory and a pool of processes refits
+the PCA on resampled rows, so the matrix is never copied or pickled.
+
+sklearn and the plotting libraries are imported by the functions that use
+them so importing this module (e.g. from `cli.py`) stays cheap.
+"""
+
+import os
+import argparse
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
 import pandas
-import matplotlib.pyplot as plt
-import seaborn as sns
-from matplotlib.colors import ListedColormap
-from sklearn.decomposition import PCA
-from sklearn.preprocessing import Imputer
-from sklearn.preprocessing import StandardScaler
-
-import us_states
+
+import profiling
 from geo_var_state_county import CmsGeoVarCountyTable
+from geo_var_state_county import LEVEL_ROWS
+from geo_var_state_county import classify_rows
+from geo_var_state_county import discover_csv_fnames
+from geo_var_state_county import read_county_csv
+
+
+DEFAULT_FRAC_THRESH = 0.10
+DEFAULT_CHUNK_ROWS = 10000
+PCA_METHODS = ['incremental', 'randomized', 'full']
+# rows per weighted product in `_bootstrap_refits`
+BOOTSTRAP_BLOCK_ROWS = 4096
+
+
+DensePcaResult = namedtuple('DensePcaResult', [
+    'feature_cols',     # names of the dense columns used in the fit
+    'sparse_cols',      # names of the columns that were dropped
+    'frac_nan',         # fraction of missing values in every input column
+    'mean',             # mean of each dense column (used for imputation)
+    'scale',            # standard deviation of each imputed dense column
+    'n_samples',        # number of rows
+    'components',       # principal axes (n_components x n_dense)
+    'explained_variance',
+    'explained_variance_ratio',
+    'pca',              # the fitted sklearn estimator
+])
+
+
+BootstrapPcaResult = namedtuple('BootstrapPcaResult', [
+    'n_boot',           # number of bootstrap refits
+    'confidence',       # coverage of the bands (e.g. 0.95)
+    'explained_variance_ratio',  # per resample (n_boot x n_components)
+    'similarity',       # |cosine| of each resampled axis with the reference
+    'ratio_bands',      # reference ratio, band and similarity per component
+    'loadings_low',     # lower band of the loadings (n_components x n_dense)
+    'loadings_high',    # upper band of the loadings
+])
+
+
+def array_chunks(X, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """Return a chunk source that yields blocks of rows of an array."""
+    def chunks():
+        for start in range(0, X.shape[0], chunk_rows):
+            yield X[start:start+chunk_rows]
+    return chunks
+
+
+def csv_feature_chunks(csv_fnames, feature_cols, level='county'):
+    """Return a chunk source that yields one year at a time.
+
+    Each yearly CSV file is read with only the feature columns and the rows
+    of `level` (see `CmsGeoVarCountyTable.select_rows`) are yielded as a
+    float64 array (missing values, including those of nullable integer
+    columns, are NaN).  Nothing is kept between years.
+
+    Args:
+      csv_fnames (dict): year -> CSV file name (see `discover_csv_fnames`)
+      feature_cols (list of str): columns to yield (in this order)
+      level (str): one of ['national', 'state', 'county']
+    """
+    def chunks():
+        for year, csv_fname in sorted(csv_fnames.items()):
+            df = read_county_csv(csv_fname, columns=feature_cols)
+            bmask = numpy.isin(classify_rows(df), LEVEL_ROWS[level])
+            yield df.loc[bmask].reindex(columns=feature_cols).to_numpy(
+                dtype=numpy.float64, na_value=numpy.nan)
+    return chunks
+
+
+def column_stats(chunks):
+    """Return (n_rows, frac_nan, mean, var) of every column in one pass.
+
+    The mean and (population) variance ignore missing values.  Partial
+    results of each chunk are merged with the parallel algorithm of Chan
+    et al. so the pass is numerically stable.
+    """
+    n_rows = 0
+    count = mean = m2 = None
+    for chunk in chunks():
+        chunk = numpy.asarray(chunk, dtype=numpy.float64)
+        isnan = numpy.isnan(chunk)
+        c_count = (~isnan).sum(axis=0)
+        c_sum = numpy.where(isnan, 0.0, chunk).sum(axis=0)
+        c_mean = numpy.divide(
+            c_sum, c_count, out=numpy.zeros_like(c_sum), where=c_count > 0)
+        dev = numpy.where(isnan, 0.0, chunk - c_mean)
+        c_m2 = (dev * dev).sum(axis=0)
+        if count is None:
+            count, mean, m2 = c_count, c_mean, c_m2
+        else:
+            total = count + c_count
+            delta = c_mean - mean
+            frac = numpy.divide(
+                c_count, total, out=numpy.zeros_like(delta), where=total > 0)
+            mean = mean + delta * frac
+            m2 = m2 + c_m2 + delta**2 * count * frac
+            count = total
+        n_rows += chunk.shape[0]
+
+    frac_nan = 1.0 - count / n_rows
+    var = numpy.divide(m2, count, out=numpy.zeros_like(m2), where=count > 0)
+    return n_rows, frac_nan, mean, var
+
+
+def standardized_chunks(chunks, dense_idx, mean, scale):
+    """Yield chunks restricted to the dense columns with missing values
+    replaced by the column means and then standardized.
+
+    Each chunk is copied once into a float64 buffer (the dense columns are
+    taken and, if the chunk isn't float64 already, cast) and the
+    imputation and scaling happen in place in that buffer.
+    """
+    for chunk in chunks():
+        with profiling.stage('pca: impute and scale', rows=len(chunk)):
+            buf = numpy.take(
+                numpy.asarray(chunk), dense_idx, axis=1).astype(
+                    numpy.float64, copy=False)
+            numpy.copyto(buf, mean, where=numpy.isnan(buf))
+            buf -= mean
+            buf /= scale
+        yield buf
+
+
+def rebatch(chunks, batch_rows, min_rows):
+    """Regroup chunks into batches of `batch_rows` rows.  The last batch is
+    merged into the one before it if it has fewer than `min_rows` rows."""
+    pending = []
+    n_pending = 0
+    held = None
+    for chunk in chunks:
+        pending.append(chunk)
+        n_pending += chunk.shape[0]
+        while n_pending >= batch_rows:
+            stacked = numpy.concatenate(pending)
+            if held is not None:
+                yield held
+            held = stacked[:batch_rows]
+            pending = [stacked[batch_rows:]]
+            n_pending = pending[0].shape[0]
+    last = numpy.concatenate(pending) if n_pending > 0 else None
+    if held is not None and last is not None and last.shape[0] < min_rows:
+        yield numpy.concatenate([held, last])
+    else:
+        if held is not None:
+            yield held
+        if last is not None:
+            yield last
+
+
+def dense_feature_pca(chunks, feature_cols, frac_thresh=DEFAULT_FRAC_THRESH,
+                      method='incremental', n_components=None,
+                      batch_rows=DEFAULT_CHUNK_ROWS, random_state=0):
+    """Impute, standardize and fit a PCA to the dense feature columns.
+
+    Args:
+      chunks (callable): returns an iterator over 2-D arrays of rows with
+        one column per entry in `feature_cols` (see `array_chunks` and
+        `csv_feature_chunks`).  It is called twice.
+      feature_cols (list of str): names of the columns in each chunk
+      frac_thresh (float): columns with at least this fraction of missing
+        values are dropped
+      method (str): 'incremental' fits an `IncrementalPCA` chunk by chunk
+        (bounded memory), 'randomized' and 'full' build the standardized
+        matrix once and use the randomized or full SVD solver of `PCA`
+      n_components (int): number of components (default is all)
+      batch_rows (int): rows per `partial_fit` call for 'incremental'
+      random_state (int): seed for the randomized solver
+
+    Returns:
+      DensePcaResult: the fitted model and the column statistics
+    """
+    from sklearn.decomposition import PCA
+    from sklearn.decomposition import IncrementalPCA
+
+    if method not in PCA_METHODS:
+        raise ValueError('method must be one of {}'.format(PCA_METHODS))
+
+    with profiling.stage('pca: column stats') as st:
+        n_rows, frac_nan, mean, var = column_stats(chunks)
+        st.add_rows(n_rows)
+    is_column_dense = frac_nan < frac_thresh
+    dense_idx = numpy.flatnonzero(is_column_dense)
+    n_dense = dense_idx.size
+    mean = mean[dense_idx]
+    # the variance after mean imputation (as seen by a StandardScaler)
+    scale = numpy.sqrt(var[dense_idx] * (1.0 - frac_nan[dense_idx]))
+    scale[scale == 0.0] = 1.0
+    if n_components is None:
+        n_components = min(n_rows, n_dense)
+
+    std_chunks = standardized_chunks(chunks, dense_idx, mean, scale)
+    if method == 'incremental':
+        pca = IncrementalPCA(n_components=n_components)
+        for batch in rebatch(std_chunks, max(batch_rows, n_components),
+                             n_components):
+            with profiling.stage('pca: fit', rows=batch.shape[0]):
+                pca.partial_fit(batch)
+    else:
+        X = numpy.empty((n_rows, n_dense), dtype=numpy.float64)
+        start = 0
+        for buf in std_chunks:
+            X[start:start+buf.shape[0]] = buf
+            start += buf.shape[0]
+        pca = PCA(n_components=n_components, svd_solver=method,
+                  random_state=random_state)
+        with profiling.stage('pca: fit', rows=n_rows):
+            pca.fit(X)
+
+    sparse_idx = numpy.flatnonzero(~is_column_dense)
+    return DensePcaResult(
+        feature_cols=[feature_cols[i] for i in dense_idx],
+        sparse_cols=[feature_cols[i] for i in sparse_idx],
+        frac_nan=pandas.Series(frac_nan, index=feature_cols),
+        mean=mean,
+        scale=scale,
+        n_samples=n_rows,
+        components=pca.components_,
+        explained_variance=pca.explained_variance_,
+        explained_variance_ratio=pca.explained_variance_ratio_,
+        pca=pca,
+    )
+
+
+def transform_chunks(result, chunks, feature_cols, n_components=2):
+    """Project chunks of rows onto the first `n_components` principal axes
+    of a `DensePcaResult`."""
+    dense_idx = [feature_cols.index(col) for col in result.feature_cols]
+    axes = result.components[:n_components].T
+    projected = [
+        buf.dot(axes) for buf in standardized_chunks(
+            chunks, dense_idx, result.mean, result.scale)]
+    return numpy.concatenate(projected)
+
+
+def standardized_matrix(chunks, result, feature_cols, out=None):
+    """Write the imputed and standardized dense columns of all rows into
+    `out` (a new array by default) chunk by chunk and return it."""
+    dense_idx = [feature_cols.index(col) for col in result.feature_cols]
+    if out is None:
+        out = numpy.empty((result.n_samples, len(dense_idx)))
+    start = 0
+    for buf in standardized_chunks(
+            chunks, dense_idx, result.mean, result.scale):
+        out[start:start+buf.shape[0]] = buf
+        start += buf.shape[0]
+    return out
+
+
+# the shared standardized matrix of a bootstrap worker process
+_BOOTSTRAP = {}
+
+
+def _init_bootstrap_worker(raw, shape, axes):
+    """Pool initializer.  Wraps the shared buffer in an array (no copy) and
+    limits BLAS to one thread so the processes don't oversubscribe cores."""
+    _BOOTSTRAP['X'] = numpy.frombuffer(raw, dtype=numpy.float64).reshape(shape)
+    _BOOTSTRAP['axes'] = axes
+    try:
+        from threadpoolctl import threadpool_limits
+        _BOOTSTRAP['limits'] = threadpool_limits(limits=1)
+    except ImportError:
+        pass
+
+
+def _bootstrap_refits(seeds):
+    """Refit the PCA on one resample of the rows per seed.
+
+    A resample is represented by how often each row is drawn, so the
+    covariance is computed from weighted rows instead of gathering a copy
+    of the resampled matrix.  The weighted products are accumulated over
+    blocks of BOOTSTRAP_BLOCK_ROWS rows so the only temporary is one
+    weighted block.
+
+    Returns:
+      tuple: (explained variance ratios, |cosines| with the reference axes,
+        sign aligned axes), one row per seed
+    """
+    X = _BOOTSTRAP['X']
+    axes = _BOOTSTRAP['axes']
+    n_rows = X.shape[0]
+    n_components = axes.shape[0]
+    ratios, similarity, loadings = [], [], []
+    for seed in seeds:
+        rng = numpy.random.default_rng(seed)
+        weights = numpy.bincount(
+            rng.integers(0, n_rows, n_rows), minlength=n_rows).astype(float)
+        mean = weights.dot(X) / n_rows
+        cov = numpy.zeros((X.shape[1], X.shape[1]))
+        for start in range(0, n_rows, BOOTSTRAP_BLOCK_ROWS):
+            block = X[start:start + BOOTSTRAP_BLOCK_ROWS]
+            cov += (block.T * weights[start:start + block.shape[0]]).dot(
+                block)
+        cov /= n_rows
+        cov -= numpy.outer(mean, mean)
+        eigvals, eigvecs = numpy.linalg.eigh(cov)
+        eigvals = numpy.maximum(eigvals[::-1], 0.0)
+        boot_axes = eigvecs[:, ::-1][:, :n_components].T
+        cosines = numpy.einsum('ij,ij->i', boot_axes, axes)
+        boot_axes *= numpy.where(cosines < 0, -1.0, 1.0)[:, numpy.newaxis]
+        ratios.append(eigvals[:n_components] / eigvals.sum())
+        similarity.append(numpy.abs(cosines))
+        loadings.append(boot_axes)
+    return numpy.array(ratios), numpy.array(similarity), numpy.array(loadings)
+
+
+def bootstrap_pca(result, chunks, feature_cols, n_boot=200, n_components=10,
+                  confidence=0.95, max_workers=None, seed=0):
+    """Bootstrap the explained variance and the principal axes of a fit.
+
+    The imputed and standardized matrix (with the column statistics of
+    the full fit) is written once into a shared memory buffer that the
+    worker processes map at start up.  Each task refits a batch of
+    resamples and only the small per-resample results are sent back, so
+    the refits are spread over the cores without copying the matrix.
+
+    Args:
+      result (DensePcaResult): the reference fit (see `dense_feature_pca`)
+      chunks (callable): the chunk source the reference was fitted on
+      feature_cols (list of str): names of the columns in each chunk
+      n_boot (int): number of resamples
+      n_components (int): number of leading components to report
+      confidence (float): coverage of the percentile bands
+      max_workers (int): number of processes (default is the CPU count)
+      seed (int): seed of the resamples (results don't depend on the
+        number of workers)
+
+    Returns:
+      BootstrapPcaResult: bands for the explained variance ratios and the
+        loadings, and the similarity of the bootstrap axes to the
+        reference axes (1 is a perfectly stable axis)
+    """
+    n_components = min(n_components, result.components.shape[0])
+    shape = (result.n_samples, len(result.feature_cols))
+    raw = multiprocessing.RawArray('d', shape[0] * shape[1])
+    X = numpy.frombuffer(raw, dtype=numpy.float64).reshape(shape)
+    standardized_matrix(chunks, result, feature_cols, out=X)
+    axes = numpy.ascontiguousarray(result.components[:n_components])
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    seeds = numpy.random.SeedSequence(seed).generate_state(n_boot)
+    batches = numpy.array_split(seeds, min(n_boot, 4 * max_workers))
+    with profiling.stage('pca: bootstrap', rows=shape[0] * n_boot):
+        with ProcessPoolExecutor(
+                max_workers=max_workers,
+                initializer=_init_bootstrap_worker,
+                initargs=(raw, shape, axes)) as executor:
+            parts = list(executor.map(_bootstrap_refits, batches))
+    ratios, similarity, loadings = [
+        numpy.concatenate(part) for part in zip(*parts)]
+
+    tail = 100.0 * (1.0 - confidence) / 2.0
+    low, median, high = numpy.percentile(
+        ratios, [tail, 50.0, 100.0 - tail], axis=0)
+    ratio_bands = pandas.DataFrame({
+        'reference': result.explained_variance_ratio[:n_components],
+        'low': low,
+        'median': median,
+        'high': high,
+        'similarity': numpy.median(similarity, axis=0),
+    }, index=pandas.RangeIndex(1, n_components+1, name='component'))
+    loadings_low, loadings_high = numpy.percentile(
+        loadings, [tail, 100.0 - tail], axis=0)
+    return BootstrapPcaResult(
+        n_boot=n_boot,
+        confidence=confidence,
+        explained_variance_ratio=ratios,
+        similarity=similarity,
+        ratio_bands=ratio_bands,
+        loadings_low=loadings_low,
+        loadings_high=loadings_high,
+    )
+
+
+def plot_explained_variance(
+        result, fname='pca_components_vs_total_variance.png', bootstrap=None):
+    """Plot the cumulative explained variance ratio (with the bootstrap
+    band of the leading components if `bootstrap` is given)."""
+    import matplotlib.pyplot as plt
+
+    n = result.explained_variance_ratio.size
+    plt.figure(figsize=(6,6))
+    plt.plot(
+        numpy.arange(n)+1,
+        numpy.cumsum(result.explained_variance_ratio),
+        lw=3.0)
+    if bootstrap is not None:
+        tail = 100.0 * (1.0 - bootstrap.confidence) / 2.0
+        low, high = numpy.percentile(
+            numpy.cumsum(bootstrap.explained_variance_ratio, axis=1),
+            [tail, 100.0 - tail], axis=0)
+        plt.fill_between(
+            numpy.arange(low.size)+1, low, high, alpha=0.3, lw=0)
+    plt.xlim(0, n+1)
+    plt.ylim(-0.05, 1.05)
+    plt.xlabel('Principal Component')
+    plt.ylabel('Total Variance')
+    plt.savefig(fname)
+
+
+def plot_components_2d(Xpc, fname='pca_components_2d.png'):
+    """Scatter plot and density contours of the first two components."""
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    from matplotlib.colors import ListedColormap
+
+    plt.figure(figsize=(6,6))
+    plt.scatter(Xpc[:,0], Xpc[:,1], s=20, alpha=0.5)
+    n_levels = 7
+    palette = list(reversed(sns.color_palette("Reds_d", n_levels)))
+    my_cmap = ListedColormap(palette)
+    sns.kdeplot(x=Xpc[:,0], y=Xpc[:,1], cmap=my_cmap, levels=n_levels)
+    plt.xlabel('First Principal Component')
+    plt.ylabel('Second Principal Component')
+    plt.savefig(fname)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--fname',
+        type=str,
+        default=None,
+        help='name of geographical variation state/county file '
+             '(default is the 2014 file)')
+    parser.add_argument(
+        '--all-years',
+        type=str,
+        default=None,
+        metavar='DATA_DIR',
+        help='use the counties of all yearly files in DATA_DIR')
+    parser.add_argument(
+        '--method',
+        default='incremental',
+        choices=PCA_METHODS,
+        help='how to fit the PCA')
+    parser.add_argument(
+        '--bootstrap',
+        type=int,
+        default=0,
+        metavar='N_BOOT',
+        help='refit on N_BOOT resamples of the rows for confidence bands')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help='number of bootstrap processes (default is the CPU count)')
+    args = parser.parse_args()
+
+    if args.all_years is not None:
+        feature_cols = CmsGeoVarCountyTable.return_feature_cols()
+        chunks = csv_feature_chunks(
+            discover_csv_fnames(args.all_years), feature_cols)
+    else:
+        kwargs = {} if args.fname is None else {'csv_fname': args.fname}
+        gvct = CmsGeoVarCountyTable(verbose=True, columns='features', **kwargs)
+        fm = gvct.feature_matrix('county')
+        feature_cols = fm.columns
+        chunks = array_chunks(fm.values)
+
+    result = dense_feature_pca(chunks, feature_cols, method=args.method)
+    print('dense columns: {}'.format(len(result.feature_cols)))
+    print('sparse columns: {}'.format(len(result.sparse_cols)))
 
+    bootstrap = None
+    if args.bootstrap > 0:
+        bootstrap = bootstrap_pca(
+            result, chunks, feature_cols, n_boot=args.bootstrap,
+            max_workers=args.workers)
+        print('bootstrap ({} resamples, {:.0%} bands):'.format(
+            bootstrap.n_boot, bootstrap.confidence))
+        print(bootstrap.ratio_bands)
 
-gvct = CmsGeoVarCountyTable(verbose=True)
-ct = gvct.select_rows('county')
-nt = gvct.select_rows('national')
-feature_cols = gvct.return_feature_cols()
-
-
-# limit to dense columns
-#==================================================
-frac_thresh = 0.10
-frac_nan = ct[feature_cols].isnull().sum() / ct.shape[0]
-is_column_dense = frac_nan < frac_thresh
-sparse_cols = is_column_dense[is_column_dense==False].index.tolist()
-feature_cols = is_column_dense[is_column_dense==True].index.tolist()
-
-# do some analysis
-#==================================================
-features = ct[feature_cols]
-
-# replace missing values with column means
-imp = Imputer()
-X = imp.fit_transform(features)
-
-# standardize columns
-scaler = StandardScaler()
-X = scaler.fit_transform(X)
-
-# do PCA
-pca = PCA()
-pca.fit(X)
-n = pca.n_components_
-
-plt.figure(figsize=(6,6))
-plt.plot(
-    pandas.np.arange(n)+1,
-    pandas.np.cumsum(pca.explained_variance_ratio_),
-    lw=3.0)
-plt.xlim(0, n+1)
-plt.ylim(-0.05, 1.05)
-plt.xlabel('Principal Component')
-plt.ylabel('Total Variance')
-plt.savefig('pca_components_vs_total_variance.png')
-
-
-
-Xpc = pca.transform(X)
-plt.figure(figsize=(6,6))
-plt.scatter(Xpc[:,0], Xpc[:,1], s=20, alpha=0.5)
-n_levels = 7
-palette = list(reversed(sns.color_palette("Reds_d", n_levels)))
-my_cmap = ListedColormap(palette)
-sns.kdeplot(Xpc[:,0], Xpc[:,1], cmap=my_cmap, n_levels=n_levels)
-plt.xlabel('First Principal Component')
-plt.ylabel('Second Principal Component')
-plt.savefig('pca_components_2d.png')
+    plot_explained_variance(result, bootstrap=bootstrap)
+    Xpc = transform_chunks(result, chunks, feature_cols)
+    plot_components_2d(Xpc)
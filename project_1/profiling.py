@@ -0,0 +1,288 @@
+"""
+Per stage timing and memory instrumentation.
+
+Stages are marked with a context manager or a decorator,
+
+    with profiling.stage('table load') as st:
+        df = read_county_csv(csv_fname)
+        st.add_rows(df.shape[0])
+
+    @profiling.profiled('select_rows', rows=profiling.row_count)
+    def select_rows(self, level, exclude=None):
+        ...
+
+and every stage records its wall time, CPU time (of the process), the
+number of rows it processed and, if memory tracing is on, its peak memory
+(`tracemalloc`, reset per stage so nested stages don't hide each other's
+peaks).  Stages can be nested; the times of a stage include its children.
+
+Profiling is off by default and then `stage` returns a shared object that
+does nothing, so instrumented code pays one function call per stage.  It is
+switched on with `enable` (or `python cli.py --profile`, or by setting the
+`GVCT_PROFILE` environment variable to the name of a JSON lines file) and
+records are kept in memory and optionally appended to a JSON lines file,
+one object per stage.  `summary` aggregates them per stage.
+
+Only the standard library is imported at the top of this module (pandas is
+imported by `summary`) so `cli.py` can import it without slowing down.
+"""
+
+import os
+import json
+import time
+import functools
+import threading
+import tracemalloc
+from collections import namedtuple
+
+
+PROFILE_ENV_VAR = 'GVCT_PROFILE'
+
+
+StageRecord = namedtuple('StageRecord', [
+    'stage',            # name of the stage
+    'wall_seconds',     # wall time
+    'cpu_seconds',      # CPU time of the process (all threads)
+    'rows',             # rows processed (None if not counted)
+    'peak_mb',          # peak traced memory (None if tracing is off)
+    'depth',            # nesting level (0 for outermost stages)
+    'start',            # wall clock time the stage started (epoch seconds)
+    'pid',              # process the stage ran in
+])
+
+
+class Profiler:
+    """Collects `StageRecord`s and optionally appends them to a JSON lines
+    file as they finish."""
+
+
+    def __init__(self, jsonl_fname=None, trace_memory=False):
+        """Initialize class.
+
+        Args:
+          jsonl_fname (str): file to append one JSON object per stage to
+          trace_memory (bool): record the peak memory of every stage.  This
+            starts `tracemalloc`, which slows down allocations.
+        """
+        self.jsonl_fname = jsonl_fname
+        self.trace_memory = trace_memory
+        self.records = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._started_tracing = False
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+
+    def close(self):
+        """Stop memory tracing if this profiler started it."""
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+
+    def record(self, record):
+        """Keep a finished stage and write it to the JSON lines file."""
+        with self._lock:
+            self.records.append(record)
+            if self.jsonl_fname is not None:
+                # one write per line in append mode, so processes forked
+                # from this one can share the file
+                with open(self.jsonl_fname, 'a') as fp:
+                    fp.write(json.dumps(record._asdict()) + '\n')
+
+
+    def stack(self):
+        """Return the stack of open stages of the calling thread."""
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+
+class Stage:
+    """An open stage.  Rows can be counted while it runs."""
+
+
+    def __init__(self, profiler, name, rows=None):
+        self.profiler = profiler
+        self.name = name
+        self.rows = rows
+        self.child_peak = 0
+
+
+    def add_rows(self, rows):
+        """Add to the number of rows processed by the stage."""
+        self.rows = rows if self.rows is None else self.rows + rows
+
+
+    def __enter__(self):
+        stack = self.profiler.stack()
+        self.depth = len(stack)
+        self.tracing = self.profiler.trace_memory and tracemalloc.is_tracing()
+        if self.tracing:
+            # keep the peak of the enclosing stage before resetting it
+            if stack:
+                stack[-1].child_peak = max(
+                    stack[-1].child_peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        stack.append(self)
+        self.start = time.time()
+        self.t_wall = time.perf_counter()
+        self.t_cpu = time.process_time()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self.t_wall
+        cpu = time.process_time() - self.t_cpu
+        stack = self.profiler.stack()
+        stack.pop()
+        peak_mb = None
+        if self.tracing:
+            peak = max(self.child_peak, tracemalloc.get_traced_memory()[1])
+            peak_mb = peak / 2**20
+            if stack:
+                stack[-1].child_peak = max(stack[-1].child_peak, peak)
+        rows = int(self.rows) if self.rows is not None else None
+        # kept on the stage so callers with their own reports can reuse it
+        self.record = StageRecord(
+            self.name, wall, cpu, rows, peak_mb, self.depth, self.start,
+            os.getpid())
+        self.profiler.record(self.record)
+        return False
+
+
+class _NullStage:
+    """Stage used while profiling is off.  Does nothing."""
+
+
+    def add_rows(self, rows):
+        pass
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+_PROFILER = None
+
+
+def enable(jsonl_fname=None, trace_memory=False):
+    """Switch profiling on and return the new `Profiler`.
+
+    Args:
+      jsonl_fname (str): file to append one JSON object per stage to
+      trace_memory (bool): record the peak memory of every stage
+    """
+    global _PROFILER
+    disable()
+    _PROFILER = Profiler(jsonl_fname=jsonl_fname, trace_memory=trace_memory)
+    return _PROFILER
+
+
+def disable():
+    """Switch profiling off and return the records collected so far."""
+    global _PROFILER
+    profiler, _PROFILER = _PROFILER, None
+    if profiler is None:
+        return []
+    profiler.close()
+    return profiler.records
+
+
+def is_enabled():
+    """Return True if stages are being recorded."""
+    return _PROFILER is not None
+
+
+def stage(name, rows=None):
+    """Return a context manager that records a stage (or does nothing if
+    profiling is off).
+
+    Args:
+      name (str): name of the stage.  Stages with the same name are
+        aggregated by `summary`.
+      rows (int): rows processed, if known up front (see `Stage.add_rows`)
+    """
+    if _PROFILER is None:
+        return _NULL_STAGE
+    return Stage(_PROFILER, name, rows)
+
+
+def profiled(name=None, rows=None):
+    """Decorator that records every call of a function as a stage.
+
+    Args:
+      name (str): name of the stage (default is the function's qualified
+        name)
+      rows (callable): returns the number of rows given the function's
+        result, e.g. `row_count`
+    """
+    def decorator(func):
+        stage_name = name if name is not None else func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _PROFILER is None:
+                return func(*args, **kwargs)
+            with Stage(_PROFILER, stage_name) as st:
+                result = func(*args, **kwargs)
+                if rows is not None:
+                    st.add_rows(rows(result))
+            return result
+        return wrapper
+    return decorator
+
+
+def row_count(result):
+    """Number of rows of a 2-D result (a DataFrame or an array) and 1 for a
+    single row (a Series or a 1-D array)."""
+    shape = getattr(result, 'shape', None)
+    if shape is None:
+        return len(result)
+    return shape[0] if len(shape) > 1 else 1
+
+
+def read_jsonl(jsonl_fname):
+    """Read the records of a JSON lines file written by a `Profiler`."""
+    with open(jsonl_fname) as fp:
+        return [StageRecord(**json.loads(line)) for line in fp if line.strip()]
+
+
+def summary(records=None):
+    """Aggregate records per stage.
+
+    Args:
+      records (list of StageRecord): default is the current profiler's
+
+    Returns:
+      DataFrame: one row per stage (in order of first appearance) with the
+        number of calls, total wall and CPU seconds, total rows, rows per
+        second and the largest peak memory
+    """
+    import pandas
+
+    if records is None:
+        records = _PROFILER.records if _PROFILER is not None else []
+    df = pandas.DataFrame(records, columns=StageRecord._fields)
+    grouped = df.groupby('stage', sort=False)
+    report = pandas.DataFrame({
+        'calls': grouped.size(),
+        'wall_seconds': grouped['wall_seconds'].sum(),
+        'cpu_seconds': grouped['cpu_seconds'].sum(),
+        'rows': grouped['rows'].sum(min_count=1),
+        'peak_mb': grouped['peak_mb'].max(),
+    })
+    report['rows_per_second'] = report['rows'] / report['wall_seconds']
+    return report
+
+
+if os.environ.get(PROFILE_ENV_VAR):
+    enable(jsonl_fname=os.environ[PROFILE_ENV_VAR])
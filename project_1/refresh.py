@@ -0,0 +1,350 @@
+"""
+Incremental refresh of the derived data when CMS publishes a new year.
+
+A new year appears as a new sheet in County_All_Table.xlsx.  Instead of
+converting the workbook and recomputing everything,
+
+  1) `convert_xlsx_parallel` only converts the sheets whose fingerprint
+     (the CRC-32 and size of the sheet in the xlsx archive and the text
+     it refers to, see `sheet_fingerprints`) is new or changed
+  2) `RunningAggregates` keeps partial results per year in a directory
+     next to the CSV files and only computes them for years whose CSV file
+     is new or changed (by SHA-256).  The yearly partials are then merged,
+
+       - column statistics (count, mean, variance, fraction missing) and
+         the covariance matrix of the mean imputed features of the county
+         rows, from which the dense feature PCA of `pca_on_dense_features`
+         is computed without reading any rows
+       - the reconciliation of totals (see `reconcile_partials`)
+
+Feature matrices and parsed tables of unchanged years are already reused
+through the parse cache (see `frame_cache.py`), which is keyed on the
+content of each CSV file.
+
+The yearly partials are sums of shifted values and of their pairwise
+products over the rows where both columns are observed, so they simply
+add up across years.  The shift (one value per column, taken from the
+first year processed) keeps the sums of squares small.
+
+ > python refresh.py ./data/County_All_Table.xlsx
+"""
+
+import os
+import argparse
+
+import numpy
+import pandas
+
+from geo_var_state_county import CmsGeoVarCountyTable
+from geo_var_state_county import DEFAULT_ATOL
+from geo_var_state_county import DEFAULT_RTOL
+from geo_var_state_county import discover_csv_fnames
+from geo_var_state_county import reconcile_partials
+from geo_var_state_county import total_partials
+from manifest import file_sha256
+from manifest import read_manifest
+from manifest import write_manifest
+from pca_on_dense_features import DEFAULT_FRAC_THRESH
+from pca_on_dense_features import DensePcaResult
+
+
+DEFAULT_STATE_DIRNAME = '.gvct_aggregates'
+INDEX_FNAME = 'index.json'
+
+
+class RunningAggregates:
+    """Per year partial results that are merged on demand.
+
+    For the county rows of every year, with y = x - shift and a mask m of
+    observed values, the partials are
+
+      - `n_rows`: number of rows
+      - `pair_count[i, j]`: rows where columns i and j are both observed
+      - `pair_sum[i, j]`: sum of y_i over the rows where j is observed
+      - `pair_prod[i, j]`: sum of y_i * y_j over the rows where both are
+        observed
+
+    (the diagonals hold the per column count, sum and sum of squares) and
+    the reconciliation partial sums of all rows (`total_partials`).
+    """
+
+
+    def __init__(self, state_dir, columns=None, verbose=False):
+        """Initialize class with the directory that holds the partials.
+
+        Args:
+          state_dir (str): directory for the partials (created if needed)
+          columns (list of str): feature columns (default is
+            `CmsGeoVarCountyTable.return_feature_cols`).  Stored partials
+            for other columns are dropped.
+          verbose (bool): print the years that are (re)computed
+        """
+        self.state_dir = state_dir
+        self.verbose = verbose
+        if columns is None:
+            columns = CmsGeoVarCountyTable.return_feature_cols()
+        os.makedirs(state_dir, exist_ok=True)
+        self.index_fname = os.path.join(state_dir, INDEX_FNAME)
+        self.index = read_manifest(self.index_fname)
+        if self.index.get('columns') != list(columns):
+            self.index = {'columns': list(columns), 'shift': None, 'years': {}}
+        self.columns = self.index['columns']
+
+
+    @property
+    def years(self):
+        """Years with stored partials."""
+        return sorted(int(year) for year in self.index['years'])
+
+
+    def update(self, csv_fnames):
+        """Compute the partials of new or changed years and drop those of
+        years that are gone.
+
+        Args:
+          csv_fnames (dict): year -> CSV file name (see
+            `discover_csv_fnames`)
+
+        Returns:
+          list of int: the years that were (re)computed
+        """
+        years = self.index['years']
+        for year in list(years):
+            if int(year) not in csv_fnames:
+                self._remove_year(year)
+
+        updated = []
+        for year, csv_fname in sorted(csv_fnames.items()):
+            sha256 = file_sha256(csv_fname)
+            entry = years.get(str(year))
+            if entry is not None and entry['csv_sha256'] == sha256:
+                continue
+            if self.verbose: print('computing partials for {}'.format(year))
+            gvct = CmsGeoVarCountyTable(csv_fname)
+            n_rows = self._save_feature_partials(year, gvct)
+            total_partials(gvct.df, year=year).to_csv(
+                self._fname(year, 'recon.csv'))
+            years[str(year)] = {
+                'csv': os.path.basename(csv_fname),
+                'csv_sha256': sha256,
+                'n_rows': n_rows,
+            }
+            write_manifest(self.index_fname, self.index)
+            updated.append(year)
+        write_manifest(self.index_fname, self.index)
+        return updated
+
+
+    def pair_sums(self, years=None):
+        """Return (n_rows, pair_count, pair_sum, pair_prod) summed over
+        years (default all)."""
+        if years is None:
+            years = self.years
+        k = len(self.columns)
+        n_rows = 0
+        sums = [numpy.zeros((k, k)) for _ in range(3)]
+        for year in years:
+            with numpy.load(self._fname(year, 'features.npz')) as npz:
+                n_rows += int(npz['n_rows'])
+                for total, name in zip(
+                        sums, ['pair_count', 'pair_sum', 'pair_prod']):
+                    total += npz[name]
+        return (n_rows,) + tuple(sums)
+
+
+    def column_stats(self, years=None):
+        """Return the count, mean, variance (ignoring missing values) and
+        fraction of missing values of each feature column.
+
+        Returns:
+          DataFrame: one row per column
+        """
+        n_rows, pair_count, pair_sum, pair_prod = self.pair_sums(years)
+        count = numpy.diag(pair_count)
+        total = numpy.diag(pair_sum)
+        sumsq = numpy.diag(pair_prod)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            mean_y = total / count
+            var = numpy.maximum(sumsq / count - mean_y**2, 0.0)
+        return pandas.DataFrame({
+            'count': count,
+            'mean': mean_y + self._shift(),
+            'var': var,
+            'frac_nan': 1.0 - count / n_rows if n_rows else numpy.nan,
+        }, index=pandas.Index(self.columns, name='column'))
+
+
+    def imputed_covariance(self, years=None):
+        """Return (n_rows, mean, covariance) of the feature columns after
+        missing values are replaced by the column means.
+
+        With the mean nu of y, the co-moment of the imputed columns only
+        gets contributions from rows where both columns are observed,
+
+          sum (y_i - nu_i) (y_j - nu_j)
+            = pair_prod - nu_i pair_sum.T - nu_j pair_sum + nu_i nu_j pair_count
+
+        The covariance is normalized by n_rows - 1, like sklearn's PCA.
+        """
+        n_rows, pair_count, pair_sum, pair_prod = self.pair_sums(years)
+        count = numpy.diag(pair_count)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            nu = numpy.where(count > 0, numpy.diag(pair_sum) / count, 0.0)
+        comoment = (
+            pair_prod -
+            nu[:, numpy.newaxis] * pair_sum.T -
+            nu[numpy.newaxis, :] * pair_sum +
+            numpy.outer(nu, nu) * pair_count)
+        cov = comoment / max(n_rows - 1, 1)
+        return n_rows, nu + self._shift(), cov
+
+
+    def dense_pca(self, frac_thresh=DEFAULT_FRAC_THRESH, years=None):
+        """Return the PCA of the mean imputed and standardized dense
+        feature columns (see `dense_feature_pca`) from the partials.
+
+        Returns:
+          DensePcaResult: with `pca` set to None
+        """
+        n_rows, mean, cov = self.imputed_covariance(years)
+        frac_nan = 1.0 - numpy.diag(self.pair_sums(years)[1]) / n_rows
+        dense_idx = numpy.flatnonzero(frac_nan < frac_thresh)
+        sparse_idx = numpy.flatnonzero(frac_nan >= frac_thresh)
+
+        cov = cov[numpy.ix_(dense_idx, dense_idx)]
+        # population standard deviation of the imputed columns
+        scale = numpy.sqrt(numpy.diag(cov) * (n_rows - 1) / n_rows)
+        scale[scale == 0.0] = 1.0
+        corr = cov / numpy.outer(scale, scale)
+        eigvals, eigvecs = numpy.linalg.eigh(corr)
+        order = numpy.argsort(eigvals)[::-1]
+        eigvals = numpy.maximum(eigvals[order], 0.0)
+        components = eigvecs[:, order].T
+        # same sign convention as sklearn (largest loading positive)
+        signs = numpy.sign(components[
+            numpy.arange(components.shape[0]),
+            numpy.abs(components).argmax(axis=1)])
+        components *= signs[:, numpy.newaxis]
+
+        return DensePcaResult(
+            feature_cols=[self.columns[i] for i in dense_idx],
+            sparse_cols=[self.columns[i] for i in sparse_idx],
+            frac_nan=pandas.Series(frac_nan, index=self.columns),
+            mean=mean[dense_idx],
+            scale=scale,
+            n_samples=n_rows,
+            components=components,
+            explained_variance=eigvals,
+            explained_variance_ratio=eigvals / eigvals.sum(),
+            pca=None,
+        )
+
+
+    def reconciliation(self, rtol=DEFAULT_RTOL, atol=DEFAULT_ATOL,
+                       only_failures=True, years=None):
+        """Return the reconciliation of totals of all years (see
+        `reconcile_totals`) from the stored partial sums."""
+        if years is None:
+            years = self.years
+        partials = [
+            pandas.read_csv(
+                self._fname(year, 'recon.csv'), index_col=[0, 1, 2])
+            for year in years]
+        return reconcile_partials(
+            partials, rtol=rtol, atol=atol, only_failures=only_failures)
+
+
+    def _save_feature_partials(self, year, gvct):
+        """Compute and store the feature partials of one year.  Returns the
+        number of county rows."""
+        fm = gvct.feature_matrix('county')
+        positions = {col: i for i, col in enumerate(self.columns)}
+        X = numpy.full((fm.values.shape[0], len(self.columns)), numpy.nan)
+        X[:, [positions[col] for col in fm.columns]] = fm.values
+        if self.index['shift'] is None:
+            with numpy.errstate(invalid='ignore'):
+                shift = numpy.nanmean(X, axis=0) if X.shape[0] else 0.0
+            self.index['shift'] = numpy.nan_to_num(shift).tolist()
+
+        observed = ~numpy.isnan(X)
+        mask = observed.astype(numpy.float64)
+        Y = numpy.where(observed, X - self._shift(), 0.0)
+        numpy.savez(
+            self._fname(year, 'features.npz'),
+            n_rows=X.shape[0],
+            pair_count=mask.T.dot(mask),
+            pair_sum=Y.T.dot(mask),
+            pair_prod=Y.T.dot(Y))
+        return X.shape[0]
+
+
+    def _shift(self):
+        return numpy.asarray(self.index['shift'], dtype=numpy.float64)
+
+
+    def _remove_year(self, year):
+        for suffix in ['features.npz', 'recon.csv']:
+            fname = self._fname(year, suffix)
+            if os.path.isfile(fname):
+                os.remove(fname)
+        del self.index['years'][str(year)]
+
+
+    def _fname(self, year, suffix):
+        return os.path.join(self.state_dir, '{}_{}'.format(year, suffix))
+
+
+def refresh(excel_fname=None, data_dir=None, state_dir=None, fmt='parquet',
+            verbose=True):
+    """Convert new or changed sheets and update the running aggregates.
+
+    Args:
+      excel_fname (str): workbook to convert (None to skip conversion)
+      data_dir (str): directory with the yearly CSV files (default is the
+        directory of `excel_fname`)
+      state_dir (str): directory of the partials (default is
+        `DEFAULT_STATE_DIRNAME` in `data_dir`)
+      fmt (str): columnar format written next to the CSVs
+
+    Returns:
+      tuple: (RunningAggregates, list of the years that were updated)
+    """
+    if excel_fname is not None:
+        from convert_geo_var_state_county_to_csv import convert_xlsx_parallel
+        convert_xlsx_parallel(excel_fname, fmt=fmt)
+        if data_dir is None:
+            data_dir = os.path.dirname(excel_fname)
+    if state_dir is None:
+        state_dir = os.path.join(data_dir, DEFAULT_STATE_DIRNAME)
+    aggregates = RunningAggregates(state_dir, verbose=verbose)
+    updated = aggregates.update(discover_csv_fnames(data_dir))
+    return aggregates, updated
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'excel_fname',
+        type=str,
+        nargs='?',
+        default=None,
+        help='workbook to convert first (default is to only update the '
+             'aggregates of the CSVs in --data-dir)')
+    parser.add_argument(
+        '--data-dir',
+        type=str,
+        default=None,
+        help='directory with the yearly CSV files')
+    args = parser.parse_args()
+    if args.excel_fname is None and args.data_dir is None:
+        parser.error('give an Excel file or --data-dir')
+
+    aggregates, updated = refresh(args.excel_fname, data_dir=args.data_dir)
+    print('years: {}, updated: {}'.format(aggregates.years, updated))
+    result = aggregates.dense_pca()
+    print('dense columns: {}'.format(len(result.feature_cols)))
+    print('explained variance ratio of the first 5 components: {}'.format(
+        numpy.round(result.explained_variance_ratio[:5], 3)))
+    recon = aggregates.reconciliation(only_failures=False)
+    print(recon.groupby('check')['ok'].agg(['size', 'sum']))
@@ -0,0 +1,331 @@
+"""
+Synthetic State/County tables for benchmarks and offline testing.
+
+The generated tables follow the layout of the CSV files written by
+`convert_geo_var_state_county_to_csv.py`,
+
+ - the same kind of columns as the County_All_Table sheets (keys, FIPS
+   codes, counts, cost totals and per capita / percent / rate metrics),
+   including every column in `CmsGeoVarCountyTable.return_feature_cols`
+ - a National row, a 'STATE TOTAL' row for every state followed by its
+   counties, and the single row states 'PR', 'VI' and 'XX'
+ - additive columns of the state total rows are the sums of their counties
+   and the National row is the sum of the states
+ - missing values with column dependent rates (e.g. about half the counties
+   have no LTCH data)
+
+The number of counties is controlled by `scale` (1 gives roughly as many
+counties as the real table) so benchmarks can measure scaling behavior.
+
+ > python synthetic_data.py --data-dir ./synthetic --scale 10
+"""
+
+import os
+import argparse
+
+import numpy
+import pandas
+
+import us_states
+from geo_var_state_county import CmsGeoVarCountyTable
+from geo_var_state_county import column_kind
+
+
+SINGLE_ROW_STATES = ['PR', 'VI', 'XX']
+NOT_IN_TABLE = ['NA', 'AS', 'GU', 'MP']
+MEAN_COUNTIES_PER_STATE = 62
+DEFAULT_YEARS = list(range(2007, 2015))
+SLCU_CATEGORIES = [
+    'IP', 'PAC: LTCH', 'PAC: IRF', 'PAC: SNF', 'PAC: HH',
+    'Hospice', 'OP', 'FQHC/RHC', 'Outpatient Dialysis Facility',
+    'ASC', 'E&M', 'Procedures', 'Imaging', 'DME', 'Tests',
+    'Part B Drugs', 'Ambulance']
+
+# fraction of counties with missing values for columns that mention these
+MISSING_RATES = {
+    'PAC: LTCH': 0.50,
+    'PAC: IRF': 0.25,
+    'Outpatient Dialysis Facility': 0.20,
+    'FQHC/RHC': 0.15,
+    'Hospice': 0.05,
+}
+DEFAULT_MISSING_RATE = 0.01
+
+
+def synthetic_columns():
+    """Return the column names of a synthetic State/County table."""
+    cols = [
+        'State', 'County', 'State and County FIPS Code',
+        'Beneficiaries with Part A and Part B', 'FFS Beneficiaries',
+        'MA Beneficiaries', 'MA Participation Rate', 'Average Age',
+        'Percent Female', 'Percent Male', 'Percent Non-Hispanic White',
+        'Percent African American', 'Percent Hispanic',
+        'Percent Other/Unknown', 'Percent Eligible for Medicaid',
+        'Average HCC Score', 'Total Actual Costs', 'Actual Per Capita Costs',
+        'Standardized Per Capita Costs',
+        'Standardized Risk-Adjusted Per Capita Costs',
+        'Total Standardized Costs',
+    ]
+    for cat in SLCU_CATEGORIES:
+        cols += [line.format(cat) for line in [
+            '{} Actual Costs',
+            '{} Standardized Costs',
+            '{} Actual Costs as % of Total Actual Costs',
+            '{} Standardized Costs as % of Total Standardized Costs',
+            '{} Per Capita Actual Costs',
+            '{} Per Capita Standardized Costs',
+            '{} Per User Actual Costs',
+            '{} Per User Standardized Costs',
+            'Beneficiaries Using {}',
+            '% of Beneficiaries Using {}',
+        ]]
+        if cat in ['IP', 'PAC: LTCH', 'PAC: IRF', 'PAC: SNF', 'Hospice']:
+            cols += [line.format(cat) for line in [
+                '{} Covered Stays',
+                '{} Covered Stays Per 1000 Beneficiaries',
+                '{} Covered Days',
+                '{} Covered Days Per 1000 Beneficiaries',
+            ]]
+        if cat in ['PAC: HH', 'OP', 'FQHC/RHC']:
+            cols += [
+                '{} Visits'.format(cat),
+                '{} Visits Per 1000 Beneficiaries'.format(cat),
+            ]
+        if cat in ['Outpatient Dialysis Facility', 'ASC', 'E&M', 'Procedures',
+                   'Imaging', 'DME', 'Tests', 'Ambulance']:
+            singular = {'Procedures': 'Procedure', 'Tests': 'Test'}.get(cat, cat)
+            cols += [
+                '{} Events'.format(cat),
+                '{} Events Per 1000 Beneficiaries'.format(singular),
+            ]
+    cols += [
+        'Hospital Readmission Rate',
+        'Emergency Department Visits',
+        'Emergency Department Visits per 1000 Beneficiaries',
+    ]
+    missing = set(CmsGeoVarCountyTable.return_feature_cols()) - set(cols)
+    assert not missing, missing
+    return cols
+
+
+def _metric_values(col, size, rng):
+    """Random values of a non-additive column."""
+    if col == 'Average Age':
+        return rng.normal(71.5, 1.5, size)
+    if col == 'Average HCC Score':
+        return rng.normal(1.0, 0.1, size)
+    if '%' in col or 'Percent' in col or 'Rate' in col:
+        return rng.uniform(0.0, 100.0, size)
+    return rng.lognormal(7.0, 0.6, size)
+
+
+def _county_values(cols, n_counties, rng):
+    """Random values (with missing values) for the non-key columns of
+    `n_counties` counties."""
+    values = numpy.empty((n_counties, len(cols)))
+    for icol, col in enumerate(cols):
+        kind = column_kind(col)
+        if kind == 'count':
+            values[:, icol] = numpy.round(rng.lognormal(8.0, 1.2, n_counties))
+        elif kind == 'amount':
+            values[:, icol] = numpy.round(rng.lognormal(16.0, 1.2, n_counties))
+        else:
+            values[:, icol] = _metric_values(col, n_counties, rng)
+
+        rate = DEFAULT_MISSING_RATE
+        for token, token_rate in MISSING_RATES.items():
+            if token in col:
+                rate = token_rate
+        values[rng.uniform(size=n_counties) < rate, icol] = numpy.nan
+    return values
+
+
+def _total_values(cols, values, rng):
+    """Values of a total row: sums of the additive columns and random
+    values for the others."""
+    total = numpy.empty(len(cols))
+    for icol, col in enumerate(cols):
+        if column_kind(col) in ['count', 'amount']:
+            total[icol] = numpy.nansum(values[:, icol])
+        else:
+            total[icol] = _metric_values(col, 1, rng)[0]
+    return total
+
+
+def make_county_table(scale=1.0, seed=None):
+    """Return a synthetic State/County table.
+
+    Args:
+      scale (float): multiplies the number of counties in each state
+      seed (int): seed for the random number generator
+
+    Returns:
+      DataFrame: National row, then every state total row followed by its
+        counties
+    """
+    rng = numpy.random.RandomState(seed)
+    cols = synthetic_columns()
+    value_cols = cols[3:]
+    states = sorted(
+        [abbr for abbr in us_states.STATES if abbr not in NOT_IN_TABLE] +
+        ['XX'])
+
+    keys = []
+    blocks = []
+    state_totals = []
+    for istate, state in enumerate(states):
+        if state in SINGLE_ROW_STATES:
+            total = _county_values(value_cols, 1, rng)[0]
+            keys.append((state, 'STATE TOTAL', '{:02d}000'.format(istate+1)))
+            blocks.append(total[numpy.newaxis, :])
+            state_totals.append(total)
+            continue
+        n_counties = max(1, int(rng.poisson(MEAN_COUNTIES_PER_STATE) * scale))
+        values = _county_values(value_cols, n_counties, rng)
+        total = _total_values(value_cols, values, rng)
+        keys.append((state, 'STATE TOTAL', '{:02d}000'.format(istate+1)))
+        keys += [
+            (state, 'COUNTY {}'.format(icounty+1),
+             '{:02d}{:03d}'.format(istate+1, icounty+1))
+            for icounty in range(n_counties)]
+        blocks.append(total[numpy.newaxis, :])
+        blocks.append(values)
+        state_totals.append(total)
+
+    national = _total_values(value_cols, numpy.array(state_totals), rng)
+    keys.insert(0, ('National', 'NATIONAL TOTAL', numpy.nan))
+    blocks.insert(0, national[numpy.newaxis, :])
+
+    df = pandas.DataFrame(numpy.concatenate(blocks), columns=value_cols)
+    df.insert(0, 'State', [key[0] for key in keys])
+    df.insert(1, 'County', [key[1] for key in keys])
+    df.insert(2, 'State and County FIPS Code', [key[2] for key in keys])
+    return df
+
+
+def write_county_tables(data_dir, years=DEFAULT_YEARS, scale=1.0, seed=0):
+    """Write one synthetic CSV file per year to `data_dir`.
+
+    Returns:
+      dict: year -> CSV file name (see `discover_csv_fnames`)
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    csv_fnames = {}
+    for year in years:
+        csv_fname = os.path.join(
+            data_dir, 'County_All_Table_{}.csv'.format(year))
+        make_county_table(scale=scale, seed=seed+year).to_csv(csv_fname)
+        csv_fnames[year] = csv_fname
+    return csv_fnames
+
+
+def make_aco_table(n_acos=330, seed=None):
+    """Return a synthetic MSSP ACO results table.
+
+    Columns are spelled like the 2014 results file (see `aco.py`), money
+    columns are formatted like "$1,234,567" and losses like "($1,234)".
+    Most ACOs serve one state, some up to four.
+
+    Args:
+      n_acos (int): number of ACOs (about 330 reported results for 2014)
+      seed (int): seed for the random number generator
+
+    Returns:
+      DataFrame: one row per ACO
+    """
+    rng = numpy.random.RandomState(seed)
+    states = sorted(
+        abbr for abbr in us_states.STATES if abbr not in NOT_IN_TABLE)
+    n_states = numpy.minimum(rng.geometric(0.7, n_acos), 4)
+    service_areas = [
+        ', '.join(us_states.STATES[abbr] for abbr in sorted(
+            rng.choice(states, size=size, replace=False)))
+        for size in n_states]
+
+    beneficiaries = numpy.round(rng.lognormal(9.5, 0.7, n_acos))
+    benchmark = numpy.round(beneficiaries * rng.normal(10500.0, 1500.0, n_acos))
+    expenditures = numpy.round(benchmark * rng.normal(0.99, 0.04, n_acos))
+    savings = benchmark - expenditures
+
+    def money(values):
+        return [
+            '${:,.0f}'.format(value) if value >= 0
+            else '(${:,.0f})'.format(-value) for value in values]
+
+    return pandas.DataFrame({
+        'ACO Name (LBN or DBA, if applicable)': [
+            'ACO {}'.format(iaco+1) for iaco in range(n_acos)],
+        'Agreement Start Date': rng.choice(
+            ['04/01/2012', '07/01/2012', '01/01/2013', '01/01/2014'], n_acos),
+        'ACO Service Area': service_areas,
+        'Total Assigned Beneficiaries': [
+            '{:,.0f}'.format(value) for value in beneficiaries],
+        'Total Benchmark Expenditures': money(benchmark),
+        'Total Expenditures': money(expenditures),
+        'Generated Total Savings/Losses(1,2)': money(savings),
+        'Savings Rate (%)': [
+            '{:.2f}%'.format(100.0 * value)
+            for value in savings / benchmark],
+    })
+
+
+def make_aco_assignments(aco_df, county_df, seed=None):
+    """Return synthetic (ACO, State, County) assignments.
+
+    Every ACO gets a few counties in each state of its service area and a
+    number of assigned beneficiaries per county.
+
+    Args:
+      aco_df (DataFrame): ACO results as read by `aco.read_aco_csv`
+      county_df (DataFrame): State/County table, e.g. from
+        `make_county_table`
+      seed (int): seed for the random number generator
+
+    Returns:
+      DataFrame: columns 'ACO Name', 'State', 'County' and
+        'Assigned Beneficiaries'
+    """
+    rng = numpy.random.RandomState(seed)
+    counties = county_df[county_df['County'] != 'STATE TOTAL']
+    by_state = counties.groupby('State', observed=True)['County'].apply(list)
+    names = {name: abbr for abbr, name in us_states.STATES.items()}
+
+    rows = []
+    for name, service_area in zip(aco_df['ACO Name'], aco_df['ACO Service Area']):
+        for state in service_area.split(', '):
+            abbr = names[state]
+            if abbr not in by_state:
+                continue
+            choices = by_state[abbr]
+            size = min(len(choices), 1 + rng.poisson(3))
+            for county in rng.choice(choices, size=size, replace=False):
+                rows.append((name, abbr, county, rng.randint(11, 5000)))
+    return pandas.DataFrame(
+        rows,
+        columns=['ACO Name', 'State', 'County', 'Assigned Beneficiaries'])
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--data-dir',
+        type=str,
+        default='./synthetic',
+        help='directory to write the CSV files to')
+    parser.add_argument(
+        '--scale',
+        type=float,
+        default=1.0,
+        help='multiplies the number of counties per state')
+    parser.add_argument(
+        '--years',
+        type=int,
+        nargs='+',
+        default=DEFAULT_YEARS,
+        help='years to write')
+    args = parser.parse_args()
+
+    csv_fnames = write_county_tables(args.data_dir, args.years, args.scale)
+    for year, csv_fname in sorted(csv_fnames.items()):
+        print(csv_fname)
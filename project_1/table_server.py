@@ -0,0 +1,623 @@
+"""
+A resident server that keeps `CmsGeoVarCountyTable`s loaded, and a thin
+client for it.
+
+Every script that makes a `CmsGeoVarCountyTable` pays for parsing (or
+memory mapping) the table and for building its row and lookup indexes.
+The server does this once per year and then answers queries over HTTP on
+localhost,
+
+ > python table_server.py --data-dir ./data --years 2013 2014
+
+    client = TableClient()
+    gvct = client.table(2014)
+    df = gvct.select_rows('state')
+    fm = gvct.feature_matrix('county')
+    positions = gvct.locate_fips(['01001', '01003'])
+
+`RemoteTable` has the query methods of `CmsGeoVarCountyTable`
+(`select_rows`, `feature_matrix`, `return_feature_cols`, `locate_states`,
+`locate_counties`, `locate_fips` and `select_state`) plus `aggregate`,
+which groups the rows of a level on the server.
+
+Requests are handled concurrently, one thread per connection.  Encoded
+responses are kept in a least recently used cache (bounded in bytes) so
+repeated queries cost one dictionary lookup.  Responses are not JSON:
+arrays and frame columns are sent as raw little endian buffers after a
+short JSON header (see `encode_payload`) and the client wraps them with
+`numpy.frombuffer` without copying or parsing them.  Arrays in decoded
+responses are read-only.
+"""
+
+import json
+import struct
+import argparse
+import threading
+import http.client
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import numpy
+import pandas
+
+from geo_var_state_county import CmsGeoVarCountyTable
+from geo_var_state_county import FeatureMatrix
+from geo_var_state_county import discover_csv_fnames
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8642
+DEFAULT_CACHE_MB = 256
+ALIGNMENT = 8
+HEADER_STRUCT = struct.Struct('<I')
+CONTENT_TYPE = 'application/x-gvct'
+AGGREGATE_FUNCS = ['count', 'sum', 'mean', 'median', 'min', 'max', 'std']
+
+# errors raised on the server that the client raises again with the same type
+REMOTE_ERRORS = {
+    'KeyError': KeyError,
+    'ValueError': ValueError,
+    'TypeError': TypeError,
+}
+
+
+#==============================================================================
+# binary encoding
+#==============================================================================
+
+def encode_payload(obj):
+    """Encode a query result (DataFrame, Series, array, FeatureMatrix or a
+    JSON compatible object) as bytes.
+
+    The payload is the length of a JSON header (4 bytes, little endian), the
+    header and then the buffers, each one aligned to `ALIGNMENT` bytes.
+    The header describes the object and the dtype, shape and offset of each
+    buffer.  Categorical columns are sent as codes with their categories in
+    the header, nullable integer columns as values and a mask, and object
+    columns in the header.
+    """
+    buffers = []
+    header = _encode(obj, buffers)
+
+    def layout(offset):
+        specs = []
+        for arr in buffers:
+            offset += -offset % ALIGNMENT
+            specs.append({'dtype': arr.dtype.str, 'shape': arr.shape,
+                          'offset': offset})
+            offset += arr.nbytes
+        return specs
+
+    # the offsets depend on the header length, which depends on the offsets
+    specs = layout(0)
+    while True:
+        header['buffers'] = specs
+        head = json.dumps(header).encode()
+        start = HEADER_STRUCT.size + len(head)
+        new_specs = layout(start)
+        if new_specs == specs:
+            break
+        specs = new_specs
+
+    parts = [HEADER_STRUCT.pack(len(head)), head]
+    offset = start
+    for arr, spec in zip(buffers, specs):
+        parts.append(b'\0' * (spec['offset'] - offset))
+        parts.append(numpy.ascontiguousarray(arr).tobytes())
+        offset = spec['offset'] + arr.nbytes
+    return b''.join(parts)
+
+
+def decode_payload(payload):
+    """Decode bytes written by `encode_payload`.  Arrays are read-only views
+    of `payload`."""
+    n_head, = HEADER_STRUCT.unpack_from(payload, 0)
+    header = json.loads(bytes(payload[HEADER_STRUCT.size:
+                                      HEADER_STRUCT.size + n_head]))
+    arrays = []
+    for spec in header['buffers']:
+        dtype = numpy.dtype(spec['dtype'])
+        count = int(numpy.prod(spec['shape']))
+        arrays.append(numpy.frombuffer(
+            payload, dtype=dtype, count=count,
+            offset=spec['offset']).reshape(spec['shape']))
+    return _decode(header, arrays)
+
+
+def _add_buffer(arr, buffers):
+    arr = numpy.asarray(arr)
+    if arr.dtype.byteorder == '>':
+        arr = arr.astype(arr.dtype.newbyteorder('<'))
+    buffers.append(arr)
+    return len(buffers) - 1
+
+
+def _json_values(values):
+    """Return a list of JSON compatible values (NaN and NA become None)."""
+    return [None if pandas.isna(v) else
+            v.item() if isinstance(v, numpy.generic) else v
+            for v in values]
+
+
+def _encode_values(values, buffers):
+    """Encode one column or 1-D array."""
+    if isinstance(values.dtype, pandas.CategoricalDtype):
+        return {'kind': 'categorical',
+                'codes': _add_buffer(values.codes, buffers),
+                'categories': _json_values(values.categories)}
+    if isinstance(values, pandas.arrays.IntegerArray):
+        data = values.to_numpy(dtype=values.dtype.numpy_dtype, na_value=0)
+        return {'kind': 'nullable',
+                'data': _add_buffer(data, buffers),
+                'mask': _add_buffer(numpy.asarray(values.isna()), buffers)}
+    values = numpy.asarray(values)
+    if values.dtype.kind in 'biuf':
+        return {'kind': 'array', 'data': _add_buffer(values, buffers)}
+    return {'kind': 'json', 'values': _json_values(values)}
+
+
+def _decode_values(spec, arrays):
+    kind = spec['kind']
+    if kind == 'categorical':
+        return pandas.Categorical.from_codes(
+            arrays[spec['codes']], spec['categories'])
+    if kind == 'nullable':
+        return pandas.arrays.IntegerArray(
+            arrays[spec['data']], arrays[spec['mask']])
+    if kind == 'array':
+        return arrays[spec['data']]
+    return numpy.array(
+        [numpy.nan if v is None else v for v in spec['values']],
+        dtype=object)
+
+
+def _encode(obj, buffers):
+    if isinstance(obj, pandas.DataFrame):
+        return {
+            'type': 'frame',
+            'index': _encode_values(obj.index.values, buffers),
+            'index_name': obj.index.name,
+            'columns': [
+                [col, _encode_values(obj[col].array, buffers)]
+                for col in obj.columns],
+        }
+    if isinstance(obj, pandas.Series):
+        return {
+            'type': 'series',
+            'name': _json_values([obj.name])[0],
+            'index': _encode_values(obj.index.values, buffers),
+            'values': _encode_values(obj.array, buffers),
+        }
+    if isinstance(obj, FeatureMatrix):
+        return {
+            'type': 'feature_matrix',
+            'values': _add_buffer(obj.values, buffers),
+            'index': _encode_values(obj.index.values, buffers),
+            'columns': list(obj.columns),
+            'frac_nan': _add_buffer(obj.frac_nan, buffers),
+        }
+    if isinstance(obj, numpy.ndarray):
+        return {'type': 'array', 'data': _add_buffer(obj, buffers)}
+    return {'type': 'json', 'value': obj}
+
+
+def _decode(header, arrays):
+    kind = header['type']
+    if kind == 'frame':
+        columns = OrderedDict(
+            (col, _decode_values(spec, arrays))
+            for col, spec in header['columns'])
+        index = pandas.Index(
+            _decode_values(header['index'], arrays),
+            name=header['index_name'])
+        return pandas.DataFrame(columns, index=index, copy=False)
+    if kind == 'series':
+        return pandas.Series(
+            _decode_values(header['values'], arrays),
+            index=_decode_values(header['index'], arrays),
+            name=header['name'])
+    if kind == 'feature_matrix':
+        return FeatureMatrix(
+            values=arrays[header['values']],
+            index=pandas.Index(_decode_values(header['index'], arrays)),
+            columns=header['columns'],
+            frac_nan=arrays[header['frac_nan']],
+        )
+    if kind == 'array':
+        return arrays[header['data']]
+    return header['value']
+
+
+#==============================================================================
+# server
+#==============================================================================
+
+class ResponseCache:
+    """Least recently used cache of encoded responses, bounded in bytes."""
+
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self, key):
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return payload
+
+
+    def put(self, key, payload):
+        if len(payload) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = payload
+            self.n_bytes += len(payload)
+            while self.n_bytes > self.max_bytes:
+                _, old = self._entries.popitem(last=False)
+                self.n_bytes -= len(old)
+
+
+class TableService:
+    """Loaded tables and the queries that can be run on them."""
+
+    QUERIES = [
+        'select_rows', 'feature_matrix', 'return_feature_cols',
+        'locate_states', 'locate_counties', 'locate_fips', 'select_state',
+        'aggregate']
+
+
+    def __init__(self, csv_fnames, cache_mb=DEFAULT_CACHE_MB, verbose=False):
+        """Load one table per year.
+
+        Args:
+          csv_fnames (dict): year -> CSV file name (see
+            `discover_csv_fnames`)
+          cache_mb (float): size of the response cache [MB]
+          verbose (bool): print the file names as they are loaded
+        """
+        with ThreadPoolExecutor() as executor:
+            tables = executor.map(
+                lambda fname: CmsGeoVarCountyTable(fname, verbose=verbose),
+                csv_fnames.values())
+            self.tables = dict(zip(csv_fnames, tables))
+        # a table's memoized results and lazily built indexes are not
+        # meant to be updated from several threads at once
+        self.locks = {year: threading.Lock() for year in self.tables}
+        self.cache = ResponseCache(int(cache_mb * 2**20))
+
+
+    def years(self):
+        return sorted(self.tables)
+
+
+    def handle(self, request):
+        """Return the encoded response to a request, a dictionary with the
+        'year', the 'query' (one of `QUERIES`) and its 'args' and 'kwargs'."""
+        key = json.dumps(request, sort_keys=True)
+        payload = self.cache.get(key)
+        if payload is not None:
+            return payload
+
+        query = request['query']
+        if query not in self.QUERIES:
+            raise ValueError('query must be one of {}'.format(self.QUERIES))
+        year = request.get('year')
+        if year not in self.tables:
+            raise KeyError('no table for year {}'.format(year))
+        method = getattr(self, '_' + query, None)
+        with self.locks[year]:
+            gvct = self.tables[year]
+            args = request.get('args', [])
+            kwargs = request.get('kwargs', {})
+            if method is not None:
+                result = method(gvct, *args, **kwargs)
+            else:
+                result = getattr(gvct, query)(*args, **kwargs)
+            payload = encode_payload(result)
+        self.cache.put(key, payload)
+        return payload
+
+
+    def _select_rows(self, gvct, level, exclude=None, columns=None):
+        df = gvct.select_rows(level, exclude=exclude)
+        if columns is not None:
+            df = df[columns]
+        return df
+
+
+    def _select_state(self, gvct, state, level='county', columns=None):
+        df = gvct.select_state(state, level=level)
+        if columns is not None:
+            df = df[columns]
+        return df
+
+
+    def _feature_matrix(self, gvct, level='county', exclude=None,
+                        max_nan_frac=1.0, dtype='float64'):
+        return gvct.feature_matrix(
+            level, exclude=exclude, max_nan_frac=max_nan_frac,
+            dtype=numpy.dtype(dtype))
+
+
+    def _aggregate(self, gvct, columns, func='mean', level='county',
+                   by='State', exclude=None):
+        if func not in AGGREGATE_FUNCS:
+            raise ValueError('func must be one of {}'.format(AGGREGATE_FUNCS))
+        df = gvct.select_rows(level, exclude=exclude)
+        return df.groupby(by, observed=True)[columns].agg(func)
+
+
+class TableRequestHandler(BaseHTTPRequestHandler):
+    """POST /query with a JSON request returns an encoded response, GET
+    /years the years that are loaded and GET /stats the cache counters."""
+
+    protocol_version = 'HTTP/1.1'
+
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == '/years':
+            self._send(200, encode_payload(service.years()))
+        elif self.path == '/stats':
+            cache = service.cache
+            self._send(200, encode_payload({
+                'hits': cache.hits, 'misses': cache.misses,
+                'entries': len(cache._entries), 'bytes': cache.n_bytes}))
+        else:
+            self._send_error(404, 'KeyError', self.path)
+
+
+    def do_POST(self):
+        if self.path != '/query':
+            self._send_error(404, 'KeyError', self.path)
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            request = json.loads(self.rfile.read(length))
+            payload = self.server.service.handle(request)
+        except Exception as err:
+            message = err.args[0] if len(err.args) == 1 else str(err)
+            self._send_error(400, type(err).__name__, message)
+            return
+        self._send(200, payload)
+
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+    def _send(self, status, payload, content_type=CONTENT_TYPE):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+    def _send_error(self, status, error, message):
+        payload = json.dumps({'error': error, 'message': str(message)})
+        self._send(status, payload.encode(), 'application/json')
+
+
+class TableServer(ThreadingHTTPServer):
+    """HTTP server around a `TableService`."""
+
+    daemon_threads = True
+
+
+    def __init__(self, service, host=DEFAULT_HOST, port=DEFAULT_PORT,
+                 verbose=False):
+        self.service = service
+        self.verbose = verbose
+        ThreadingHTTPServer.__init__(self, (host, port), TableRequestHandler)
+
+
+#==============================================================================
+# client
+#==============================================================================
+
+class TableClient:
+    """Client of a `TableServer`.  Each thread uses its own connection."""
+
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, timeout=60.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._local = threading.local()
+
+
+    def table(self, year):
+        """Return a `RemoteTable` for one year."""
+        return RemoteTable(self, year)
+
+
+    def years(self):
+        """Return the years loaded by the server."""
+        return self._request('GET', '/years')
+
+
+    def stats(self):
+        """Return the counters of the server's response cache."""
+        return self._request('GET', '/stats')
+
+
+    def query(self, year, query, *args, **kwargs):
+        """Run one of `TableService.QUERIES` on the table of `year`."""
+        body = json.dumps({
+            'year': year, 'query': query,
+            'args': [_to_json(arg) for arg in args],
+            'kwargs': {k: _to_json(v) for k, v in kwargs.items()},
+        })
+        return self._request('POST', '/query', body)
+
+
+    def _request(self, method, path, body=None):
+        for attempt in range(2):
+            conn = getattr(self._local, 'conn', None)
+            if conn is None:
+                conn = self._local.conn = http.client.HTTPConnection(
+                    self.host, self.port, timeout=self.timeout)
+            try:
+                conn.request(method, path, body=body)
+                response = conn.getresponse()
+                payload = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                # the server may have closed an idle connection
+                conn.close()
+                self._local.conn = None
+                if attempt == 1:
+                    raise
+        if response.status != 200:
+            error = json.loads(payload)
+            raise REMOTE_ERRORS.get(error['error'], RuntimeError)(
+                error['message'])
+        return decode_payload(payload)
+
+
+def _to_json(value):
+    """Convert array and Series arguments to lists."""
+    if isinstance(value, (numpy.ndarray, pandas.Series, pandas.Index)):
+        return _json_values(value)
+    if isinstance(value, tuple):
+        return list(value)
+    return value
+
+
+class RemoteTable:
+    """Mirror of the query methods of `CmsGeoVarCountyTable` for one year
+    loaded by a `TableServer`."""
+
+
+    def __init__(self, client, year):
+        self.client = client
+        self.year = year
+
+
+    def select_rows(self, level, exclude=None, columns=None):
+        """See `CmsGeoVarCountyTable.select_rows`.  `columns` restricts the
+        columns that are sent."""
+        return self.client.query(
+            self.year, 'select_rows', level, exclude=exclude, columns=columns)
+
+
+    def feature_matrix(self, level='county', exclude=None, max_nan_frac=1.0,
+                       dtype=numpy.float64):
+        """See `CmsGeoVarCountyTable.feature_matrix`."""
+        return self.client.query(
+            self.year, 'feature_matrix', level, exclude=exclude,
+            max_nan_frac=max_nan_frac, dtype=numpy.dtype(dtype).name)
+
+
+    def return_feature_cols(self):
+        """See `CmsGeoVarCountyTable.return_feature_cols`."""
+        return self.client.query(self.year, 'return_feature_cols')
+
+
+    def locate_states(self, states):
+        """See `CmsGeoVarCountyTable.locate_states`."""
+        return self.client.query(self.year, 'locate_states', states)
+
+
+    def locate_counties(self, states, counties):
+        """See `CmsGeoVarCountyTable.locate_counties`."""
+        return self.client.query(
+            self.year, 'locate_counties', states, counties)
+
+
+    def locate_fips(self, codes):
+        """See `CmsGeoVarCountyTable.locate_fips`."""
+        return self.client.query(self.year, 'locate_fips', codes)
+
+
+    def select_state(self, state, level='county', columns=None):
+        """See `CmsGeoVarCountyTable.select_state`."""
+        return self.client.query(
+            self.year, 'select_state', state, level=level, columns=columns)
+
+
+    def aggregate(self, columns, func='mean', level='county', by='State',
+                  exclude=None):
+        """Group the rows of `level` by `by` and aggregate `columns` with
+        `func` (one of `AGGREGATE_FUNCS`) on the server.
+
+        Returns:
+          DataFrame: one row per group
+        """
+        return self.client.query(
+            self.year, 'aggregate', columns, func=func, level=level, by=by,
+            exclude=exclude)
+
+
+def serve(data_dir, years=None, host=DEFAULT_HOST, port=DEFAULT_PORT,
+          cache_mb=DEFAULT_CACHE_MB, verbose=False):
+    """Load the tables of `years` (default all) and serve them until
+    interrupted."""
+    csv_fnames = discover_csv_fnames(data_dir)
+    if years is not None:
+        csv_fnames = {year: csv_fnames[year] for year in years}
+    service = TableService(csv_fnames, cache_mb=cache_mb, verbose=verbose)
+    server = TableServer(service, host=host, port=port, verbose=verbose)
+    print('serving years {} on http://{}:{}'.format(
+        service.years(), *server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--data-dir',
+        type=str,
+        default='./data',
+        help='directory with the yearly CSV files')
+    parser.add_argument(
+        '--years',
+        type=int,
+        nargs='+',
+        default=None,
+        help='years to load (default all)')
+    parser.add_argument(
+        '--host',
+        type=str,
+        default=DEFAULT_HOST,
+        help='address to listen on')
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=DEFAULT_PORT,
+        help='port to listen on')
+    parser.add_argument(
+        '--cache-mb',
+        type=float,
+        default=DEFAULT_CACHE_MB,
+        help='size of the response cache [MB]')
+    parser.add_argument(
+        '--verbose',
+        action='store_true',
+        help='log every request')
+    args = parser.parse_args()
+
+    serve(args.data_dir, years=args.years, host=args.host, port=args.port,
+          cache_mb=args.cache_mb, verbose=args.verbose)